@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""CPU smoke benchmarks of the four workflow templates.
+
+Each template's operation chain is run on a single tiny statepoint in a
+temporary signac project using HOOMD's CPU device, so no GPU, cluster or
+network access is needed. The wall time of every operation and of the
+``status`` evaluation is compared against the baselines stored for this
+host in ``baselines.json``. Baselines are machine specific and not part
+of the repository; without one for this host the comparison is skipped::
+
+    python benchmarks/smoke.py                  # run and compare
+    python benchmarks/smoke.py --update         # store new baselines
+    python benchmarks/smoke.py pps ellipsoids   # only some templates
+
+An operation is flagged as a regression if it takes longer than
+``--tolerance`` times its baseline plus ``--slack`` seconds. Failing
+operations are reported and stop the rest of that template's chain. After
+the chain, the telemetry it recorded must give a walltime prediction.
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import pickle
+import socket
+import sys
+import tempfile
+import time
+import traceback
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINES = os.path.join(ROOT, "benchmarks", "baselines.json")
+sys.path.insert(0, ROOT)
+
+# Tiny statepoint values, applied on top of the first parameter combination
+# of each template's init.py.
+CHAIN_STATEPOINT = dict(
+    chains=(2, 10),
+    n_equil_steps=1e3,
+    n_prod_steps=5e2,
+    n_shrink_steps=1e3,
+    shrink_period=10,
+    gsd_write_freq=100,
+    log_write_freq=100,
+)
+TEMPLATES = {
+    "pps": dict(
+        statepoint=CHAIN_STATEPOINT,
+        doc=dict(run_longer_steps=1e3, compact_tables=True),
+        # Set when the run operation compacted the Table forces.
+        expect_doc=["table_compaction"],
+        chain=[
+            "build",
+            "run",
+            "run-longer",
+            "production",
+            "production_run_longer",
+            "archive",
+        ],
+    ),
+    "kremer-grest": dict(
+        statepoint=CHAIN_STATEPOINT,
+        doc=dict(shrink_steps=1e3),
+        chain=[
+            "build",
+            "run",
+            "run-longer",
+            "production",
+            "production_run_longer",
+            "archive",
+        ],
+    ),
+    "ellipsoids": dict(
+        statepoint=CHAIN_STATEPOINT,
+        doc=dict(
+            run_longer_steps=1e3,
+            dt_benchmark_steps=1e3,
+            run_dt_benchmark=True,
+        ),
+        chain=[
+            "run",
+            "run-longer",
+            "production",
+            "production_run_longer",
+            "shape-overlay",
+            "archive",
+            "dt-benchmark",
+        ],
+    ),
+    "single-ellipsoid": dict(
+        statepoint=dict(
+            N=2,
+            n_equil_steps=1e3,
+            n_prod_steps=5e2,
+            n_shrink_steps=1e3,
+            shrink_period=10,
+            gsd_write_freq=100,
+            log_write_freq=100,
+        ),
+        doc=dict(),
+        chain=["build", "run", "production", "shape-overlay", "archive"],
+    ),
+}
+
+
+def _load_module(template, name):
+    spec = importlib.util.spec_from_file_location(
+        f"smoke_{template.replace('-', '_')}_{name}",
+        os.path.join(ROOT, template, f"{name}.py"),
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_msibi_forcefield(path, width=1000):
+    """A stand-in for the MSIBI project the PPS template reads its FF from.
+
+    Like MSIBI output, all potentials are ``Table`` forces on fine grids and
+    the pair table extends well past where the potential has decayed, so
+    that the table compaction of ``template_utils.tables`` has work to do.
+    """
+    import hoomd
+    import numpy as np
+    import signac
+
+    project = signac.init_project(path)
+    job = project.open_job(dict(smoke=True)).init()
+    nlist = hoomd.md.nlist.Cell(buffer=0.4)
+    pair = hoomd.md.pair.Table(nlist=nlist)
+    r_min, r_cut = 0.8, 4.0
+    r = np.linspace(r_min, r_cut, width, endpoint=False)
+    pair.params[("A", "A")] = dict(
+        r_min=r_min,
+        U=4 * (r**-12 - r**-6),
+        F=4 * (12 * r**-13 - 6 * r**-7),
+    )
+    pair.r_cut[("A", "A")] = r_cut
+    bond = hoomd.md.bond.Table(width=width)
+    r = np.linspace(1.0, 1.9, width)
+    bond.params["A-A"] = dict(
+        r_min=1.0,
+        r_max=1.9,
+        U=0.5 * 1777.6 * (r - 1.4226) ** 2,
+        F=-1777.6 * (r - 1.4226),
+    )
+    angle = hoomd.md.angle.Table(width=width)
+    theta = np.linspace(0, np.pi, width)
+    angle.params["A-A-A"] = dict(
+        U=0.5 * 50.0 * (theta - 2.0) ** 2, tau=-50.0 * (theta - 2.0)
+    )
+    with open(job.fn("pps-msibi.pickle"), "wb") as f:
+        pickle.dump([pair, bond, angle], f)
+    return dict(msibi_project=path, msibi_job=job.id)
+
+
+def _init_project(init_module, statepoint):
+    """Initialize a one-job workspace in the current directory."""
+    names, combinations = init_module.get_parameters()
+    values = dict(zip(names, combinations[0]))
+    values.update((k, v) for k, v in statepoint.items() if k in values)
+    init_module.get_parameters = lambda: (names, [tuple(values.values())])
+    init_module.main()
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(*args)
+    return time.perf_counter() - start
+
+
+def _check_prediction(job):
+    """A template with telemetry records must get a fitted walltime."""
+    from template_utils.walltime import _project_records, predict_walltime
+
+    _project_records.cache_clear()
+    if predict_walltime(job, job.sp.n_equil_steps) is None:
+        raise RuntimeError(
+            "No walltime prediction despite the recorded telemetry."
+        )
+
+
+def run_template(template, workdir):
+    """Run a template's chain in ``workdir`` and return its timings."""
+    import signac
+
+    spec = TEMPLATES[template]
+    statepoint = dict(spec["statepoint"])
+    if template == "pps":
+        statepoint.update(
+            _write_msibi_forcefield(os.path.join(workdir, "msibi"))
+        )
+    project_dir = os.path.join(workdir, template)
+    os.makedirs(project_dir)
+    os.chdir(project_dir)
+    _init_project(_load_module(template, "init"), statepoint)
+    module = _load_module(template, "project")
+    project_class = next(
+        cls
+        for cls in vars(module).values()
+        if isinstance(cls, type)
+        and issubclass(cls, module.FlowProject)
+        and cls is not module.FlowProject
+    )
+    project = project_class.get_project(project_dir)
+    operations = project.operations
+    job = next(iter(signac.get_project()))
+    job.doc.update(execution_profile="cpu", cpu_ranks=1, **spec["doc"])
+
+    timings = dict()
+    failure = None
+    for name in spec["chain"]:
+        if name.startswith("production"):
+            job.doc.equilibrated = True
+        try:
+            timings[name] = _timed(operations[name], job)
+        except Exception:
+            failure = (name, traceback.format_exc())
+            break
+    if failure is None:
+        missing = [k for k in spec.get("expect_doc", []) if k not in job.doc]
+        if missing:
+            failure = ("job document", f"Missing keys: {missing}\n")
+    if failure is None:
+        try:
+            _check_prediction(job)
+        except Exception:
+            failure = ("walltime prediction", traceback.format_exc())
+    timings["status"] = _timed(project.print_status)
+    return timings, failure
+
+
+def compare(results, baselines, tolerance, slack):
+    """Print the timings and return the operations slower than baseline.
+
+    Operations without a stored baseline are marked as skipped.
+    """
+    regressions = []
+    print(
+        f"{'template':>18}  {'operation':>22}  {'time (s)':>10}  "
+        f"{'baseline':>10}"
+    )
+    for template, timings in results.items():
+        for name, seconds in timings.items():
+            baseline = baselines.get(template, dict()).get(name)
+            flag = ""
+            if baseline is None:
+                flag = "  SKIPPED (no baseline)"
+            elif seconds > tolerance * baseline + slack:
+                flag = "  REGRESSION"
+                regressions.append((template, name))
+            print(
+                f"{template:>18}  {name:>22}  {seconds:>10.3f}  "
+                f"{'-' if baseline is None else f'{baseline:.3f}':>10}{flag}"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("templates", nargs="*", default=list(TEMPLATES))
+    parser.add_argument("--update", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    parser.add_argument("--slack", type=float, default=1.0)
+    args = parser.parse_args()
+
+    os.environ["EXECUTION_PROFILE"] = "cpu"
+    cwd = os.getcwd()
+    results = dict()
+    failures = dict()
+    for template in args.templates:
+        print(f"Running {template}...")
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                results[template], failure = run_template(template, workdir)
+            except Exception:
+                results[template] = dict()
+                failure = ("setup", traceback.format_exc())
+            finally:
+                os.chdir(cwd)
+        if failure is not None:
+            failures[template] = failure
+
+    host = socket.gethostname()
+    stored = dict()
+    if os.path.isfile(BASELINES):
+        with open(BASELINES, "r") as f:
+            stored = json.load(f)
+    if host not in stored and not args.update:
+        print(
+            f"No baselines for {host} in {BASELINES}, timings are not "
+            "compared. Run with --update to store them."
+        )
+    regressions = compare(
+        results, stored.get(host, dict()), args.tolerance, args.slack
+    )
+    for template, (name, tb) in failures.items():
+        print(f"\n{template}: {name} failed\n{tb}")
+
+    if args.update:
+        stored.setdefault(host, dict()).update(
+            (t, r) for t, r in results.items() if t not in failures
+        )
+        with open(BASELINES, "w") as f:
+            json.dump(stored, f, indent=2, sort_keys=True)
+        print(f"Baselines for {host} written to {BASELINES}.")
+    return 1 if failures or (regressions and not args.update) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""Startup benchmark of the project modules.
+
+``status`` and ``submit`` run from cron on login nodes, so a project module
+must import and evaluate its labels without loading the simulation stack.
+For each template a workspace is initialized with its ``init.py`` in a
+temporary directory, then
+
+* ``project.py status`` is timed in fresh interpreters, and
+* a probe imports ``project.py``, evaluates the labels of all jobs and lists
+  the heavy modules that were imported on the way::
+
+    python benchmarks/startup.py                   # all templates
+    python benchmarks/startup.py --repeat 5 pps    # only some templates
+
+A template fails if the median ``status`` time exceeds ``--limit`` seconds
+or if any of ``HEAVY_MODULES`` is imported. Operations import these inside
+their functions, where the interpreter caches them for the rest of a worker
+or bundle.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATES = ("pps", "kremer-grest", "ellipsoids", "single-ellipsoid")
+HEAVY_MODULES = (
+    "cmeutils",
+    "flowermd",
+    "freud",
+    "gsd",
+    "hoomd",
+    "mbuild",
+    "scipy",
+    "unyt",
+)
+
+PROBE = """
+import importlib.util, json, sys, time
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("project", sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter() - start
+cls = next(
+    c for c in vars(module).values()
+    if isinstance(c, type) and issubclass(c, module.FlowProject)
+    and c is not module.FlowProject
+)
+project = cls.get_project()
+start = time.perf_counter()
+for job in project:
+    list(project.labels(job))
+labels = time.perf_counter() - start
+heavy = sorted(
+    m for m in json.loads(sys.argv[2]) if m in sys.modules
+)
+print(json.dumps(dict(import_s=imported, labels_s=labels, heavy=heavy)))
+"""
+
+
+def _run(args, cwd):
+    return subprocess.run(
+        [sys.executable] + args,
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def run_template(template, workdir, repeat):
+    """Startup measurements of ``template`` in the workspace ``workdir``."""
+    project_file = os.path.join(ROOT, template, "project.py")
+    _run([os.path.join(ROOT, template, "init.py")], workdir)
+    probe = json.loads(
+        _run(
+            ["-c", PROBE, project_file, json.dumps(HEAVY_MODULES)], workdir
+        ).stdout.splitlines()[-1]
+    )
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        _run([project_file, "status"], workdir)
+        times.append(time.perf_counter() - start)
+    probe["status_s"] = statistics.median(times)
+    return probe
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("templates", nargs="*", default=list(TEMPLATES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--limit", type=float, default=1.0)
+    args = parser.parse_args()
+
+    failed = False
+    print(
+        f"{'template':>18}  {'import (s)':>10}  {'labels (s)':>10}  "
+        f"{'status (s)':>10}  heavy modules"
+    )
+    for template in args.templates:
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                result = run_template(template, workdir, args.repeat)
+            except subprocess.CalledProcessError as e:
+                print(f"{template:>18}  failed\n{e.stderr}")
+                failed = True
+                continue
+        slow = result["status_s"] > args.limit
+        failed = failed or slow or bool(result["heavy"])
+        print(
+            f"{template:>18}  {result['import_s']:>10.3f}  "
+            f"{result['labels_s']:>10.3f}  {result['status_s']:>10.3f}  "
+            f"{', '.join(result['heavy']) or '-'}"
+            f"{'  SLOW' if slow else ''}"
+        )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
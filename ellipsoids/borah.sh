@@ -1,12 +1,22 @@
 {% extends "base_script.sh" %}
 {% block header %}
 {% set gpus = operations|map(attribute='directives.ngpu')|sum %}
+{% set walltime = operations|calc_walltime(parallel) %}
+{# Move predicted runs that exceed the short queue limit to the long queue #}
+{% set short_queue_hours = 12 %}
+{% if walltime and partition == "shortgpu-v100" and walltime.total_seconds() > short_queue_hours * 3600 %}
+{% set partition = "gpu-v100" %}
+{% endif %}
 #!/bin/bash
 #SBATCH --job-name="{{ id }}"
 {% if partition %}
 #SBATCH --partition={{ partition }}
 {% endif %}
+{% if walltime %}
+#SBATCH -t {{ walltime|format_timedelta }}
+{% else %}
 #SBATCH -t {{ 96|format_timedelta }}
+{% endif %}
 {% if gpus %}
 #SBATCH --gres gpu:{{ gpus }}
 {% endif %}
@@ -6,85 +6,127 @@ status, execute operations and submit them to a cluster. See also:
     $ python src/project.py --help
 """
 import signac
-import pickle
-from flow import FlowProject, directives
-from flow.environment import DefaultSlurmEnvironment
+from flow import FlowProject, aggregator
 import os
-from unyt import Unit
+import sys
 
-class Ellipsoids(FlowProject):
-    pass
+# Shared helpers (template_utils) live in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from template_utils.execution import execution_directives
+from template_utils.failures import failure_policy, retry_allowed
+from template_utils.priority import ordered_submit, run_longer_rounds_left
+from template_utils.nlist import tuning_steps
+from template_utils.telemetry import instrumented, phase
+from template_utils.walltime import predicted_walltime
+from template_utils import workflow
+from template_utils.workflow import Fry
 
 
-class Borah(DefaultSlurmEnvironment):
-    hostname_pattern = "borah"
-    template = "borah.sh"
+class Ellipsoids(FlowProject):
+    def submit(self, jobs=None, **kwargs):
+        """Submit the jobs with the longest remaining critical path first."""
+        return ordered_submit(self, CRITICAL_PATH, jobs=jobs, **kwargs)
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="shortgpu-v100",
-            help="Specify the partition to submit to."
-        )
 
+@Ellipsoids.label
+def system_built(job):
+    return job.isfile("init_frame.gsd")
 
-class Fry(DefaultSlurmEnvironment):
-    hostname_pattern = "fry"
-    template = "fry.sh"
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="v100," "batch",
-            help="Specify the partition to submit to."
-        )
+initial_run_done = Ellipsoids.label(workflow.initial_run_done)
+equilibrated = Ellipsoids.label(workflow.equilibrated)
+production_done = Ellipsoids.label(workflow.production_done)
+archived = Ellipsoids.label(workflow.archived)
+nlist_tuned = Ellipsoids.label(workflow.nlist_tuned)
 
 
 @Ellipsoids.label
-def system_built(job):
-    return job.isfile("init_frame.gsd")
+def production_finished(job):
+    # Raise job.doc.production_rounds to run more production_run_longer.
+    return job.doc.production_runs >= job.doc.get("production_rounds", 1)
 
 
-@Ellipsoids.label
-def initial_run_done(job):
-    return job.doc.runs > 0
+def dt_benchmark_requested(job):
+    # Opt in with job.doc.run_dt_benchmark, e.g. for a sweep over dt.
+    return job.doc.get("run_dt_benchmark", False)
 
 
 @Ellipsoids.label
-def equilibrated(job):
-    return job.doc.equilibrated
+def dt_benchmarked(job):
+    return "dt_benchmark" in job.doc
+
+
+def dt_report_written(*jobs):
+    # The report lists the jobs it was built from, it is rebuilt when more
+    # benchmarks are done.
+    import json
+    filename = signac.get_project().fn("dt_benchmark.json")
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, "r") as f:
+        report = json.load(f)
+    benchmarked = sorted(job.id for job in jobs if dt_benchmarked(job))
+    return report.get("jobs") == benchmarked
+
 
 @Ellipsoids.label
-def production_done(job):
-    return job.isfile("production-restart.gsd")
+def overlays_written(job):
+    from template_utils.ellipsoid import missing_overlays
+    return job.isfile("restart.gsd") and not missing_overlays(job)
 
+# Stages of the simulation pipeline, see template_utils.priority
+CRITICAL_PATH = (
+    (
+        initial_run_done,
+        lambda job: job.sp.n_shrink_steps + job.sp.n_equil_steps,
+    ),
+    (
+        equilibrated,
+        lambda job: run_longer_rounds_left(job)
+        * job.doc.get("run_longer_steps", 1e7),
+    ),
+    (production_done, lambda job: 2 * job.sp.n_prod_steps),
+)
+
+
+@Ellipsoids.pre(retry_allowed("run"))
 @Ellipsoids.post(initial_run_done)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"}, name="run"
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(
+            lambda job: job.sp.n_shrink_steps + job.sp.n_equil_steps
+        ),
+    },
+    name="run"
 )
+@instrumented
+@failure_policy
 def run(job):
     """Run initial single-chain simulation."""
-    import unyt
     from unyt import Unit
-    import flowermd
     from flowermd.base import Simulation,Pack
     from flowermd.library import EllipsoidForcefield, EllipsoidChain
     from flowermd.utils import get_target_box_number_density
     from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    import hoomd
+    from template_utils.ellipsoid import store_rigid_bodies
+    from template_utils.writers import set_gsd_dynamic
+    from template_utils.checkpoint import save_checkpoint
+    from template_utils.execution import execution_device, rank_doc
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        doc = rank_doc(job)
+        workflow.print_job_id(job)
         print("Building initial frame.")
-        job.doc.n_particles = int(job.doc.num_mols * job.doc.lengths)
+        doc.n_particles = int(job.doc.num_mols * job.doc.lengths)
         ellipsoid_chain = EllipsoidChain(num_mols=job.doc.num_mols, lengths=job.doc.lengths,lpar=1.0,bead_mass=1.0)
-        system = Pack(molecules=ellipsoid_chain, density=job.sp.density*Unit("nm**-3"), 
-                      packing_expand_factor=11,edge=2,overlap=1,fix_orientation=True)
-        system.to_gsd(job.fn("init_frame.gsd"))
+        with phase("build"):
+            # A failed run increments build_seed, see template_utils.failures.
+            system = Pack(molecules=ellipsoid_chain, density=job.sp.density*Unit("nm**-3"), 
+                          packing_expand_factor=11,edge=2,overlap=1,fix_orientation=True,
+                          seed=12345 + job.doc.get("build_seed", 0))
+        with phase("io"):
+            system.to_gsd(job.fn("init_frame.gsd"))
         print("Finished.")
 
         # Set up Simulation obj
@@ -94,9 +136,11 @@ def run(job):
         ff = EllipsoidForcefield(epsilon=1.0,lpar=1.0,lperp=0.5,r_cut=2.0,bond_k=100,bond_r0=0,angle_k=30,angle_theta0=1.9)
         ff.hoomd_forces
         rigid_frame, rigid = create_rigid_ellipsoid_chain(system.hoomd_snapshot)
-        
+        store_rigid_bodies(job, rigid)
+
         sim = Simulation(
-            initial_state=job.fn("init_frame.gsd"),
+            initial_state=rigid_frame,
+            device=execution_device(job),
             forcefield=ff.hoomd_forces,
             constraint=rigid,
             dt=job.sp.dt,
@@ -106,178 +150,350 @@ def run(job):
             log_file_name=log_path,
             seed=job.sp.sim_seed,
         )
+        set_gsd_dynamic(sim, job)
         sim.pickle_forcefield(job.fn("forcefield.pickle"))
         # Store more unit information in job doc
         tau_kT = job.sp.dt * job.sp.tau_kT
-        job.doc.tau_kT = tau_kT
-        job.doc.real_time_step = sim.real_timestep.to("fs").value
-        job.doc.real_time_units = "fs"
+        doc.tau_kT = tau_kT
+        doc.real_time_step = sim.real_timestep.to("fs").value
+        doc.real_time_units = "fs"
         target_box = get_target_box_number_density(density=job.sp.density*Unit("nm**-3"),n_beads=job.doc.num_mols * 
                                                    job.doc.lengths)
-        job.doc.target_box = target_box.value
+        doc.target_box = target_box.value
         shrink_kT_ramp = sim.temperature_ramp(
                 n_steps=job.sp.n_shrink_steps,
                 kT_start=job.sp.shrink_kT,
                 kT_final=job.sp.kT
         )
-        sim.run_update_volume(
-                final_box_lengths=target_box,
-                n_steps=job.sp.n_shrink_steps,
-                period=job.sp.shrink_period,
-                tau_kt=tau_kT,
-                kT=shrink_kT_ramp
-        )
-        sim.save_restart_gsd(job.fn("shrink_restart.gsd"))
+        with phase("shrink", sim):
+            # Reduced by the retry policy, see template_utils.failures.
+            sim.dt = job.sp.dt * job.doc.get("shrink_dt_factor", 1.0)
+            sim.run_update_volume(
+                    final_box_lengths=target_box,
+                    n_steps=job.sp.n_shrink_steps,
+                    period=job.sp.shrink_period,
+                    tau_kt=tau_kT,
+                    kT=shrink_kT_ramp
+            )
+            sim.dt = job.sp.dt
+        with phase("io"):
+            save_checkpoint(sim, job.fn("shrink_restart.gsd"))
         print("Shrinking simulation finished...")
-        sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs = 1
+        with phase("nvt", sim):
+            sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
+        with phase("io"):
+            save_checkpoint(sim, job.fn("restart.gsd"))
+        doc.runs = 1
         print("Simulation finished.")
 
 @Ellipsoids.pre(initial_run_done)
+@Ellipsoids.pre(retry_allowed("run_longer"))
 @Ellipsoids.post(equilibrated)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(
+            lambda job: job.doc.get("run_longer_steps", 1e7)
+        ),
+    },
     name="run-longer"
 )
+@instrumented
+@failure_policy
 def run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    import gsd.hoomd
-    from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        system = gsd.hoomd.open(job.fn("restart.gsd"),'r')
-        rigid_frame, rigid = create_rigid_ellipsoid_chain(system.hoomd_snapshot)
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-        gsd_path = job.fn(f"trajectory{job.doc.runs}.gsd")
-        log_path = job.fn(f"log{job.doc.runs}.txt")
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="restart.gsd",
+        gsd_file=f"trajectory{job.doc.runs}.gsd",
+        log_file=f"log{job.doc.runs}.txt",
+        n_steps=job.doc.get("run_longer_steps", 1e7),
+        stage="equilibration",
+        counter="runs",
+        seed=job.sp.sim_seed,
+        rigid=True,
+    )
+
+
+@Ellipsoids.pre(initial_run_done)
+@Ellipsoids.post(nlist_tuned)
+@Ellipsoids.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(tuning_steps),
+    },
+    name="tune-nlist"
+)
+@instrumented
+def tune_neighbor_list(job):
+    """Find the fastest neighbor list settings on the current restart.gsd."""
+    workflow.tune_neighbor_list(
+        job,
+        seed=job.sp.sim_seed,
+        rigid=True,
+    )
 
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            constraint=rigid,
-            dt=job.sp.dt,
-            gsd_write_freq=job.sp.gsd_write_freq,
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=1e7,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs += 1
-        print("Simulation finished.")
 
 @Ellipsoids.pre(equilibrated)
+@Ellipsoids.pre(retry_allowed("production_run"))
 @Ellipsoids.post(production_done)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production"
 )
+@instrumented
+@failure_policy
 def production_run(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    import gsd.hoomd
-    from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Running the production run...")
-        system = gsd.hoomd.open(job.fn("restart.gsd"),'r')
-        rigid_frame, rigid = create_rigid_ellipsoid_chain(system.hoomd_snapshot)
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="production-restart.gsd",
+        gsd_file="production.gsd",
+        log_file="production.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.sp.sim_seed,
+        gsd_write_freq=5e5,
+        rigid=True,
+    )
 
-        gsd_path = job.fn(f"production.gsd")
-        log_path = job.fn(f"production.txt")
-
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            constraint=rigid,
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        job.doc.production_runs += 1
-        print("Simulation finished.")
-   
 
 @Ellipsoids.pre(production_done)
+@Ellipsoids.pre(retry_allowed("production_run_longer"))
+@Ellipsoids.post(production_finished)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production_run_longer"
 )
+@instrumented
+@failure_policy
 def production_run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
+    workflow.continue_nvt(
+        job,
+        restart="production-restart.gsd",
+        output="production-restart.gsd",
+        gsd_file=f"production{job.doc.production_runs+1}.gsd",
+        log_file=f"production{job.doc.production_runs+1}.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.sp.sim_seed,
+        gsd_write_freq=5e5,
+        rigid=True,
+    )
+
+
+@Ellipsoids.pre(production_finished)
+@Ellipsoids.post(archived)
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="archive"
+)
+@instrumented
+def archive(job):
+    """Replace finished trajectory segments with verified slim archives."""
+    from template_utils.archive import archive_job
+    from template_utils.trajectory import find_segments
+    with job:
+        workflow.print_job_id(job)
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="equilibration"),
+            frames="log",
+            n_frames=100,
+            types=["R"],
+            keep_orientation=True,
+        )
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="production"),
+            frames="stride",
+            stride=job.doc.get("archive_stride", 1),
+            types=["R"],
+            keep_orientation=True,
+        )
+        print("Finished.")
+
+
+@Ellipsoids.pre(initial_run_done)
+@Ellipsoids.post(overlays_written)
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="shape-overlay"
+)
+@instrumented
+def shape_overlay(job):
+    """Write small OVITO overlays of the rigid centers with ellipsoid shapes."""
+    from template_utils.ellipsoid import (
+        missing_overlays,
+        overlay_name,
+        write_shape_overlay,
+    )
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Continuing the production run...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-
-        gsd_path = job.fn(f"production{job.doc.production_runs+1}.gsd")
-        log_path = job.fn(f"production{job.doc.production_runs+1}.txt")
-        ref_values = get_ref_values(job)
+        workflow.print_job_id(job)
+        for segment in missing_overlays(job):
+            print(f"Writing shape overlay for {segment}...")
+            write_shape_overlay(
+                gsd_file=segment,
+                new_file=overlay_name(segment),
+                lpar=1.0,
+                lperp=0.5,
+                stride=job.doc.get("overlay_stride", 1),
+            )
+        print("Finished.")
 
+
+@Ellipsoids.pre(dt_benchmark_requested)
+@Ellipsoids.post(dt_benchmarked)
+@Ellipsoids.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(
+            lambda job: 3 * job.doc.get("dt_benchmark_steps", 1e5)
+        ),
+    },
+    name="dt-benchmark"
+)
+@instrumented
+def dt_benchmark(job):
+    """Measure energy drift and TPS of short NVT/NVE runs at this job's dt."""
+    from unyt import Unit
+    from flowermd.base import Simulation, Pack
+    from flowermd.library import EllipsoidForcefield, EllipsoidChain
+    from flowermd.utils import get_target_box_number_density
+    from flowermd.utils.constraints import create_rigid_ellipsoid_chain
+    from template_utils.ellipsoid import body_definitions
+    from template_utils.stability import measure_stability, unstable_result
+    from template_utils.execution import execution_device, rank_doc
+    with job:
+        doc = rank_doc(job)
+        workflow.print_job_id(job)
+        n_steps = int(job.doc.setdefault("dt_benchmark_steps", 1e5))
+        ellipsoid_chain = EllipsoidChain(num_mols=job.doc.num_mols, lengths=job.doc.lengths,lpar=1.0,bead_mass=1.0)
+        with phase("build"):
+            system = Pack(molecules=ellipsoid_chain, density=job.sp.density*Unit("nm**-3"),
+                          packing_expand_factor=11,edge=2,overlap=1,fix_orientation=True)
+        ff = EllipsoidForcefield(epsilon=1.0,lpar=1.0,lperp=0.5,r_cut=2.0,bond_k=100,bond_r0=0,angle_k=30,angle_theta0=1.9)
+        rigid_frame, rigid = create_rigid_ellipsoid_chain(system.hoomd_snapshot)
         sim = Simulation(
-            initial_state=job.fn("production-restart.gsd"),
-            forcefield=hoomd_ff,
-            reference_values=ref_values,
+            initial_state=rigid_frame,
+            device=execution_device(job),
+            forcefield=ff.hoomd_forces,
+            constraint=rigid,
             dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-        gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
+            gsd_write_freq=n_steps * 10,
+            gsd_file_name=job.fn("dt-benchmark.gsd"),
+            log_write_freq=max(1, n_steps // 100),
+            log_file_name=job.fn("dt-benchmark.txt"),
             seed=job.sp.sim_seed,
         )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
+        tau_kT = job.sp.dt * job.sp.tau_kT
+        target_box = get_target_box_number_density(density=job.sp.density*Unit("nm**-3"),n_beads=job.doc.num_mols *
+                                                   job.doc.lengths)
+        try:
+            print("Shrinking to the target density...")
+            with phase("shrink", sim):
+                sim.run_update_volume(
+                        final_box_lengths=target_box,
+                        n_steps=n_steps,
+                        period=10,
+                        tau_kt=tau_kT,
+                        kT=job.sp.kT,
+                        thermalize_particles=True
+                )
+            print("Measuring stability...")
+            result = measure_stability(
+                sim,
+                kT=job.sp.kT,
+                tau_kt=tau_kT,
+                n_steps=n_steps,
+                bodies=body_definitions(rigid),
+            )
+        except RuntimeError as e:
+            # HOOMD errors out of unstable runs, e.g. particles out of the
+            # box. Record the dt as unstable so that dt-report can run.
+            print(f"Unstable at dt = {job.sp.dt}: {e}")
+            result = unstable_result(job.sp.dt, e)
+        result["real_time_step"] = sim.real_timestep.to("fs").value
+        doc.dt_benchmark = result
+        print(result)
+        print("Finished.")
+
+
+@Ellipsoids.pre(
+    lambda *jobs: any(dt_benchmark_requested(job) for job in jobs)
+    and all(
+        dt_benchmarked(job) for job in jobs if dt_benchmark_requested(job)
+    )
+)
+@Ellipsoids.post(dt_report_written)
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="dt-report",
+    aggregator=aggregator()
+)
+def dt_report(*jobs):
+    """Report the largest stable dt and its throughput for each chain size."""
+    import json
+    from template_utils.stability import largest_stable_dt
+    groups = dict()
+    for job in jobs:
+        if not dt_benchmarked(job):
+            continue
+        key = f"{job.doc.num_mols}x{job.doc.lengths}"
+        groups.setdefault(key, []).append(job)
+    report = dict(
+        jobs=sorted(job.id for group in groups.values() for job in group),
+        dt=dict(),
+    )
+    for key, group in sorted(groups.items()):
+        best = largest_stable_dt(
+            [dict(job.doc["dt_benchmark"]) for job in group],
+            kT=group[0].sp.kT
         )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        print("Simulation finished.")
-        job.doc.production_runs += 1
-        
+        if best is None:
+            print(f"{key} chains: no stable dt found.")
+        else:
+            best["ns_per_hour"] = (
+                best["real_time_step"] * best["nvt_tps"] * 3600 * 1e-6
+            )
+            print(
+                f"{key} chains: largest stable dt = {best['dt']}, "
+                f"{best['time_per_hour']:.4g} time units / hour "
+                f"({best['ns_per_hour']:.4g} ns / hour)"
+            )
+        report["dt"][key] = best
+    with open(signac.get_project().fn("dt_benchmark.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="collect-results",
+    aggregator=aggregator()
+)
+def collect(*jobs):
+    """Update the project-wide results table in results.npz."""
+    from template_utils.results import RESULTS_FILE, collect_results
+    n_read = collect_results(jobs, signac.get_project().fn(RESULTS_FILE))
+    print(f"Read {n_read} of {len(jobs)} jobs into {RESULTS_FILE}.")
+
+
 if __name__ == "__main__":
-    Ellipsoids(environment=Fry).main()
+    if sys.argv[1:2] == ["worker"]:
+        from template_utils import worker
+        worker.main(Ellipsoids.get_project(), CRITICAL_PATH, sys.argv[2:])
+    else:
+        Ellipsoids(environment=Fry).main()
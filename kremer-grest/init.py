@@ -11,12 +11,19 @@ The result of running this file is the creation of a signac workspace:
 
 """
 
+import os
 import signac
 import flow
 import logging
+import sys
 from collections import OrderedDict
 from itertools import product
 
+# Shared helpers (template_utils) live in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from template_utils import statepoints
+from template_utils.statepoints import load_index, save_index
+
 
 def get_parameters():
     ''''''
@@ -40,6 +47,23 @@ def get_parameters():
     return list(parameters.keys()), list(product(*parameters.values()))
 
 
+def init_job(job):
+    """Set the document defaults of a job."""
+    job.doc.setdefault("equilibrated", False)
+    job.doc.setdefault("sampled", False)
+    job.doc.setdefault("runs", 0)
+    job.doc.setdefault("production_runs",0)
+    job.doc.setdefault("num_mols", job.sp.chains[0])
+    job.doc.setdefault("lengths", job.sp.chains[1])
+    # Soft push-off before the full KG force field, see
+    # template_utils.pushoff. Allows a larger dt for equilibration.
+    job.doc.setdefault("pushoff", False)
+    # Run the run-longer and production stages of all seeds of a statepoint
+    # together in one process (run-longer-replicas, production-replicas).
+    # Useful for small systems, see template_utils.replicas.
+    job.doc.setdefault("replicas", False)
+
+
 def main():
     project = signac.init_project()
     param_names, param_combinations = get_parameters()
@@ -48,14 +72,10 @@ def main():
         statepoint = dict(zip(param_names, params))
         job = project.open_job(statepoint)
         job.init()
-        job.doc.setdefault("equilibrated", False)
-        job.doc.setdefault("sampled", False)
-        job.doc.setdefault("runs", 0)
-        job.doc.setdefault("production_runs",0)
-        job.doc.setdefault("num_mols", job.sp.chains[0])
-        job.doc.setdefault("lengths", job.sp.chains[1])
+        init_job(job)
+    save_index(project, load_index(project))
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    main()
+    statepoints.main(get_parameters, init_job, walk=main)
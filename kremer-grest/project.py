@@ -6,90 +6,98 @@ status, execute operations and submit them to a cluster. See also:
     $ python src/project.py --help
 """
 import signac
-import pickle
-from flow import FlowProject, directives
-from flow.environment import DefaultSlurmEnvironment
+from flow import FlowProject, aggregator
 import os
-from unyt import Unit
+import sys
+
+# Shared helpers (template_utils) live in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from template_utils.execution import execution_directives
+from template_utils.failures import failure_policy, retry_allowed
+from template_utils.priority import ordered_submit, run_longer_rounds_left
+from template_utils.replicas import replica_key
+from template_utils.nlist import tuning_steps
+from template_utils.telemetry import instrumented, phase
+from template_utils.walltime import predicted_walltime
+from template_utils import workflow
+from template_utils.workflow import Fry
 
 
 class KGCG(FlowProject):
-    pass
+    def submit(self, jobs=None, **kwargs):
+        """Submit the jobs with the longest remaining critical path first."""
+        return ordered_submit(self, CRITICAL_PATH, jobs=jobs, **kwargs)
 
 
-class Borah(DefaultSlurmEnvironment):
-    hostname_pattern = "borah"
-    template = "borah.sh"
+@KGCG.label
+def system_built(job):
+    # A failed run increments build_seed to request a new configuration.
+    return job.isfile("init_frame.gsd") and job.doc.get(
+        "built_seed", 0
+    ) == job.doc.get("build_seed", 0)
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="shortgpu-v100",
-            help="Specify the partition to submit to."
-        )
 
+initial_run_done = KGCG.label(workflow.initial_run_done)
+equilibrated = KGCG.label(workflow.equilibrated)
+sampled = KGCG.label(workflow.sampled)
+production_done = KGCG.label(workflow.production_done)
+archived = KGCG.label(workflow.archived)
+nlist_tuned = KGCG.label(workflow.nlist_tuned)
 
-class Fry(DefaultSlurmEnvironment):
-    hostname_pattern = "fry"
-    template = "fry.sh"
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="v100," "batch",
-            help="Specify the partition to submit to."
-        )
+def replicas_together(job):
+    # The run-longer and production stages of all seeds of a statepoint run
+    # in the *-replicas operations instead of per job, see init.py.
+    return job.doc.get("replicas", False)
 
 
-@KGCG.label
-def system_built(job):
-    return job.isfile("init_frame.gsd")
-
+def single_job(job):
+    return not replicas_together(job)
 
-@KGCG.label
-def initial_run_done(job):
-    return job.doc.runs > 0
 
-
-@KGCG.label
-def equilibrated(job):
-    return job.doc.equilibrated
+def initial_run_steps(job):
+    """Steps of the run operation, including the optional push-off."""
+    steps = job.doc.get("shrink_steps", 1e5) + job.sp.n_equil_steps
+    if job.doc.get("pushoff", False):
+        steps += job.doc.get("pushoff_steps", 1e5)
+    return steps
 
 
-@KGCG.label
-def sampled(job):
-    return job.doc.sampled
+# Stages of the simulation pipeline, see template_utils.priority
+CRITICAL_PATH = (
+    (initial_run_done, initial_run_steps),
+    (
+        equilibrated,
+        lambda job: run_longer_rounds_left(job) * job.sp.n_equil_steps,
+    ),
+    (production_done, lambda job: 2 * job.sp.n_prod_steps),
+)
 
 
-@KGCG.label
-def production_done(job):
-    return job.isfile("production-restart.gsd")
-
+@KGCG.pre(retry_allowed("build"))
 @KGCG.post(system_built)
 @KGCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"}, name="build"
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"}, name="build"
 )
+@instrumented
+@failure_policy
 def build(job):
     """Build system."""
     import mbuild as mb
     from mbuild.path import HardSphereRandomWalk
-    from mbuild import Polymer
     import numpy as np
-    from scipy.spatial.distance import pdist
-    import freud
     
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        workflow.print_job_id(job)
 
     chain_length = job.doc.lengths
     n_chains = job.doc.num_mols
+    job.doc.n_particles = int(n_chains * chain_length)
     
-    seeds = [np.random.randint(low=1) for i in range(n_chains)]
+    # Shifted by the retry policy after a failed run, see
+    # template_utils.failures.
+    build_seed = job.doc.get("build_seed", 0)
+    seeds = [np.random.randint(low=1) + build_seed for i in range(n_chains)]
     chains = []
     
     for seed in seeds:
@@ -105,38 +113,94 @@ def build(job):
         rw_path.generate()
         chains.append(rw_path.to_compound(bead_name="A", bead_mass=1.0))
     a = int(chain_length//2 + 25)
-    box = mb.fill_box(compound=chains, n_compounds=[1 for i in chains], box=[a,a,a],overlap=2,edge=3)
+    box = mb.fill_box(compound=chains, n_compounds=[1 for i in chains], box=[a,a,a],overlap=2,edge=3,seed=12345+build_seed)
     box.check_for_overlap(minimum_distance=1.0, excluded_bond_depth=1)
     box.save(job.fn("init_frame.gsd"))
+    job.doc.built_seed = build_seed
 
 @KGCG.pre(system_built)
+@KGCG.pre(retry_allowed("run"))
 @KGCG.post(initial_run_done)
 @KGCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"}, name="run"
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(initial_run_steps),
+    },
+    name="run"
 )
+@instrumented
+@failure_policy
 def run(job):
     """Run initial simulation."""
-    import unyt
     from unyt import Unit
     import numpy
-    import flowermd
     from flowermd.base import Simulation
     from flowermd.library import KremerGrestBeadSpring
     from flowermd.utils import get_target_box_number_density
-    import hoomd
+    from template_utils.writers import set_gsd_dynamic
+    from template_utils.checkpoint import save_checkpoint
+    from template_utils.pushoff import run_pushoff, soft_forcefield
+    from template_utils.execution import execution_device, rank_doc
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        doc = rank_doc(job)
+        workflow.print_job_id(job)
 
 
         ff = KremerGrestBeadSpring(bond_k=100,bond_max=1.15,sigma=1.0)
         gsd_path = job.fn(f"trajectory{job.doc.runs}.gsd")
         log_path = job.fn(f"log{job.doc.runs}.txt")
         seed = numpy.random.randint(1,1e4)
+        device = execution_device(job)
+        target_box = get_target_box_number_density(density=job.sp.density*Unit("nm**-3"),n_beads=job.doc.num_mols*job.doc.lengths)
+        initial_state = job.fn("init_frame.gsd")
+        if job.doc.get("pushoff", False):
+            # Shrink and remove overlaps with a soft potential, so that the
+            # full force field can start at a production-sized dt.
+            print("Pushing off overlaps with a soft potential...")
+            pushoff_dt = job.doc.get("pushoff_dt", 0.001)
+            soft, soft_forces = soft_forcefield(
+                KremerGrestBeadSpring(bond_k=100,bond_max=1.15,sigma=1.0).hoomd_forces
+            )
+            pushoff_sim = Simulation(
+                initial_state=initial_state,
+                device=device,
+                forcefield=soft_forces,
+                # Reduced by the retry policy, see template_utils.failures.
+                dt=pushoff_dt * job.doc.get("shrink_dt_factor", 1.0),
+                gsd_write_freq=job.sp.gsd_write_freq,
+                gsd_file_name=job.fn("pushoff.gsd"),
+                log_write_freq=job.sp.log_write_freq,
+                log_file_name=job.fn("pushoff.txt"),
+                seed=seed,
+            )
+            set_gsd_dynamic(pushoff_sim, job)
+            with phase("shrink", pushoff_sim):
+                pushoff_sim.run_update_volume(
+                    final_box_lengths=target_box,
+                    kT=3.0,
+                    n_steps=job.doc.get("shrink_steps", 1e5),
+                    tau_kt=100*pushoff_dt,
+                    period=10,
+                    thermalize_particles=True
+                )
+            with phase("pushoff", pushoff_sim):
+                run_pushoff(
+                    pushoff_sim,
+                    soft,
+                    kT=job.sp.kT,
+                    tau_kt=100*pushoff_dt,
+                    n_steps=job.doc.get("pushoff_steps", 1e5),
+                    A_final=job.doc.get("pushoff_A", 100.0),
+                )
+            with phase("io"):
+                save_checkpoint(pushoff_sim, job.fn("shrink_restart.gsd"))
+            initial_state = job.fn("shrink_restart.gsd")
+            print("Push-off finished...")
+
         sim = Simulation(
-            initial_state=job.fn("init_frame.gsd"),
+            initial_state=initial_state,
+            device=device,
             forcefield=ff.hoomd_forces,
             dt=job.sp.dt,
             gsd_write_freq=job.sp.gsd_write_freq,
@@ -145,177 +209,223 @@ def run(job):
             log_file_name=log_path,
             seed=seed,
         )
+        set_gsd_dynamic(sim, job)
 
-        target_box = get_target_box_number_density(density=job.sp.density*Unit("nm**-3"),n_beads=job.doc.num_mols*job.doc.lengths)
         sim.pickle_forcefield(job.fn("forcefield.pickle"))
         # Store more unit information in job doc
         tau_kT = job.sp.dt * 100
-        job.doc.tau_kT = tau_kT
-        job.doc.real_time_step = sim.real_timestep.to("fs").value
-        job.doc.real_time_units = "fs"
-        job.doc.target_box = target_box.value
-        job.doc.seed = seed
+        doc.tau_kT = tau_kT
+        doc.real_time_step = sim.real_timestep.to("fs").value
+        doc.real_time_units = "fs"
+        doc.target_box = target_box.value
+        doc.seed = seed
     
-        sim.run_update_volume(
-            final_box_lengths=target_box,
-            kT=3.0,
-            n_steps=1e5,
-            tau_kt=100*job.sp.dt,
-            period=10,
-            thermalize_particles=True
-        )
-        sim.save_restart_gsd(job.fn("shrink_restart.gsd"))
-        print("Shrinking simulation finished...")
-        sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs = 1
+        if not job.doc.get("pushoff", False):
+            with phase("shrink", sim):
+                # Reduced by the retry policy, see template_utils.failures.
+                sim.dt = job.sp.dt * job.doc.get("shrink_dt_factor", 1.0)
+                sim.run_update_volume(
+                    final_box_lengths=target_box,
+                    kT=3.0,
+                    n_steps=job.doc.get("shrink_steps", 1e5),
+                    tau_kt=100*job.sp.dt,
+                    period=10,
+                    thermalize_particles=True
+                )
+                sim.dt = job.sp.dt
+            with phase("io"):
+                save_checkpoint(sim, job.fn("shrink_restart.gsd"))
+            print("Shrinking simulation finished...")
+        with phase("nvt", sim):
+            sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
+        with phase("io"):
+            save_checkpoint(sim, job.fn("restart.gsd"))
+        doc.runs = 1
         print("Simulation finished.")
 
 @KGCG.pre(initial_run_done)
+@KGCG.pre(single_job)
+@KGCG.pre(retry_allowed("run_longer"))
 @KGCG.post(equilibrated)
 @KGCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: job.sp.n_equil_steps),
+    },
     name="run-longer"
 )
+@instrumented
+@failure_policy
 def run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-        gsd_path = job.fn(f"trajectory{job.doc.runs}.gsd")
-        log_path = job.fn(f"log{job.doc.runs}.txt")
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            dt=job.sp.dt,
-            gsd_write_freq=job.sp.gsd_write_freq,
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.doc.seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_equil_steps,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs += 1
-        print("Simulation finished.")
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="restart.gsd",
+        gsd_file=f"trajectory{job.doc.runs}.gsd",
+        log_file=f"log{job.doc.runs}.txt",
+        n_steps=job.sp.n_equil_steps,
+        stage="equilibration",
+        counter="runs",
+        seed=job.doc.seed,
+    )
+
+
+@KGCG.pre(initial_run_done)
+@KGCG.post(nlist_tuned)
+@KGCG.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(tuning_steps),
+    },
+    name="tune-nlist"
+)
+@instrumented
+def tune_neighbor_list(job):
+    """Find the fastest neighbor list settings on the current restart.gsd."""
+    workflow.tune_neighbor_list(
+        job,
+        seed=job.doc.seed,
+    )
+
 
 @KGCG.pre(equilibrated)
+@KGCG.pre(single_job)
+@KGCG.pre(retry_allowed("production_run"))
 @KGCG.post(production_done)
 @KGCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production"
 )
+@instrumented
+@failure_policy
 def production_run(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Running the production run...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-
-        gsd_path = job.fn(f"production.gsd")
-        log_path = job.fn(f"production.txt")
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="production-restart.gsd",
+        gsd_file="production.gsd",
+        log_file="production.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.doc.seed,
+        gsd_write_freq=5e5,
+    )
 
-        sim = Simulation(
-            initial_state = job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-        gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.doc.seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        job.doc.production_runs += 1
-        print("Simulation finished.")
-   
 
 @KGCG.pre(production_done)
+@KGCG.pre(retry_allowed("production_run_longer"))
+@KGCG.post(sampled)
 @KGCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production_run_longer"
 )
+@instrumented
+@failure_policy
 def production_run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Continuing the production run...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-
-        gsd_path = job.fn(f"production{job.doc.production_runs+1}.gsd")
-        log_path = job.fn(f"production{job.doc.production_runs+1}.txt")
+    workflow.continue_nvt(
+        job,
+        restart="production-restart.gsd",
+        output="production-restart.gsd",
+        gsd_file=f"production{job.doc.production_runs+1}.gsd",
+        log_file=f"production{job.doc.production_runs+1}.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.doc.seed,
+        gsd_write_freq=5e5,
+    )
+
+
+@KGCG.pre(
+    lambda *jobs: all(
+        replicas_together(job)
+        and initial_run_done(job)
+        and not equilibrated(job)
+        for job in jobs
+    )
+)
+@KGCG.pre(retry_allowed("run_longer_replicas"))
+@KGCG.post(lambda *jobs: all(equilibrated(job) for job in jobs))
+@KGCG.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: job.sp.n_equil_steps),
+    },
+    name="run-longer-replicas",
+    aggregator=aggregator.groupby(key=replica_key),
+)
+@instrumented
+@failure_policy
+def run_longer_replicas(*jobs):
+    """Run-longer for all seed replicas of a statepoint in one process."""
+    workflow.continue_replicas(
+        jobs,
+        restart="restart.gsd",
+        output="restart.gsd",
+        gsd_files=[f"trajectory{job.doc.runs}.gsd" for job in jobs],
+        n_steps=jobs[0].sp.n_equil_steps,
+        stage="equilibration",
+        counter="runs",
+        seeds=[job.doc.seed for job in jobs],
+    )
+
+
+@KGCG.pre(
+    lambda *jobs: all(
+        replicas_together(job) and equilibrated(job) for job in jobs
+    )
+)
+@KGCG.pre(retry_allowed("production_replicas"))
+@KGCG.post(lambda *jobs: all(production_done(job) for job in jobs))
+@KGCG.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
+    name="production-replicas",
+    aggregator=aggregator.groupby(key=replica_key),
+)
+@instrumented
+@failure_policy
+def production_replicas(*jobs):
+    """Production run for all seed replicas of a statepoint in one process."""
+    workflow.continue_replicas(
+        jobs,
+        restart="restart.gsd",
+        output="production-restart.gsd",
+        gsd_files=["production.gsd" for job in jobs],
+        n_steps=jobs[0].sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seeds=[job.doc.seed for job in jobs],
+        gsd_write_freq=5e5,
+    )
 
-        sim = Simulation(
-            initial_state=job.fn("production-restart.gsd"),
-            forcefield=hoomd_ff,
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-        gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.doc.seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        print("Simulation finished.")
-        job.doc.production_runs += 1
 
 @KGCG.pre(production_done)
 @KGCG.operation(
     directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
     name="sample"
 )
+@instrumented
 def sample(job):
     import numpy as np
     from cmeutils.dynamics import msd_from_gsd
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        workflow.print_job_id(job)
         steps_per_frame = int(5e5)
         # Update job doc
         ts = job.doc.real_time_step * 1e-15
@@ -335,6 +445,53 @@ def sample(job):
         
         print("Finished.")
         job.doc.sampled = True
-        
+
+
+@KGCG.pre(sampled)
+@KGCG.post(archived)
+@KGCG.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="archive"
+)
+@instrumented
+def archive(job):
+    """Replace finished trajectory segments with verified slim archives."""
+    from template_utils.archive import chain_center_indices, archive_job
+    from template_utils.trajectory import find_segments
+    with job:
+        workflow.print_job_id(job)
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="equilibration"),
+            frames="log",
+            n_frames=100,
+            indices=chain_center_indices(job.doc.num_mols, job.doc.lengths),
+        )
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="production"),
+            frames="stride",
+            stride=job.doc.get("archive_stride", 1),
+            indices=chain_center_indices(job.doc.num_mols, job.doc.lengths),
+        )
+        print("Finished.")
+
+
+@KGCG.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="collect-results",
+    aggregator=aggregator()
+)
+def collect(*jobs):
+    """Update the project-wide results table in results.npz."""
+    from template_utils.results import RESULTS_FILE, collect_results
+    n_read = collect_results(jobs, signac.get_project().fn(RESULTS_FILE))
+    print(f"Read {n_read} of {len(jobs)} jobs into {RESULTS_FILE}.")
+
+
 if __name__ == "__main__":
-    KGCG(environment=Fry).main()
+    if sys.argv[1:2] == ["worker"]:
+        from template_utils import worker
+        worker.main(KGCG.get_project(), CRITICAL_PATH, sys.argv[2:])
+    else:
+        KGCG(environment=Fry).main()
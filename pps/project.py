@@ -7,69 +7,48 @@ status, execute operations and submit them to a cluster. See also:
 """
 import signac
 import pickle
-from flow import FlowProject, directives
-from flow.environment import DefaultSlurmEnvironment
+from flow import FlowProject, aggregator
 import os
-from unyt import Unit
+import sys
 
+# Shared helpers (template_utils) live in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from template_utils.execution import execution_directives
+from template_utils.failures import failure_policy, retry_allowed
+from template_utils.priority import ordered_submit, run_longer_rounds_left
+from template_utils.nlist import tuning_steps
+from template_utils.telemetry import instrumented, phase
+from template_utils.walltime import predicted_walltime
+from template_utils import workflow
+from template_utils.workflow import Fry
 
-class PPSCG(FlowProject):
-    pass
-
-
-class Borah(DefaultSlurmEnvironment):
-    hostname_pattern = "borah"
-    template = "borah.sh"
-
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="shortgpu-v100",
-            help="Specify the partition to submit to."
-        )
-
-
-class Fry(DefaultSlurmEnvironment):
-    hostname_pattern = "fry"
-    template = "fry.sh"
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="v100," "batch",
-            help="Specify the partition to submit to."
-        )
+class PPSCG(FlowProject):
+    def submit(self, jobs=None, **kwargs):
+        """Submit the jobs with the longest remaining critical path first."""
+        return ordered_submit(self, CRITICAL_PATH, jobs=jobs, **kwargs)
 
 
 @PPSCG.label
 def system_built(job):
-    return job.isfile("init_frame.gsd")
+    # A failed run increments build_seed to request a new configuration.
+    return job.isfile("init_frame.gsd") and job.doc.get(
+        "built_seed", 0
+    ) == job.doc.get("build_seed", 0)
 
 
-@PPSCG.label
-def initial_run_done(job):
-    return job.doc.runs > 0
-
-
-@PPSCG.label
-def equilibrated(job):
-    return job.doc.equilibrated
-
-
-@PPSCG.label
-def sampled(job):
-    return job.doc.sampled
-
-
-@PPSCG.label
-def production_done(job):
-    return job.isfile("production-restart.gsd")
+initial_run_done = PPSCG.label(workflow.initial_run_done)
+equilibrated = PPSCG.label(workflow.equilibrated)
+sampled = PPSCG.label(workflow.sampled)
+production_done = PPSCG.label(workflow.production_done)
+archived = PPSCG.label(workflow.archived)
+nlist_tuned = PPSCG.label(workflow.nlist_tuned)
 
 
 def get_ref_values(job):
     """These are the reference values for PPS."""
+    from unyt import Unit
+    from template_utils.execution import rank_doc
     ref_length = 0.3438 * Unit("nm")
     ref_mass = 32.06 * Unit("amu")
     ref_energy = 1.065 * Unit("kJ/mol")
@@ -78,12 +57,13 @@ def get_ref_values(job):
         "mass": ref_mass,
         "energy": ref_energy
     }
-    job.doc.ref_length = ref_length.value
-    job.doc.ref_length_units = "nm"
-    job.doc.ref_energy = ref_energy.value
-    job.doc.ref_energy_units = "kJ/mol"
-    job.doc.ref_mass = ref_mass.value
-    job.doc.ref_mass_units = "amu"
+    doc = rank_doc(job)
+    doc.ref_length = ref_length.value
+    doc.ref_length_units = "nm"
+    doc.ref_energy = ref_energy.value
+    doc.ref_energy_units = "kJ/mol"
+    doc.ref_mass = ref_mass.value
+    doc.ref_mass_units = "amu"
     return ref_values_dict
 
 
@@ -100,23 +80,29 @@ def make_cg_system_bulk(job):
             molecules=chains,
             density=job.sp.density,
             base_units=ref_values,
-            seed=job.sp.system_seed
+            seed=job.sp.system_seed + job.doc.get("build_seed", 0)
     )
+    job.doc.built_seed = job.doc.get("build_seed", 0)
     return system
 
 
 def make_cg_system_lattice(job):
-    """Make an initial lattice of long polymer chains"""
+    """Make an initial lattice of long polymer chains
+
+    The lattice itself is fixed. After a failed run (``job.doc.build_seed``
+    > 0, see template_utils.failures) every chain is shifted along the
+    lattice normal by a random offset to get a different configuration.
+    """
     import math
 
     from flowermd.base import System
     from flowermd.library import PPS
-    from flowermd.utils import get_target_box_mass_density
     import numpy as np
     import mbuild as mb
 
     class Lattice(System):
-        def __init__(self, molecules, base_units=dict()):
+        def __init__(self, molecules, base_units=dict(), seed=None):
+            self.seed = seed
             super(Lattice, self).__init__(
                     molecules=molecules, base_units=base_units
             )
@@ -125,13 +111,17 @@ def make_cg_system_lattice(job):
             n_per = math.ceil(np.sqrt(self.n_molecules))
             system = mb.Compound()
             sep = 4
+            shifts = np.zeros(self.n_molecules)
+            if self.seed is not None:
+                rng = np.random.default_rng(self.seed)
+                shifts = rng.uniform(-sep / 2, sep / 2, self.n_molecules)
             count = 0
             layer_num = 0
             for i in range(self.n_molecules // n_per):
                 layer = mb.Compound()
                 for j in range(n_per):
                     comp = self.all_molecules[count]
-                    comp.translate(np.array([sep * j, 0, 0]))
+                    comp.translate(np.array([sep * j, 0, shifts[count]]))
                     layer.add(comp)
                     count += 1
                 layer.translate(np.array([0, sep * i, 0]))
@@ -141,7 +131,7 @@ def make_cg_system_lattice(job):
             if count != self.n_molecules:
                 last_layer = mb.Compound()
                 for j, comp in enumerate(self.all_molecules[count:]):
-                    comp.translate(np.array([sep * j, 0, 0]))
+                    comp.translate(np.array([sep * j, 0, shifts[count + j]]))
                     last_layer.add(comp)
                 last_layer.translate(np.array([0, sep * layer_num , 0]))
                 system.add(last_layer)
@@ -160,55 +150,102 @@ def make_cg_system_lattice(job):
     chains = PPS(num_mols=job.doc.num_mols, lengths=job.doc.lengths)
     chains.coarse_grain(beads={"A": "c1cc(S)ccc1"})
     ref_values = get_ref_values(job)
-    system = Lattice(molecules=chains, base_units=ref_values)
+    build_seed = job.doc.get("build_seed", 0)
+    system = Lattice(
+            molecules=chains,
+            base_units=ref_values,
+            seed=job.sp.system_seed + build_seed if build_seed else None,
+    )
+    job.doc.built_seed = build_seed
     job.doc.system_mass_g = system.mass.to("g").value
     return system
 
 
 def get_ff(job):
-    """"""
+    """Load the MSIBI force field, with compacted tables if requested.
+
+    With ``job.doc.compact_tables`` the tabulated potentials are resampled
+    and the pair cutoffs trimmed once per MSIBI job, see
+    template_utils.tables.
+    """
+    from template_utils.execution import rank_doc
+    from template_utils.tables import F_TOLERANCE, U_TOLERANCE, cached_forcefield
     msibi_project = signac.get_project(job.sp.msibi_project)
     msibi_job = msibi_project.open_job(id=job.sp.msibi_job)
-    with open(msibi_job.fn("pps-msibi.pickle"), "rb") as f:
-        hoomd_ff = pickle.load(f)
+    if not job.doc.get("compact_tables", False):
+        with open(msibi_job.fn("pps-msibi.pickle"), "rb") as f:
+            hoomd_ff = pickle.load(f)
+        return hoomd_ff
+    hoomd_ff, report = cached_forcefield(
+        msibi_job.fn("pps-msibi.pickle"),
+        signac.get_project().fn("forcefields"),
+        u_tol=job.doc.get("table_u_tolerance", U_TOLERANCE),
+        f_tol=job.doc.get("table_f_tolerance", F_TOLERANCE),
+    )
+    print(f"Compacted force field tables: {report}")
+    rank_doc(job).table_compaction = report
     return hoomd_ff
 
 
+# Stages of the simulation pipeline, see template_utils.priority
+CRITICAL_PATH = (
+    (
+        initial_run_done,
+        lambda job: job.sp.n_shrink_steps + job.sp.n_equil_steps,
+    ),
+    (
+        equilibrated,
+        lambda job: run_longer_rounds_left(job)
+        * job.doc.get("run_longer_steps", 1e7),
+    ),
+    (production_done, lambda job: 2 * job.sp.n_prod_steps),
+)
+
+
 @PPSCG.post(system_built)
 @PPSCG.operation(
     directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"}, name="build"
 )
+@instrumented
 def build(job):
     """Run the initial configuration builder on CPU"""
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        workflow.print_job_id(job)
         print("Building initial frame.")
-        system = make_cg_system_lattice(job)
-        system.to_gsd(job.fn("init_frame.gsd"))
+        with phase("build"):
+            system = make_cg_system_lattice(job)
+        with phase("io"):
+            system.to_gsd(job.fn("init_frame.gsd"))
         print("Finished.")
 
 
 @PPSCG.pre(system_built)
+@PPSCG.pre(retry_allowed("run"))
 @PPSCG.post(initial_run_done)
 @PPSCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"}, name="run"
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(
+            lambda job: job.sp.n_shrink_steps + job.sp.n_equil_steps
+        ),
+    },
+    name="run"
 )
+@instrumented
+@failure_policy
 def run(job):
     """Run initial single-chain simulation."""
-    import unyt
     from unyt import Unit
-    import flowermd
     from flowermd.base import Simulation
     from flowermd.utils import get_target_box_mass_density
     import hoomd
+    from template_utils.writers import set_gsd_dynamic
+    from template_utils.checkpoint import save_checkpoint
+    from template_utils.execution import execution_device, rank_doc
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        doc = rank_doc(job)
+        workflow.print_job_id(job)
 
         hoomd_ff = get_ff(job)
         for force in hoomd_ff:
@@ -229,6 +266,7 @@ def run(job):
 
         sim = Simulation(
             initial_state=job.fn("init_frame.gsd"),
+            device=execution_device(job),
             forcefield=hoomd_ff,
             reference_values=ref_values_dict,
             dt=job.sp.dt,
@@ -238,175 +276,151 @@ def run(job):
             log_file_name=log_path,
             seed=job.sp.sim_seed,
         )
+        set_gsd_dynamic(sim, job)
         sim.pickle_forcefield(job.fn("forcefield.pickle"))
         # Store more unit information in job doc
         tau_kT = job.sp.dt * job.sp.tau_kT
-        job.doc.tau_kT = tau_kT
-        job.doc.real_time_step = sim.real_timestep.to("fs").value
-        job.doc.real_time_units = "fs"
+        doc.tau_kT = tau_kT
+        doc.real_time_step = sim.real_timestep.to("fs").value
+        doc.real_time_units = "fs"
         target_box = get_target_box_mass_density(
                 mass=job.doc.system_mass_g * Unit("g"),
                 density=job.sp.density * Unit("g/cm**3")
         )
-        job.doc.target_box = target_box.value
+        doc.target_box = target_box.value
         shrink_kT_ramp = sim.temperature_ramp(
                 n_steps=job.sp.n_shrink_steps,
                 kT_start=job.sp.shrink_kT,
                 kT_final=job.sp.kT
         )
-        sim.run_update_volume(
-                final_box_lengths=target_box,
-                n_steps=job.sp.n_shrink_steps,
-                period=job.sp.shrink_period,
-                tau_kt=tau_kT,
-                kT=shrink_kT_ramp
-        )
-        sim.save_restart_gsd(job.fn("shrink_restart.gsd"))
+        with phase("shrink", sim):
+            # Reduced by the retry policy, see template_utils.failures.
+            sim.dt = job.sp.dt * job.doc.get("shrink_dt_factor", 1.0)
+            sim.run_update_volume(
+                    final_box_lengths=target_box,
+                    n_steps=job.sp.n_shrink_steps,
+                    period=job.sp.shrink_period,
+                    tau_kt=tau_kT,
+                    kT=shrink_kT_ramp
+            )
+            sim.dt = job.sp.dt
+        with phase("io"):
+            save_checkpoint(sim, job.fn("shrink_restart.gsd"))
         print("Shrinking simulation finished...")
-        sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs = 1
+        with phase("nvt", sim):
+            sim.run_NVT(n_steps=job.sp.n_equil_steps, kT=job.sp.kT, tau_kt=tau_kT)
+        with phase("io"):
+            save_checkpoint(sim, job.fn("restart.gsd"))
+        doc.runs = 1
         print("Simulation finished.")
 
 @PPSCG.pre(initial_run_done)
+@PPSCG.pre(retry_allowed("run_longer"))
 @PPSCG.post(equilibrated)
 @PPSCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(
+            lambda job: job.doc.get("run_longer_steps", 1e7)
+        ),
+    },
     name="run-longer"
 )
+@instrumented
+@failure_policy
 def run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-        gsd_path = job.fn(f"trajectory{job.doc.runs}.gsd")
-        log_path = job.fn(f"log{job.doc.runs}.txt")
-        ref_values = get_ref_values(job)
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="restart.gsd",
+        gsd_file=f"trajectory{job.doc.runs}.gsd",
+        log_file=f"log{job.doc.runs}.txt",
+        n_steps=job.doc.get("run_longer_steps", 1e7),
+        stage="equilibration",
+        counter="runs",
+        seed=job.sp.sim_seed,
+        reference_values=get_ref_values(job),
+    )
+
+
+@PPSCG.pre(initial_run_done)
+@PPSCG.post(nlist_tuned)
+@PPSCG.operation(
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(tuning_steps),
+    },
+    name="tune-nlist"
+)
+@instrumented
+def tune_neighbor_list(job):
+    """Find the fastest neighbor list settings on the current restart.gsd."""
+    workflow.tune_neighbor_list(
+        job,
+        seed=job.sp.sim_seed,
+        reference_values=get_ref_values(job),
+    )
 
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            reference_values=ref_values,
-            dt=job.sp.dt,
-            gsd_write_freq=job.sp.gsd_write_freq,
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=1e7,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs += 1
-        print("Simulation finished.")
 
 @PPSCG.pre(equilibrated)
+@PPSCG.pre(retry_allowed("production_run"))
 @PPSCG.post(production_done)
 @PPSCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production"
 )
+@instrumented
+@failure_policy
 def production_run(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Running the production run...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="production-restart.gsd",
+        gsd_file="production.gsd",
+        log_file="production.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.sp.sim_seed,
+        gsd_write_freq=5e5,
+        reference_values=get_ref_values(job),
+    )
 
-        gsd_path = job.fn(f"production.gsd")
-        log_path = job.fn(f"production.txt")
-        ref_values = get_ref_values(job)
-
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            reference_values=ref_values,
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-        gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        job.doc.production_runs += 1
-        print("Simulation finished.")
-   
 
 @PPSCG.pre(production_done)
+@PPSCG.pre(retry_allowed("production_run_longer"))
 @PPSCG.post(sampled)
 @PPSCG.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production_run_longer"
 )
+@instrumented
+@failure_policy
 def production_run_longer(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Continuing the production run...")
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
+    workflow.continue_nvt(
+        job,
+        restart="production-restart.gsd",
+        output="production-restart.gsd",
+        gsd_file=f"production{job.doc.production_runs+1}.gsd",
+        log_file=f"production{job.doc.production_runs+1}.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.sp.sim_seed,
+        gsd_write_freq=5e5,
+        reference_values=get_ref_values(job),
+    )
 
-        gsd_path = job.fn(f"production{job.doc.production_runs+1}.gsd")
-        log_path = job.fn(f"production{job.doc.production_runs+1}.txt")
-        ref_values = get_ref_values(job)
-
-        sim = Simulation(
-            initial_state=job.fn("production-restart.gsd"),
-            forcefield=hoomd_ff,
-            reference_values=ref_values,
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-        gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        print("Simulation finished.")
-        job.doc.production_runs += 1
 
 @PPSCG.pre(production_done)
 @PPSCG.post(sampled)
@@ -414,14 +428,12 @@ def production_run_longer(job):
     directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
     name="sample"
 )
+@instrumented
 def sample(job):
     import numpy as np
     from cmeutils.dynamics import msd_from_gsd
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        workflow.print_job_id(job)
         steps_per_frame = int(5e5)
         # Update job doc
         ts = job.doc.real_time_step * 1e-15
@@ -445,6 +457,53 @@ def sample(job):
         
         print("Finished.")
         job.doc.sampled = True
-        
+
+
+@PPSCG.pre(sampled)
+@PPSCG.post(archived)
+@PPSCG.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="archive"
+)
+@instrumented
+def archive(job):
+    """Replace finished trajectory segments with verified slim archives."""
+    from template_utils.archive import chain_center_indices, archive_job
+    from template_utils.trajectory import find_segments
+    with job:
+        workflow.print_job_id(job)
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="equilibration"),
+            frames="log",
+            n_frames=100,
+            indices=chain_center_indices(job.doc.num_mols, job.doc.lengths),
+        )
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="production"),
+            frames="stride",
+            stride=job.doc.get("archive_stride", 1),
+            indices=chain_center_indices(job.doc.num_mols, job.doc.lengths),
+        )
+        print("Finished.")
+
+
+@PPSCG.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="collect-results",
+    aggregator=aggregator()
+)
+def collect(*jobs):
+    """Update the project-wide results table in results.npz."""
+    from template_utils.results import RESULTS_FILE, collect_results
+    n_read = collect_results(jobs, signac.get_project().fn(RESULTS_FILE))
+    print(f"Read {n_read} of {len(jobs)} jobs into {RESULTS_FILE}.")
+
+
 if __name__ == "__main__":
-    PPSCG(environment=Fry).main()
+    if sys.argv[1:2] == ["worker"]:
+        from template_utils import worker
+        worker.main(PPSCG.get_project(), CRITICAL_PATH, sys.argv[2:])
+    else:
+        PPSCG(environment=Fry).main()
@@ -6,91 +6,100 @@ status, execute operations and submit them to a cluster. See also:
     $ python src/project.py --help
 """
 import signac
-import pickle
-from flow import FlowProject, directives
-from flow.environment import DefaultSlurmEnvironment
+from flow import FlowProject, aggregator
 import os
-from unyt import Unit
+import sys
 
-class Ellipsoids(FlowProject):
-    pass
+# Shared helpers (template_utils) live in the repository root.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from template_utils.execution import execution_directives
+from template_utils.failures import failure_policy, retry_allowed
+from template_utils.priority import ordered_submit
+from template_utils.telemetry import instrumented, phase
+from template_utils.walltime import predicted_walltime
+from template_utils import workflow
 
 
-class Borah(DefaultSlurmEnvironment):
-    hostname_pattern = "borah"
-    template = "borah.sh"
+class Borah(workflow.Borah):
+    default_partition = "gpu-v100"
+
+
+class Ellipsoids(FlowProject):
+    def submit(self, jobs=None, **kwargs):
+        """Submit the jobs with the longest remaining critical path first."""
+        return ordered_submit(self, CRITICAL_PATH, jobs=jobs, **kwargs)
 
-    @classmethod
-    def add_args(cls, parser):
-        parser.add_argument(
-            "--partition",
-            default="gpu-v100",
-            help="Specify the partition to submit to."
-        )
 
 @Ellipsoids.label
 def system_built(job):
     return job.isfile("shrink_restart.gsd")
 
 
-@Ellipsoids.label
-def initial_run_done(job):
-    return job.doc.runs > 0
+initial_run_done = Ellipsoids.label(workflow.initial_run_done)
+equilibrated = Ellipsoids.label(workflow.equilibrated)
+production_done = Ellipsoids.label(workflow.production_done)
+archived = Ellipsoids.label(workflow.archived)
 
 
 @Ellipsoids.label
-def equilibrated(job):
-    return job.doc.equilibrated
+def overlays_written(job):
+    from template_utils.ellipsoid import missing_overlays
+    return job.isfile("restart.gsd") and not missing_overlays(job)
 
-@Ellipsoids.label
-def production_done(job):
-    return job.isfile("production-restart.gsd")
+# Stages of the simulation pipeline, see template_utils.priority
+CRITICAL_PATH = (
+    (system_built, lambda job: job.sp.n_shrink_steps),
+    (initial_run_done, lambda job: job.sp.n_equil_steps),
+    (production_done, lambda job: 2 * job.sp.n_prod_steps),
+)
 
-@Ellipsoids.label
-def restart_rigid_ellipsoid(): #this function needs to updated to be more extensible
-    local_coords = [(0.0, 0.0, 0.0), (1.049999999999999, 0.0, 0.0), (1.0, 0.0, 0.0), (-1.0000000000000009, 0.0, 0.0)]
-    rigid_constrain = hoomd.md.constrain.Rigid()
-    rigid_constrain.body["R"] = {
-        "constituent_types": ["X", "A", "T", "T"],
-        "positions": local_coords,
-        "orientations": [[1, 0, 0, 0]] * len(local_coords),
-    }
-    return rigid_constrain
 
+@Ellipsoids.pre(retry_allowed("build"))
 @Ellipsoids.post(system_built)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"}, name="build"
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: job.sp.n_shrink_steps),
+    },
+    name="build"
 )
+@instrumented
+@failure_policy
 def build(job):
     """Build ellipsoid system and run shrink simulation."""
-    import unyt
     from unyt import Unit
-    import flowermd
     from flowermd.base import Simulation,Pack
     from flowermd.library import EllipsoidForcefield, EllipsoidChain
     from flowermd.utils import get_target_box_number_density
     from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    import hoomd
+    from template_utils.ellipsoid import store_rigid_bodies
+    from template_utils.writers import set_gsd_dynamic
+    from template_utils.checkpoint import save_checkpoint
+    from template_utils.execution import execution_device, rank_doc
     with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
+        doc = rank_doc(job)
+        workflow.print_job_id(job)
         print("Building initial frame.")
-        job.doc.n_particles = int(job.sp.N * job.sp.length)
+        doc.n_particles = int(job.sp.N * job.sp.length)
         ellipsoid_chain = EllipsoidChain(num_mols=job.sp.N,
                                          lengths=job.sp.length,
                                          lpar=job.sp.lpar,
                                          bead_mass=job.sp.bead_mass
                                         )
-        system = Pack(molecules=ellipsoid_chain,
-                      density=job.sp.density*Unit("nm**-3"), 
-                      packing_expand_factor=job.sp.packing_expand_factor,
-                      edge=job.sp.edge,
-                      overlap=job.sp.overlap,
-                      fix_orientation=job.sp.fix_orientation,
-                     )
-        system.to_gsd(job.fn("init_frame.gsd"))
+        with phase("build"):
+            system = Pack(molecules=ellipsoid_chain,
+                          density=job.sp.density*Unit("nm**-3"), 
+                          packing_expand_factor=job.sp.packing_expand_factor,
+                          edge=job.sp.edge,
+                          overlap=job.sp.overlap,
+                          fix_orientation=job.sp.fix_orientation,
+                          # Incremented after failures, see
+                          # template_utils.failures.
+                          seed=12345 + job.doc.get("build_seed", 0),
+                         )
+        with phase("io"):
+            system.to_gsd(job.fn("init_frame.gsd"))
         print("Finished.")
 
         # Set up Simulation obj
@@ -105,9 +114,11 @@ def build(job):
                                  bond_r0=job.sp.bond_r0
                                 )
         rigid_frame, rigid = create_rigid_ellipsoid_chain(system.hoomd_snapshot)
-        
+        store_rigid_bodies(job, rigid)
+
         sim = Simulation(
-            initial_state=job.fn("init_frame.gsd"),
+            initial_state=rigid_frame,
+            device=execution_device(job),
             forcefield=ff.hoomd_forces,
             constraint=rigid,
             dt=job.sp.dt,
@@ -117,125 +128,168 @@ def build(job):
             log_file_name=log_path,
             seed=job.sp.sim_seed,
         )
+        set_gsd_dynamic(sim, job)
         sim.pickle_forcefield(job.fn("forcefield.pickle"))
         # Store more unit information in job doc
         tau_kT = job.sp.dt * job.sp.tau_kT
-        job.doc.tau_kT = tau_kT
-        job.doc.real_time_step = sim.real_timestep.to("fs").value
-        job.doc.real_time_units = "fs"
+        doc.tau_kT = tau_kT
+        doc.real_time_step = sim.real_timestep.to("fs").value
+        doc.real_time_units = "fs"
         target_box = get_target_box_number_density(density=job.sp.density*Unit("nm**-3"),n_beads=job.sp.N * 
                                                    job.sp.length)
-        job.doc.target_box = target_box.value
+        doc.target_box = target_box.value
         shrink_kT_ramp = sim.temperature_ramp(
                 n_steps=job.sp.n_shrink_steps,
                 kT_start=job.sp.shrink_kT,
                 kT_final=job.sp.kT
         )
-        sim.run_update_volume(
-                final_box_lengths=target_box,
-                n_steps=job.sp.n_shrink_steps,
-                period=job.sp.shrink_period,
-                tau_kt=tau_kT,
-                kT=shrink_kT_ramp
-        )
-        sim.save_restart_gsd(job.fn("shrink_restart.gsd"))
+        with phase("shrink", sim):
+            # Reduced by the retry policy, see template_utils.failures.
+            sim.dt = job.sp.dt * job.doc.get("shrink_dt_factor", 1.0)
+            sim.run_update_volume(
+                    final_box_lengths=target_box,
+                    n_steps=job.sp.n_shrink_steps,
+                    period=job.sp.shrink_period,
+                    tau_kt=tau_kT,
+                    kT=shrink_kT_ramp
+            )
+            sim.dt = job.sp.dt
+        with phase("io"):
+            save_checkpoint(sim, job.fn("shrink_restart.gsd"))
         print("Shrinking simulation finished...")
 
 @Ellipsoids.pre(system_built)
+@Ellipsoids.pre(retry_allowed("run"))
 @Ellipsoids.post(initial_run_done)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: job.sp.n_equil_steps),
+    },
     name="run"
 )
+@instrumented
+@failure_policy
 def run(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    import gsd.hoomd
-    from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        system = gsd.hoomd.open(job.fn("restart.gsd"),'r')
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-        gsd_path = job.fn(f"trajectory{job.doc.runs}.gsd")
-        log_path = job.fn(f"log{job.doc.runs}.txt")
+    workflow.continue_nvt(
+        job,
+        restart="shrink_restart.gsd",
+        output="restart.gsd",
+        gsd_file=f"trajectory{job.doc.runs}.gsd",
+        log_file=f"log{job.doc.runs}.txt",
+        n_steps=job.sp.n_equil_steps,
+        stage="equilibration",
+        counter="runs",
+        seed=job.sp.sim_seed,
+        rigid=True,
+    )
 
-        sim = Simulation(
-            initial_state=job.fn("shrink_restart.gsd"),
-            forcefield=hoomd_ff,
-            constraint=restart_rigid_ellipsoid(),
-            dt=job.sp.dt,
-            gsd_write_freq=job.sp.gsd_write_freq,
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
-        )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_equil_steps,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
-        )
-        sim.save_restart_gsd(job.fn("restart.gsd"))
-        job.doc.runs += 1
-        print("Simulation finished.")
 
 @Ellipsoids.pre(equilibrated)
+@Ellipsoids.pre(retry_allowed("production_run"))
 @Ellipsoids.post(production_done)
 @Ellipsoids.operation(
-    directives={"ngpu": 1, "ncpu": 1, "executable": "python -u"},
+    directives={
+        **execution_directives(),
+        "executable": "python -u",
+        "walltime": predicted_walltime(lambda job: 2 * job.sp.n_prod_steps),
+    },
     name="production"
 )
+@instrumented
+@failure_policy
 def production_run(job):
-    import unyt
-    from unyt import Unit
-    import flowermd
-    from flowermd.base import Simulation
-    import hoomd
-    import gsd.hoomd
-    from flowermd.utils.constraints import create_rigid_ellipsoid_chain
-    with job:
-        print("------------------------------------")
-        print("JOB ID NUMBER:")
-        print(job.id)
-        print("------------------------------------")
-        print("Restarting and continuing simulation...")
-        print("Running the production run...")
-        system = gsd.hoomd.open(job.fn("restart.gsd"),'r')
-        with open(job.fn("forcefield.pickle"), "rb") as f:
-            hoomd_ff = pickle.load(f)
-
-        gsd_path = job.fn(f"production.gsd")
-        log_path = job.fn(f"production.txt")
+    workflow.continue_nvt(
+        job,
+        restart="restart.gsd",
+        output="production-restart.gsd",
+        gsd_file="production.gsd",
+        log_file="production.txt",
+        n_steps=job.sp.n_prod_steps*2,
+        stage="production",
+        counter="production_runs",
+        seed=job.sp.sim_seed,
+        gsd_write_freq=5e5,
+        rigid=True,
+    )
 
-        sim = Simulation(
-            initial_state=job.fn("restart.gsd"),
-            forcefield=hoomd_ff,
-            constraint=restart_rigid_ellipsoid(),
-            dt=job.sp.dt,
-            gsd_write_freq=int(5e5),
-            gsd_file_name=gsd_path,
-            log_write_freq=job.sp.log_write_freq,
-            log_file_name=log_path,
-            seed=job.sp.sim_seed,
+
+@Ellipsoids.pre(production_done)
+@Ellipsoids.post(archived)
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="archive"
+)
+@instrumented
+def archive(job):
+    """Replace finished trajectory segments with verified slim archives."""
+    from template_utils.archive import archive_job
+    from template_utils.trajectory import find_segments
+    with job:
+        workflow.print_job_id(job)
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="equilibration"),
+            frames="log",
+            n_frames=100,
+            types=["R"],
+            keep_orientation=True,
         )
-        print("Running simulation.")
-        sim.run_NVT(
-            n_steps=job.sp.n_prod_steps*2,
-            kT=job.sp.kT,
-            tau_kt=job.doc.tau_kT,
+        archive_job(
+            job,
+            find_segments(job.fn(""), stage="production"),
+            frames="stride",
+            stride=job.doc.get("archive_stride", 1),
+            types=["R"],
+            keep_orientation=True,
         )
-        sim.save_restart_gsd(job.fn("production-restart.gsd"))
-        job.doc.production_runs += 1
-        print("Simulation finished.")
+        print("Finished.")
+
+
+@Ellipsoids.pre(initial_run_done)
+@Ellipsoids.post(overlays_written)
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="shape-overlay"
+)
+@instrumented
+def shape_overlay(job):
+    """Write small OVITO overlays of the rigid centers with ellipsoid shapes."""
+    from template_utils.ellipsoid import (
+        missing_overlays,
+        overlay_name,
+        write_shape_overlay,
+    )
+    with job:
+        workflow.print_job_id(job)
+        for segment in missing_overlays(job):
+            print(f"Writing shape overlay for {segment}...")
+            write_shape_overlay(
+                gsd_file=segment,
+                new_file=overlay_name(segment),
+                lpar=job.sp.lpar,
+                lperp=job.sp.lper,
+                stride=job.doc.get("overlay_stride", 1),
+            )
+        print("Finished.")
+
+
+@Ellipsoids.operation(
+    directives={"ngpu": 0, "ncpu": 1, "executable": "python -u"},
+    name="collect-results",
+    aggregator=aggregator()
+)
+def collect(*jobs):
+    """Update the project-wide results table in results.npz."""
+    from template_utils.results import RESULTS_FILE, collect_results
+    n_read = collect_results(jobs, signac.get_project().fn(RESULTS_FILE))
+    print(f"Read {n_read} of {len(jobs)} jobs into {RESULTS_FILE}.")
+
 
 if __name__ == "__main__":
-    Ellipsoids(environment=Borah).main()
+    if sys.argv[1:2] == ["worker"]:
+        from template_utils import worker
+        worker.main(Ellipsoids.get_project(), CRITICAL_PATH, sys.argv[2:])
+    else:
+        Ellipsoids(environment=Borah).main()
@@ -1,14 +1,21 @@
 {% extends "base_script.sh" %}
 {% block header %}
 {% set gpus = operations|map(attribute='directives.ngpu')|sum %}
-{% set gpus = operations|map(attribute='directives.ncpu')|sum %}
+{% set cpus = operations|map(attribute='directives.ncpu')|sum %}
+{# MPI ranks, execution_directives sets np > 1 for the CPU profile #}
+{% set np = operations|map(attribute='directives.np')|sum %}
+{# CPU profile bundles (no GPUs) only go to the CPU partition #}
+{% if not gpus and partition == "v100,batch" %}
+{% set partition = "batch" %}
+{% endif %}
+{% set walltime = operations|calc_walltime(parallel) %}
 #!/bin/bash
 #SBATCH --job-name="{{ id }}"
 {% if partition %}
 #SBATCH --partition={{ partition }}
 {% endif %}
 {% if walltime %}
-#SBATCH -t {{ 48|format_timedelta }}
+#SBATCH -t {{ walltime|format_timedelta }}
 {% endif %}
 {% if gpus %}
 #SBATCH --gres gpu:{{ gpus }}
@@ -18,6 +25,9 @@
 #SBATCH --error={{ job_output }}
 {% endif %}
 {% block tasks %}
-#SBATCH --ntasks={{ np_global }}
+#SBATCH --ntasks={{ np }}
+{% if cpus > np %}
+#SBATCH --cpus-per-task={{ (cpus / np)|round(method='ceil')|int }}
+{% endif %}
 {% endblock %}
 {% endblock %}
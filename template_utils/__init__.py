@@ -0,0 +1,7 @@
+"""Helpers shared by the signac templates in this repository.
+
+The templates (``pps``, ``kremer-grest``, ``ellipsoids`` and
+``single-ellipsoid``) add the repository root to ``sys.path`` so these
+modules can be imported from their ``project.py`` files. Heavy dependencies
+(numpy, gsd, hoomd, ...) are imported inside the functions that need them.
+"""
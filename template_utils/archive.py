@@ -0,0 +1,217 @@
+"""Rewrite finished trajectory segments into slim archives.
+
+An archive keeps only a subset of the particles and frames of a segment:
+positions, type ids, image flags and, optionally, orientations. GSD stores
+positions as float32 either way, so they are copied unchanged. No
+velocities or topology are written. Frames are streamed one
+at a time, so memory use does not depend on the length of the segment.
+The newest segment of each stage is left alone, so that a segment is never
+archived while it is still being written. The templates keep every
+``job.doc.archive_stride``-th production frame (default 1).
+"""
+import os
+
+from template_utils.trajectory import ARCHIVE_PREFIX, find_segments
+
+ARCHIVED_STAGES = ("equilibration", "production")
+
+
+def select_frames(n_frames, mode="log", n_select=100, stride=1):
+    """Indices of the frames kept from a segment with ``n_frames`` frames.
+
+    ``mode="log"`` keeps up to ``n_select`` log-spaced frames (always
+    including the first and last), ``mode="stride"`` keeps every
+    ``stride``-th frame.
+    """
+    import numpy as np
+
+    if n_frames == 0:
+        return np.array([], dtype=int)
+    if mode == "log":
+        indices = np.geomspace(1, n_frames, num=min(n_select, n_frames))
+        return np.unique(np.round(indices).astype(int) - 1)
+    elif mode == "stride":
+        return np.arange(0, n_frames, stride)
+    raise ValueError(f"Unknown frame selection mode {mode}.")
+
+
+def chain_center_indices(num_mols, lengths):
+    """Index of the middle bead of each chain in a linear polymer system."""
+    import numpy as np
+
+    return np.arange(num_mols) * lengths + lengths // 2
+
+
+def _particle_selection(frame, types=None, indices=None):
+    import numpy as np
+
+    if indices is not None:
+        return np.asarray(indices, dtype=int)
+    if types is not None:
+        type_ids = [frame.particles.types.index(t) for t in types]
+        return np.flatnonzero(np.isin(frame.particles.typeid, type_ids))
+    return np.arange(frame.particles.N)
+
+
+def _slim_frame(frame, selection, keep_orientation):
+    import gsd.hoomd
+
+    slim = gsd.hoomd.Frame()
+    slim.configuration.step = frame.configuration.step
+    slim.configuration.box = frame.configuration.box
+    slim.particles.N = len(selection)
+    slim.particles.types = frame.particles.types
+    slim.particles.typeid = frame.particles.typeid[selection]
+    slim.particles.position = frame.particles.position[selection]
+    slim.particles.image = frame.particles.image[selection]
+    if keep_orientation:
+        slim.particles.orientation = frame.particles.orientation[selection]
+    return slim
+
+
+def archive_segment(
+    filename,
+    archive_name,
+    frames="log",
+    n_frames=100,
+    stride=1,
+    types=None,
+    indices=None,
+    keep_orientation=False,
+):
+    """Write a slim copy of ``filename`` to ``archive_name``.
+
+    Returns the frame and particle indices that were kept, which are needed
+    by ``verify_archive``.
+    """
+    import gsd.hoomd
+
+    with gsd.hoomd.open(filename, mode="r") as traj:
+        frame_indices = select_frames(
+            len(traj), mode=frames, n_select=n_frames, stride=stride
+        )
+        if len(frame_indices) == 0:
+            selection = []
+        else:
+            selection = _particle_selection(traj[0], types, indices)
+        with gsd.hoomd.open(archive_name, mode="w") as archive:
+            for index in frame_indices:
+                archive.append(
+                    _slim_frame(traj[int(index)], selection, keep_orientation)
+                )
+    return frame_indices, selection
+
+
+def verify_archive(
+    filename,
+    archive_name,
+    frame_indices,
+    selection,
+    keep_orientation=False,
+):
+    """Check an archive against the segment it was written from.
+
+    Raises a ``RuntimeError`` describing the first mismatch.
+    """
+    import gsd.hoomd
+    import numpy as np
+
+    with gsd.hoomd.open(filename, mode="r") as traj, gsd.hoomd.open(
+        archive_name, mode="r"
+    ) as archive:
+        if len(archive) != len(frame_indices):
+            raise RuntimeError(
+                f"{archive_name} has {len(archive)} frames, "
+                f"expected {len(frame_indices)}."
+            )
+        for slim, index in zip(archive, frame_indices):
+            frame = traj[int(index)]
+            if slim.configuration.step != frame.configuration.step:
+                raise RuntimeError(
+                    f"Step mismatch in {archive_name} at frame {index}."
+                )
+            if not np.allclose(slim.configuration.box, frame.configuration.box):
+                raise RuntimeError(
+                    f"Box mismatch in {archive_name} at frame {index}."
+                )
+            if not np.array_equal(
+                slim.particles.typeid, frame.particles.typeid[selection]
+            ):
+                raise RuntimeError(
+                    f"Type mismatch in {archive_name} at frame {index}."
+                )
+            if not np.array_equal(
+                slim.particles.position, frame.particles.position[selection]
+            ):
+                raise RuntimeError(
+                    f"Position mismatch in {archive_name} at frame {index}."
+                )
+            if not np.array_equal(
+                slim.particles.image, frame.particles.image[selection]
+            ):
+                raise RuntimeError(
+                    f"Image mismatch in {archive_name} at frame {index}."
+                )
+            if keep_orientation and not np.allclose(
+                slim.particles.orientation,
+                frame.particles.orientation[selection],
+            ):
+                raise RuntimeError(
+                    f"Orientation mismatch in {archive_name} at frame {index}."
+                )
+
+
+def pending_segments(job, segments):
+    """The ``segments`` of a job that are not archived yet.
+
+    ``segments`` are in run order, as returned by ``find_segments``. The
+    newest one is never included, a continuation operation may still be
+    writing to it.
+    """
+    archives = job.doc.get("archives", {})
+    return [s for s in segments[:-1] if os.path.basename(s) not in archives]
+
+
+def unarchived(job):
+    """Whether any segment of ``job`` is waiting to be archived."""
+    return any(
+        pending_segments(job, find_segments(job.fn(""), stage=stage))
+        for stage in ARCHIVED_STAGES
+    )
+
+
+def archive_job(job, segments, delete=True, **kwargs):
+    """Archive ``segments`` of a job and record the result in the job doc.
+
+    Only the ``pending_segments`` are archived. Each original is only
+    deleted after its archive has been verified. Remaining keyword
+    arguments are passed to ``archive_segment``.
+    """
+    archives = dict(job.doc.get("archives", {}))
+    keep_orientation = kwargs.get("keep_orientation", False)
+    for filename in pending_segments(job, segments):
+        name = os.path.basename(filename)
+        archive_name = os.path.join(
+            os.path.dirname(filename), f"{ARCHIVE_PREFIX}{name}"
+        )
+        print(f"Archiving {name}...")
+        frame_indices, selection = archive_segment(
+            filename, archive_name, **kwargs
+        )
+        verify_archive(
+            filename,
+            archive_name,
+            frame_indices,
+            selection,
+            keep_orientation=keep_orientation,
+        )
+        archives[name] = dict(
+            n_frames=len(frame_indices),
+            n_particles=len(selection),
+            original_bytes=os.path.getsize(filename),
+            archive_bytes=os.path.getsize(archive_name),
+        )
+        if delete:
+            os.remove(filename)
+        job.doc.archives = archives
+    job.doc.archived = True
@@ -0,0 +1,121 @@
+"""Continuation checkpoints that keep the full precision and thermostat state.
+
+``Simulation.save_restart_gsd`` writes a single precision GSD frame, so a
+continuation starts from rounded positions and velocities and with a fresh
+thermostat. ``save_checkpoint`` writes the restart file together with a
+``<name>-checkpoint.npz`` holding the double precision particle state, the
+box, the seed and the state of the MTTK thermostat. A continuation restored
+with ``restore_checkpoint`` and run with ``run_nvt`` picks up from that state
+instead of re-equilibrating the thermostat::
+
+    sim = Simulation(initial_state=job.fn("restart.gsd"), ...)
+    checkpoint = restore_checkpoint(sim, job.fn("restart.gsd"))
+    run_nvt(sim, checkpoint, n_steps=n_steps, kT=kT, tau_kt=tau_kt)
+    save_checkpoint(sim, job.fn("restart.gsd"))
+
+A long run can then be split across several short continuations that are
+statistically equivalent to one uninterrupted run. They are not bit-identical
+to it: the neighbor list is rebuilt and the particles are sorted anew after a
+restore, which changes the order of floating point sums, so trajectories
+diverge after a while.
+"""
+import os
+
+CHECKPOINT_SUFFIX = "-checkpoint.npz"
+PARTICLE_FIELDS = ("position", "velocity", "orientation", "angmom", "image")
+THERMOSTAT_FIELDS = ("translational_dof", "rotational_dof")
+
+
+def checkpoint_name(restart_file):
+    """Checkpoint file that belongs to ``restart_file``."""
+    return os.path.splitext(restart_file)[0] + CHECKPOINT_SUFFIX
+
+
+def _thermostat(sim):
+    methods = sim.operations.integrator.methods
+    if not methods:
+        return None
+    return getattr(methods[0], "thermostat", None)
+
+
+def save_checkpoint(sim, restart_file):
+    """Write ``restart_file`` and the full continuation state next to it."""
+    import numpy as np
+
+    sim.save_restart_gsd(restart_file)
+    snapshot = sim.state.get_snapshot()
+    if snapshot.communicator.rank != 0:
+        return
+    state = {
+        field: np.array(getattr(snapshot.particles, field))
+        for field in PARTICLE_FIELDS
+    }
+    state["box"] = np.array(snapshot.configuration.box, dtype=np.float64)
+    state["timestep"] = np.array(sim.timestep, dtype=np.uint64)
+    state["seed"] = np.array(sim.seed)
+    thermostat = _thermostat(sim)
+    for field in THERMOSTAT_FIELDS:
+        if thermostat is not None and hasattr(thermostat, field):
+            state[field] = np.array(getattr(thermostat, field))
+    write_checkpoint(restart_file, state)
+
+
+def write_checkpoint(restart_file, state):
+    """Write the checkpoint arrays ``state`` that belong to ``restart_file``."""
+    import numpy as np
+
+    filename = checkpoint_name(restart_file)
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **state)
+    os.replace(filename + ".tmp", filename)
+
+
+def load_checkpoint(restart_file):
+    """The checkpoint of ``restart_file`` as a dict, ``None`` if missing."""
+    import numpy as np
+
+    filename = checkpoint_name(restart_file)
+    if not os.path.isfile(filename):
+        return None
+    with np.load(filename) as f:
+        return {key: f[key] for key in f.files}
+
+
+def restore_checkpoint(sim, restart_file):
+    """Restore the particle, box and seed state saved with ``restart_file``.
+
+    ``sim`` must have been created from ``restart_file``. Returns the
+    checkpoint to pass on to ``run_nvt``, or ``None`` if ``restart_file``
+    was written without one, in which case ``sim`` is left as it is.
+    """
+    checkpoint = load_checkpoint(restart_file)
+    if checkpoint is None:
+        return None
+    if int(checkpoint["timestep"]) != sim.timestep:
+        raise RuntimeError(
+            f"{checkpoint_name(restart_file)} was saved at step "
+            f"{int(checkpoint['timestep'])}, but the simulation starts at "
+            f"step {sim.timestep}."
+        )
+    snapshot = sim.state.get_snapshot()
+    if snapshot.communicator.rank == 0:
+        snapshot.configuration.box = checkpoint["box"]
+        for field in PARTICLE_FIELDS:
+            getattr(snapshot.particles, field)[:] = checkpoint[field]
+    sim.state.set_snapshot(snapshot)
+    sim.seed = int(checkpoint["seed"])
+    return checkpoint
+
+
+def run_nvt(sim, checkpoint, n_steps, kT, tau_kt):
+    """``sim.run_NVT`` continuing the thermostat state of ``checkpoint``."""
+    if checkpoint is None:
+        sim.run_NVT(n_steps=n_steps, kT=kT, tau_kt=tau_kt)
+        return
+    # Attach the NVT method without running, then restore its thermostat.
+    sim.run_NVT(n_steps=0, kT=kT, tau_kt=tau_kt)
+    thermostat = _thermostat(sim)
+    for field in THERMOSTAT_FIELDS:
+        if field in checkpoint and hasattr(thermostat, field):
+            setattr(thermostat, field, tuple(checkpoint[field].tolist()))
+    sim.run(int(n_steps))
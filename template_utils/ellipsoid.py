@@ -0,0 +1,225 @@
+"""Helpers specific to the rigid ellipsoid chain templates."""
+import os
+
+from template_utils.trajectory import find_segments
+
+OVERLAY_SUFFIX = "-ovito.gsd"
+RIGID_BODY_KEYS = ("constituent_types", "positions", "orientations")
+
+
+def overlay_name(filename):
+    """Name of the shape overlay written for a trajectory segment."""
+    return f"{os.path.splitext(filename)[0]}{OVERLAY_SUFFIX}"
+
+
+def write_shape_overlay(
+    gsd_file, new_file, lpar, lperp, stride=1, center_type="R"
+):
+    """Write the rigid body centers of ``gsd_file`` with ellipsoid shapes.
+
+    Replaces ``cmeutils.gsd_utils.ellipsoid_gsd`` for visualization in OVITO.
+    Only the ``center_type`` particles are written (position, orientation and
+    image) and the type and shape information is stored in the first frame
+    only. Frames are streamed one at a time, every ``stride``-th frame is
+    kept.
+    """
+    import gsd.hoomd
+    import numpy as np
+
+    with gsd.hoomd.open(gsd_file, mode="r") as traj, gsd.hoomd.open(
+        new_file, mode="w"
+    ) as overlay:
+        centers = None
+        for index in range(0, len(traj), stride):
+            frame = traj[index]
+            if centers is None:
+                type_id = frame.particles.types.index(center_type)
+                centers = np.flatnonzero(frame.particles.typeid == type_id)
+            slim = gsd.hoomd.Frame()
+            slim.configuration.step = frame.configuration.step
+            slim.configuration.box = frame.configuration.box
+            slim.particles.N = len(centers)
+            slim.particles.position = frame.particles.position[centers]
+            slim.particles.orientation = frame.particles.orientation[centers]
+            slim.particles.image = frame.particles.image[centers]
+            if index == 0:
+                slim.particles.types = [center_type]
+                slim.particles.type_shapes = [
+                    {"type": "Ellipsoid", "a": lpar, "b": lperp, "c": lperp}
+                ]
+            overlay.append(slim)
+
+
+def missing_overlays(job):
+    """Trajectory segments of a job without an up to date shape overlay."""
+    segments = find_segments(job.fn(""), stage="equilibration")
+    segments += find_segments(job.fn(""), stage="production")
+    return [
+        segment
+        for segment in segments
+        if not os.path.isfile(overlay_name(segment))
+        or os.path.getmtime(overlay_name(segment))
+        < os.path.getmtime(segment)
+    ]
+
+
+def body_definitions(rigid):
+    """Body definitions of a ``hoomd.md.constrain.Rigid`` as plain lists.
+
+    Only the local constituent types, positions and orientations of each
+    body type are kept, independent of the system size.
+    """
+    import numpy as np
+
+    bodies = dict()
+    for body_type in rigid.body.keys():
+        body = rigid.body[body_type]
+        if body is None:
+            continue
+        bodies[body_type] = {
+            key: np.asarray(body[key]).tolist()
+            if key != "constituent_types"
+            else list(body[key])
+            for key in RIGID_BODY_KEYS
+        }
+    return bodies
+
+
+def store_rigid_bodies(job, rigid):
+    """Store the body definitions of a ``hoomd.md.constrain.Rigid``.
+
+    Call once when the rigid system is created, e.g. with the constraint
+    returned by ``create_rigid_ellipsoid_chain``. The definitions (see
+    ``body_definitions``) are kept in ``job.doc.rigid_bodies``.
+    """
+    from template_utils.execution import rank_doc
+
+    bodies = body_definitions(rigid)
+    rank_doc(job).rigid_bodies = bodies
+    return bodies
+
+
+def _quaternion_conjugate(q):
+    return q * [1, -1, -1, -1]
+
+
+def _quaternion_product(a, b):
+    import numpy as np
+
+    a0, av = a[..., :1], a[..., 1:]
+    b0, bv = b[..., :1], b[..., 1:]
+    scalar = a0 * b0 - np.sum(av * bv, axis=-1, keepdims=True)
+    vector = a0 * bv + b0 * av + np.cross(av, bv)
+    return np.concatenate([scalar, vector], axis=-1)
+
+
+def rigid_bodies_from_frame(frame):
+    """Body definitions of the rigid bodies in a GSD frame.
+
+    Each body type is read from its first body only, by rotating its
+    constituents into the frame of the center particle. Used for jobs built
+    before the definitions were stored in the job document.
+    """
+    import numpy as np
+
+    particles = frame.particles
+    body = particles.body
+    tags = np.arange(particles.N)
+    box = np.asarray(frame.configuration.box[:3], dtype=np.float64)
+    bodies = dict()
+    for center in np.flatnonzero(body == tags):
+        body_type = particles.types[particles.typeid[center]]
+        if body_type in bodies:
+            continue
+        members = np.flatnonzero((body == center) & (tags != center))
+        delta = (
+            particles.position[members] - particles.position[center]
+        ).astype(np.float64)
+        delta -= box * np.round(delta / box)
+        q_inv = _quaternion_conjugate(
+            np.asarray(particles.orientation[center], dtype=np.float64)
+        )
+        pure = np.concatenate([np.zeros((len(delta), 1)), delta], axis=1)
+        local = _quaternion_product(
+            _quaternion_product(q_inv, pure), _quaternion_conjugate(q_inv)
+        )[:, 1:]
+        orientations = _quaternion_product(
+            q_inv, np.asarray(particles.orientation[members], np.float64)
+        )
+        bodies[body_type] = {
+            "constituent_types": [
+                particles.types[i] for i in particles.typeid[members]
+            ],
+            "positions": local.tolist(),
+            "orientations": orientations.tolist(),
+        }
+    return bodies
+
+
+def rigid_constraint(job, restart_file=None):
+    """``hoomd.md.constrain.Rigid`` for restarting a rigid job.
+
+    The body definitions come from ``job.doc.rigid_bodies``. For older jobs
+    without them they are read once from the last frame of
+    ``restart_file`` and stored.
+    """
+    import hoomd
+
+    from template_utils.execution import rank_doc
+
+    if "rigid_bodies" in job.doc:
+        bodies = job.doc.rigid_bodies
+    else:
+        import gsd.hoomd
+
+        with gsd.hoomd.open(restart_file, mode="r") as traj:
+            bodies = rigid_bodies_from_frame(traj[-1])
+        rank_doc(job).rigid_bodies = bodies
+    rigid = hoomd.md.constrain.Rigid()
+    for body_type, body in bodies.items():
+        rigid.body[body_type] = {
+            "constituent_types": list(body["constituent_types"]),
+            "positions": [tuple(p) for p in body["positions"]],
+            "orientations": [tuple(q) for q in body["orientations"]],
+        }
+    return rigid
+
+
+def rigid_violation(snapshot, bodies):
+    """Largest distance of a constituent from its place in the body.
+
+    The place of each constituent is the position of its body's center plus
+    the local position of ``bodies`` (see ``body_definitions``) rotated by
+    the center's orientation, the inverse of ``rigid_bodies_from_frame``.
+    """
+    import numpy as np
+
+    particles = snapshot.particles
+    body = np.asarray(particles.body)
+    tags = np.arange(particles.N)
+    box = np.asarray(snapshot.configuration.box[:3], dtype=np.float64)
+    position = np.asarray(particles.position, dtype=np.float64)
+    is_member = (body >= 0) & (body != tags)
+    worst = 0.0
+    for body_type, definition in bodies.items():
+        type_id = list(particles.types).index(body_type)
+        centers = np.flatnonzero((particles.typeid == type_id) & (body == tags))
+        members = np.flatnonzero(is_member & np.isin(body, centers))
+        if len(centers) == 0 or len(members) == 0:
+            continue
+        # Constituents of a body have consecutive tags in definition order.
+        members = members[np.argsort(body[members], kind="stable")]
+        local = np.asarray(definition["positions"], dtype=np.float64)
+        if len(members) != len(centers) * len(local):
+            raise ValueError(f"Bodies of type {body_type} are incomplete.")
+        members = members.reshape(len(centers), len(local))
+        q = np.asarray(particles.orientation[centers], dtype=np.float64)
+        pure = np.concatenate([np.zeros((len(local), 1)), local], axis=1)
+        rotated = _quaternion_product(
+            _quaternion_product(q[:, None, :], pure[None, :, :]),
+            _quaternion_conjugate(q)[:, None, :],
+        )[..., 1:]
+        delta = position[members] - (position[centers][:, None, :] + rotated)
+        delta -= box * np.round(delta / box)
+        worst = max(worst, float(np.max(np.linalg.norm(delta, axis=-1))))
+    return worst
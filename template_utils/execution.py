@@ -0,0 +1,111 @@
+"""GPU and multi-rank CPU execution profiles for simulation operations.
+
+By default every simulation runs on one GPU. With the ``cpu`` profile the
+operation instead runs as ``cpu_ranks`` MPI ranks using HOOMD's CPU device
+and domain decomposition, e.g. on the ``batch`` partition of Fry. The
+profile is read from the ``EXECUTION_PROFILE`` environment variable (set at
+submission, SLURM passes it on to the job) or from
+``job.doc.execution_profile``; the number of ranks from
+``job.doc.cpu_ranks``::
+
+    EXECUTION_PROFILE=cpu python project.py submit -o run --partition batch
+
+Under MPI only rank 0 may write to the job document, see ``rank_doc``.
+"""
+import os
+
+PROFILES = ("gpu", "cpu")
+DEFAULT_CPU_RANKS = 16
+_RANK_VARIABLES = ("OMPI_COMM_WORLD_RANK", "PMI_RANK", "PMIX_RANK")
+
+
+def execution_profile(job):
+    profile = os.environ.get(
+        "EXECUTION_PROFILE", job.doc.get("execution_profile", "gpu")
+    )
+    if profile not in PROFILES:
+        raise ValueError(
+            f"Unknown execution profile {profile}, choose from {PROFILES}."
+        )
+    return profile
+
+
+def _ngpu(*jobs):
+    return int(execution_profile(jobs[0]) == "gpu")
+
+
+def _nranks(*jobs):
+    # Aggregate operations run in one process with the profile of the first
+    # job of the aggregate.
+    if execution_profile(jobs[0]) == "cpu":
+        return jobs[0].doc.get("cpu_ranks", DEFAULT_CPU_RANKS)
+    return 1
+
+
+def execution_directives():
+    """``ngpu``, ``ncpu``, ``nranks`` and ``np`` directives of the profile.
+
+    Merge them into the directives of every simulation operation::
+
+        @Project.operation(
+            directives={**execution_directives(), "executable": "python -u"}
+        )
+    """
+    return {
+        "ngpu": _ngpu,
+        "ncpu": _nranks,
+        "nranks": _nranks,
+        "np": _nranks,
+    }
+
+
+def execution_device(job):
+    """HOOMD device for the job's execution profile."""
+    import hoomd
+
+    if execution_profile(job) == "cpu":
+        return hoomd.device.CPU()
+    return hoomd.device.auto_select()
+
+
+def mpi_rank():
+    """Rank of this process in its MPI job, 0 outside of MPI."""
+    for variable in _RANK_VARIABLES:
+        if variable in os.environ:
+            return int(os.environ[variable])
+    return 0
+
+
+class _ReadOnlyDoc:
+    """Job document proxy that reads from the document and drops writes."""
+
+    def __init__(self, doc):
+        object.__setattr__(self, "_doc", doc)
+
+    def __getattr__(self, key):
+        return getattr(self._doc, key)
+
+    def __setattr__(self, key, value):
+        pass
+
+    def __getitem__(self, key):
+        return self._doc[key]
+
+    def __setitem__(self, key, value):
+        pass
+
+    def __contains__(self, key):
+        return key in self._doc
+
+    def get(self, key, default=None):
+        return self._doc.get(key, default)
+
+    def setdefault(self, key, default=None):
+        return self._doc.get(key, default)
+
+
+def rank_doc(job):
+    """The job document on rank 0, a read-only proxy of it on other ranks."""
+    if mpi_rank() == 0:
+        return job.doc
+    return _ReadOnlyDoc(job.doc)
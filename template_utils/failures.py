@@ -0,0 +1,179 @@
+"""Classify failed operations and decide whether and how to retry them.
+
+A failing operation stays eligible, so without a policy it is resubmitted
+with the same inputs and fails the same way. Operations decorated with
+``failure_policy`` record every failure in ``job.doc.failures[operation]``
+with a category, and adjust the job document for the next attempt:
+
+``unstable``, ``nan``, ``constraint``
+    The system blew up. If the operation builds or shrinks the system
+    (``REBUILT``), the shrink timestep factor ``job.doc.shrink_dt_factor``
+    is halved and ``job.doc.build_seed`` incremented; the builders read
+    them. A continuation halves ``job.doc.dt_factor`` instead, which
+    ``workflow.continue_nvt`` applies to the timestep.
+``walltime``
+    SIGTERM before the walltime. Continuation operations resume from their
+    checkpoints, so the operation is retried as it is.
+``oom``, ``error``
+    Retried after an exponential back-off.
+
+After ``job.doc.max_attempts`` (default ``MAX_ATTEMPTS``) failures of an
+operation it is given up. Use ``retry_allowed`` as a precondition::
+
+    @Project.pre(retry_allowed("run"))
+    @Project.operation(...)
+    @failure_policy
+    def run(job):
+        ...
+
+Aggregate operations are supported: the failure is recorded in every job of
+the aggregate and the operation is only eligible if it may be retried for
+all of them.
+
+Call ``reset_failures(job)`` to try a given up operation again.
+"""
+import datetime
+import functools
+import re
+import signal
+import time
+
+MAX_ATTEMPTS = 3
+BACKOFF_HOURS = 1.0
+# Patterns of the error messages of HOOMD, CUDA and flowermd, lower case.
+CATEGORIES = (
+    ("oom", ("out of memory", "memory allocation", "cudaerrormemory")),
+    ("nan", (r"\bnan\b",)),
+    ("unstable", ("no longer in the simulation box", "out of box", "overlap")),
+    ("constraint", ("constraint", "rigid")),
+)
+ADJUSTED = ("unstable", "nan", "constraint")
+# Operations that build or shrink the system, the others continue it.
+REBUILT = ("build", "run")
+BACKED_OFF = ("oom", "error")
+
+
+class WalltimeExceeded(Exception):
+    """Raised in an operation when SIGTERM arrives before the walltime."""
+
+
+def classify(error):
+    """The failure category of an exception."""
+    if isinstance(error, WalltimeExceeded):
+        return "walltime"
+    if isinstance(error, MemoryError):
+        return "oom"
+    # e.g. template_utils.monitor.UnstableSimulation
+    if getattr(error, "category", None) in ADJUSTED:
+        return error.category
+    message = f"{type(error).__name__}: {error}".lower()
+    for category, patterns in CATEGORIES:
+        if any(re.search(pattern, message) for pattern in patterns):
+            return category
+    return "error"
+
+
+def _failures(job, name):
+    return list(job.doc.get("failures", dict()).get(name, []))
+
+
+def retry_allowed(name):
+    """Precondition: operation ``name`` is not given up or backing off."""
+
+    def allowed_job(job):
+        failures = _failures(job, name)
+        if len(failures) >= job.doc.get("max_attempts", MAX_ATTEMPTS):
+            return False
+        return not failures or time.time() >= failures[-1]["retry_after"]
+
+    def allowed(*jobs):
+        return all(allowed_job(job) for job in jobs)
+
+    allowed.__name__ = f"retry_allowed_{name}"
+    return allowed
+
+
+def given_up(job):
+    """Names of the operations of ``job`` that ran out of attempts."""
+    max_attempts = job.doc.get("max_attempts", MAX_ATTEMPTS)
+    return [
+        name
+        for name, failures in job.doc.get("failures", dict()).items()
+        if len(failures) >= max_attempts
+    ]
+
+
+def reset_failures(job, name=None):
+    """Forget the failures of operation ``name``, or of all operations."""
+    failures = dict(job.doc.get("failures", dict()))
+    if name is None:
+        failures = dict()
+    else:
+        failures.pop(name, None)
+    job.doc.failures = failures
+
+
+def _adjust(job, name, category, attempt):
+    """Change the job document for the next attempt, return the delay."""
+    if category in ADJUSTED and name in REBUILT:
+        job.doc.shrink_dt_factor = job.doc.get("shrink_dt_factor", 1.0) / 2
+        job.doc.build_seed = job.doc.get("build_seed", 0) + 1
+    elif category in ADJUSTED:
+        job.doc.dt_factor = job.doc.get("dt_factor", 1.0) / 2
+    if category in BACKED_OFF:
+        return BACKOFF_HOURS * 3600 * 2 ** (attempt - 1)
+    return 0.0
+
+
+def _record(job, name, error):
+    """Append ``error`` to the failures of operation ``name`` of ``job``."""
+    failures = _failures(job, name)
+    category = classify(error)
+    delay = _adjust(job, name, category, len(failures) + 1)
+    failures.append(
+        dict(
+            category=category,
+            message=str(error)[-500:],
+            time=datetime.datetime.now().isoformat(timespec="seconds"),
+            retry_after=time.time() + delay,
+        )
+    )
+    job.doc.setdefault("failures", dict())
+    job.doc.failures[name] = failures
+    print(
+        f"{name} failed on {job.id} ({category}), attempt {len(failures)} "
+        f"of {job.doc.get('max_attempts', MAX_ATTEMPTS)}."
+    )
+
+
+def _raise_walltime(signum, frame):
+    raise WalltimeExceeded("Received SIGTERM before the walltime.")
+
+
+def failure_policy(func):
+    """Record and classify failures of the operation ``func``.
+
+    SIGTERM is turned into ``WalltimeExceeded`` unless another handler is
+    installed, e.g. by ``template_utils.worker``, which finishes the current
+    operation instead. The exception is re-raised after it is recorded.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*jobs, **kwargs):
+        from template_utils.execution import mpi_rank
+
+        handler = None
+        if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+            handler = signal.signal(signal.SIGTERM, _raise_walltime)
+        try:
+            return func(*jobs, **kwargs)
+        except Exception as e:
+            if mpi_rank() == 0:
+                for job in jobs:
+                    _record(job, func.__name__, e)
+            raise
+        finally:
+            if handler is not None:
+                signal.signal(signal.SIGTERM, handler)
+
+    return wrapper
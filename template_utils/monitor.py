@@ -0,0 +1,136 @@
+"""Stop unstable simulations early.
+
+A system that blows up during a long ``run_NVT`` keeps running to the end
+of the allocation and writes unusable frames. ``add_drift_monitor`` adds a
+HOOMD custom writer that samples the potential energy, kinetic temperature
+and pressure every ``period`` steps. After ``warmup`` samples, a sample
+more than ``n_sigma`` standard deviations from the running mean of the
+accepted samples counts as a violation. ``patience`` violations in a row,
+or any non-finite value, raise ``UnstableSimulation`` from ``sim.run``::
+
+    monitor = add_drift_monitor(sim, job)
+    try:
+        sim.run(n_steps)
+    except UnstableSimulation:
+        save_checkpoint(sim, job.fn("aborted.gsd"))
+        raise
+
+The settings are read from ``job.doc.drift_monitor`` on top of
+``MONITOR_DEFAULTS``; set ``enabled`` to ``False`` to turn it off.
+"""
+import math
+
+MONITOR_DEFAULTS = dict(
+    enabled=True, period=10000, warmup=20, n_sigma=8.0, patience=3
+)
+QUANTITIES = ("potential_energy", "kinetic_temperature", "pressure")
+
+
+class UnstableSimulation(RuntimeError):
+    """Raised by the drift monitor, ``category`` is ``nan`` or ``unstable``."""
+
+    def __init__(self, message, category):
+        super().__init__(message)
+        self.category = category
+
+
+class RunningStats:
+    """Mean and variance of a stream of values (Welford's algorithm)."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / (self.n - 1)) if self.n > 1 else 0.0
+
+
+def monitor_settings(job):
+    settings = dict(MONITOR_DEFAULTS)
+    settings.update(job.doc.get("drift_monitor", dict()))
+    return settings
+
+
+def _drift_monitor(thermo, warmup, n_sigma, patience):
+    import hoomd
+
+    class DriftMonitor(hoomd.custom.Action):
+        def __init__(self):
+            self.stats = {q: RunningStats() for q in QUANTITIES}
+            self.violations = 0
+            self.last = dict()
+
+        def act(self, timestep):
+            values = {q: float(getattr(thermo, q)) for q in QUANTITIES}
+            self.last = dict(values, timestep=timestep)
+            for q, value in values.items():
+                if not math.isfinite(value):
+                    raise UnstableSimulation(
+                        f"{q} is {value} at step {timestep}.", "nan"
+                    )
+            outliers = [
+                q
+                for q, value in values.items()
+                if self.stats[q].n >= warmup
+                and abs(value - self.stats[q].mean)
+                > n_sigma * max(self.stats[q].std, 1e-12 * abs(value))
+            ]
+            if not outliers:
+                self.violations = 0
+                for q, value in values.items():
+                    self.stats[q].add(value)
+                return
+            self.violations += 1
+            if self.violations >= patience:
+                details = ", ".join(
+                    f"{q} = {values[q]:.6g} "
+                    f"(mean {self.stats[q].mean:.6g} "
+                    f"+- {self.stats[q].std:.3g})"
+                    for q in outliers
+                )
+                raise UnstableSimulation(
+                    f"Drift at step {timestep} for {self.violations} "
+                    f"checks in a row: {details}.",
+                    "unstable",
+                )
+
+    return DriftMonitor()
+
+
+def add_drift_monitor(sim, job, filter=None):
+    """Attach a drift monitor to ``sim`` with the settings of ``job``.
+
+    The thermodynamic quantities are computed for ``filter``, by default
+    the integrated group of a ``flowermd.base.Simulation``. Returns the
+    monitor action, or ``None`` if it is disabled.
+    """
+    import hoomd
+
+    settings = monitor_settings(job)
+    if not settings["enabled"]:
+        return None
+    if filter is None:
+        filter = sim.integrate_group
+    thermo = hoomd.md.compute.ThermodynamicQuantities(filter=filter)
+    sim.operations.computes.append(thermo)
+    monitor = _drift_monitor(
+        thermo,
+        warmup=int(settings["warmup"]),
+        n_sigma=float(settings["n_sigma"]),
+        patience=int(settings["patience"]),
+    )
+    sim.operations.writers.append(
+        hoomd.write.CustomWriter(
+            action=monitor,
+            trigger=hoomd.trigger.Periodic(int(settings["period"])),
+        )
+    )
+    return monitor
@@ -0,0 +1,114 @@
+"""Neighbor list autotuning.
+
+The neighbor list buffer trades the cost of building the list against the
+cost of evaluating pairs in the buffer shell, and the best value depends on
+the density and mobility of the system. ``tune_nlist`` runs a few thousand
+steps of NVT per candidate setting on an existing simulation and returns the
+fastest safe buffer and rebuild check delay. The continuation operations
+apply the result stored in ``job.doc.nlist`` to their force field::
+
+    with open(job.fn("forcefield.pickle"), "rb") as f:
+        hoomd_ff = pickle.load(f)
+    apply_nlist_settings(hoomd_ff, job)
+"""
+import time
+
+BUFFERS = (0.1, 0.2, 0.3, 0.4, 0.6, 0.8)
+CHECK_DELAYS = (1, 2, 5, 10)
+TUNE_STEPS = 5000
+
+
+def tuning_steps(job):
+    """Steps of the tune-nlist operation, including warm-up runs."""
+    n_steps = job.doc.get("nlist_tune_steps", TUNE_STEPS)
+    return 1.2 * n_steps * (len(BUFFERS) + len(CHECK_DELAYS))
+
+
+def neighbor_lists(forces):
+    """The distinct neighbor lists of the pair forces in ``forces``."""
+    import hoomd
+
+    nlists = []
+    for force in forces:
+        if isinstance(force, hoomd.md.pair.Pair):
+            if not any(force.nlist is n for n in nlists):
+                nlists.append(force.nlist)
+    return nlists
+
+
+def apply_nlist_settings(forces, job):
+    """Set the tuned buffer and check delay from ``job.doc.nlist``."""
+    settings = job.doc.get("nlist")
+    if not settings:
+        return
+    for nlist in neighbor_lists(forces):
+        nlist.buffer = settings["buffer"]
+        nlist.rebuild_check_delay = int(settings["rebuild_check_delay"])
+
+
+def _measure(sim, nlists, n_steps):
+    sim.run(max(n_steps // 5, 1))
+    start = time.perf_counter()
+    sim.run(n_steps)
+    tps = n_steps / (time.perf_counter() - start)
+    shortest = min(n.shortest_rebuild for n in nlists)
+    return tps, int(shortest)
+
+
+def tune_nlist(
+    sim,
+    kT,
+    tau_kt,
+    n_steps=TUNE_STEPS,
+    buffers=BUFFERS,
+    delays=CHECK_DELAYS,
+):
+    """Find the fastest neighbor list buffer and rebuild check delay.
+
+    The buffers are scanned with a check delay of 1. A larger delay is only
+    accepted if no rebuild was needed sooner than the delay, since HOOMD
+    would otherwise miss neighbors. Returns the settings, their TPS and the
+    measurements of all candidates.
+    """
+    sim.run_NVT(n_steps=0, kT=kT, tau_kt=tau_kt)
+    nlists = neighbor_lists(sim.operations.integrator.forces)
+    if not nlists:
+        return None
+    n_steps = int(n_steps)
+    scan = []
+    for buffer in buffers:
+        for nlist in nlists:
+            nlist.buffer = buffer
+            nlist.rebuild_check_delay = 1
+        tps, shortest = _measure(sim, nlists, n_steps)
+        scan.append(
+            dict(
+                buffer=buffer,
+                rebuild_check_delay=1,
+                tps=tps,
+                shortest_rebuild=shortest,
+            )
+        )
+    best = max(scan, key=lambda r: r["tps"])
+    for delay in delays:
+        if delay == 1 or delay >= best["shortest_rebuild"]:
+            continue
+        for nlist in nlists:
+            nlist.buffer = best["buffer"]
+            nlist.rebuild_check_delay = delay
+        tps, shortest = _measure(sim, nlists, n_steps)
+        result = dict(
+            buffer=best["buffer"],
+            rebuild_check_delay=delay,
+            tps=tps,
+            shortest_rebuild=shortest,
+        )
+        scan.append(result)
+        if shortest > delay and tps > best["tps"]:
+            best = result
+    return dict(
+        buffer=best["buffer"],
+        rebuild_check_delay=best["rebuild_check_delay"],
+        tps=best["tps"],
+        scan=scan,
+    )
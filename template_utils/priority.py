@@ -0,0 +1,116 @@
+"""Submit jobs in order of their remaining critical path.
+
+Each template describes its simulation pipeline as a list of stages, a
+label that is true once the stage is done and the number of steps the
+stage takes::
+
+    CRITICAL_PATH = (
+        (initial_run_done, lambda job: job.sp.n_equil_steps),
+        (production_done, lambda job: 2 * job.sp.n_prod_steps),
+    )
+
+The remaining time of a job is the number of steps of its unfinished
+stages divided by the TPS predicted from recorded telemetry for its system
+size (see ``template_utils.walltime``). ``ordered_submit`` submits the jobs
+with the longest remaining time first and bundles jobs with similar
+remaining times, so the largest systems are not left waiting at the end of
+a sweep.
+"""
+from template_utils.execution import execution_profile
+from template_utils.walltime import _project_records, fit_tps, n_particles
+
+
+def run_longer_rounds_left(job):
+    """Expected number of run-longer rounds before a job is equilibrated.
+
+    Set ``job.doc.expected_run_longer_rounds`` (default 1) from experience,
+    e.g. more rounds for longer chains. At least one round is left while
+    the job is not equilibrated.
+    """
+    done = max(job.doc.get("runs", 0) - 1, 0)
+    return max(job.doc.get("expected_run_longer_rounds", 1) - done, 1)
+
+
+def remaining_steps(job, stages):
+    return sum(steps(job) for done, steps in stages if not done(job))
+
+
+def remaining_hours(job, stages, records=None):
+    """Estimated hours left in the pipeline of ``job``.
+
+    Without telemetry the TPS is assumed to be inversely proportional to the
+    number of particles, which orders jobs correctly but is not in hours.
+    """
+    if records is None:
+        import signac
+
+        records = _project_records(signac.get_project().fn(""))
+    model = fit_tps(records, profile=execution_profile(job))
+    a, b = model if model is not None else (1.0, -1.0)
+    return remaining_steps(job, stages) / (a * n_particles(job) ** b) / 3600
+
+
+def ordered_submit(
+    project,
+    stages,
+    bundle_size=1,
+    jobs=None,
+    names=None,
+    num=None,
+    parallel=False,
+    force=False,
+    ignore_conditions=None,
+    ignore_conditions_on_execution=None,
+    **kwargs,
+):
+    """``FlowProject.submit`` with operations ordered by remaining critical path.
+
+    Takes the arguments of ``FlowProject.submit``. The eligible operations
+    of single jobs and aggregates (e.g. replica groups) are collected in
+    one status pass. They are ordered by the longest remaining time of
+    their jobs, and only then limited to ``num``. Bundles are formed from
+    consecutive operations in that order.
+
+    signac-flow has no public hook for the order of submission, so this
+    uses the same private steps as ``FlowProject.submit``.
+    """
+    from flow import IgnoreConditions
+    from flow.project import _make_bundles
+
+    if ignore_conditions is None:
+        ignore_conditions = IgnoreConditions.NONE
+    if ignore_conditions_on_execution is None:
+        ignore_conditions_on_execution = IgnoreConditions.NONE
+    records = _project_records(project.fn(""))
+    hours = dict()
+
+    def priority(operation):
+        for job in operation._jobs:
+            if job.id not in hours:
+                hours[job.id] = remaining_hours(job, stages, records)
+        return max(hours[job.id] for job in operation._jobs)
+
+    with project._buffered():
+        operations = list(
+            project._get_submission_operations(
+                project._convert_jobs_to_aggregates(jobs),
+                project._get_default_directives(),
+                names,
+                ignore_conditions,
+                ignore_conditions_on_execution,
+            )
+        )
+        operations.sort(key=priority, reverse=True)
+    if num is not None:
+        operations = operations[:num]
+    for operation in operations:
+        print(f"{operation}: {priority(operation):.3g} hours left")
+    with project._buffered():
+        with project._update_cached_scheduler_status() as status_update:
+            for bundle in _make_bundles(operations, bundle_size):
+                status = project._submit_operations(
+                    operations=bundle, parallel=parallel, force=force, **kwargs
+                )
+                if status is not None:
+                    for operation in bundle:
+                        status_update[operation.id] = status
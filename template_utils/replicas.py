@@ -0,0 +1,370 @@
+"""Run the seed replicas of a small system together in one HOOMD process.
+
+For systems of a few hundred particles the GPU mostly waits for kernel
+launches, so one replica per process wastes most of it. ``run_replicas``
+overlays N replicas in one periodic box. Every replica gets its own copy of
+the particle and bond types (``A`` becomes ``A-r0``, ``A-r1``, ...). Pair
+interactions between different replicas have a cutoff of zero and never
+enter the neighbor list. Each replica is integrated by its own NVT method
+and thermostat, so the replicas evolve independently, each in its own
+periodic box, while one set of kernel launches advances all of them.
+Replicas run on a single MPI rank.
+
+Frames are split back into each job's own trajectory, restart file and
+checkpoint (see ``template_utils.checkpoint``) with the original type
+names. The single-job continuation operations can pick up from them.
+"""
+import itertools
+import json
+
+REPLICA_SEPARATOR = "-r"
+TOPOLOGY_GROUPS = ("bonds", "angles", "dihedrals", "impropers", "pairs")
+PARTICLE_FIELDS = (
+    "position",
+    "velocity",
+    "orientation",
+    "angmom",
+    "image",
+    "mass",
+    "charge",
+    "diameter",
+    "moment_inertia",
+)
+
+
+def replica_key(job, ignore=("sim_seed",)):
+    """Group key of jobs that only differ in the ``ignore`` statepoint keys.
+
+    Use with ``aggregator.groupby(replica_key)`` to define replica operations.
+    """
+    return json.dumps(
+        {k: v for k, v in job.statepoint().items() if k not in ignore},
+        sort_keys=True,
+    )
+
+
+def replica_type(name, replica):
+    return f"{name}{REPLICA_SEPARATOR}{replica}"
+
+
+def stack_frames(frames):
+    """Overlay GSD frames with equal boxes and steps into one frame."""
+    import gsd.hoomd
+    import numpy as np
+
+    first = frames[0]
+    for frame in frames[1:]:
+        if (
+            not np.allclose(frame.configuration.box, first.configuration.box)
+            or frame.configuration.step != first.configuration.step
+        ):
+            raise ValueError("Replicas must share the box and the timestep.")
+    stacked = gsd.hoomd.Frame()
+    stacked.configuration.box = first.configuration.box
+    stacked.configuration.step = first.configuration.step
+    particles = stacked.particles
+    particles.N = sum(f.particles.N for f in frames)
+    particles.types = [
+        replica_type(t, i)
+        for i, f in enumerate(frames)
+        for t in f.particles.types
+    ]
+    type_offsets = np.cumsum([0] + [len(f.particles.types) for f in frames])
+    particle_offsets = np.cumsum([0] + [f.particles.N for f in frames])
+    particles.typeid = np.concatenate(
+        [f.particles.typeid + o for f, o in zip(frames, type_offsets)]
+    )
+    for field in PARTICLE_FIELDS:
+        setattr(
+            particles,
+            field,
+            np.concatenate([getattr(f.particles, field) for f in frames]),
+        )
+    particles.body = np.concatenate(
+        [
+            np.where(f.particles.body >= 0, f.particles.body + o, -1)
+            for f, o in zip(frames, particle_offsets)
+        ]
+    )
+    for group in TOPOLOGY_GROUPS:
+        groups = [getattr(f, group) for f in frames]
+        if not any(g.N for g in groups):
+            continue
+        target = getattr(stacked, group)
+        target.N = sum(g.N for g in groups)
+        target.types = [
+            replica_type(t, i) for i, g in enumerate(groups) for t in g.types
+        ]
+        offsets = np.cumsum([0] + [len(g.types) for g in groups])
+        target.typeid = np.concatenate(
+            [g.typeid + o for g, o in zip(groups, offsets)]
+        )
+        target.group = np.concatenate(
+            [g.group + o for g, o in zip(groups, particle_offsets)]
+        )
+    return stacked
+
+
+def replica_forces(forces, n_replicas):
+    """Copies of ``forces`` acting on the replica types only.
+
+    Supports analytic pair forces and bonded forces, which covers the
+    bead-spring force fields. Pairs of different replicas get a cutoff of
+    zero. Tabulated pair forces (``pair.Table``) are rejected: their
+    parameters are per-pair arrays, and copying them to every pair of
+    replicas multiplies their memory by the number of replicas squared.
+    """
+    import inspect
+
+    import hoomd
+
+    bonded = (
+        hoomd.md.bond.Bond,
+        hoomd.md.angle.Angle,
+        hoomd.md.dihedral.Dihedral,
+        hoomd.md.improper.Improper,
+    )
+    nlist = None
+    copies = []
+    for force in forces:
+        if isinstance(force, hoomd.md.pair.Pair):
+            if "mode" not in inspect.signature(type(force)).parameters:
+                raise ValueError(
+                    f"{type(force).__name__} is not an analytic pair force "
+                    "and is not supported for replicas."
+                )
+            if nlist is None:
+                nlist = hoomd.md.nlist.Cell(
+                    buffer=force.nlist.buffer,
+                    rebuild_check_delay=force.nlist.rebuild_check_delay,
+                    exclusions=force.nlist.exclusions,
+                )
+            copy = type(force)(nlist=nlist, mode=force.mode)
+            for a, b in force.params.keys():
+                for i, j in itertools.product(range(n_replicas), repeat=2):
+                    pair = (replica_type(a, i), replica_type(b, j))
+                    copy.params[pair] = force.params[(a, b)]
+                    copy.r_cut[pair] = force.r_cut[(a, b)] if i == j else 0.0
+        elif isinstance(force, bonded):
+            copy = type(force)()
+            for name in force.params.keys():
+                for i in range(n_replicas):
+                    copy.params[replica_type(name, i)] = force.params[name]
+        else:
+            raise ValueError(
+                f"{type(force).__name__} is not supported for replicas."
+            )
+        copies.append(copy)
+    return copies
+
+
+def _split_frame(particles, step, box, template, start, stop, full):
+    """Frame of one replica from the particle arrays of all of them.
+
+    ``particles`` maps field names to arrays in tag order.
+    """
+    import gsd.hoomd
+
+    frame = gsd.hoomd.Frame()
+    frame.configuration.step = step
+    frame.configuration.box = box
+    frame.particles.N = stop - start
+    for field in ("position", "orientation", "image"):
+        setattr(frame.particles, field, particles[field][start:stop])
+    if full:
+        frame.particles.velocity = particles["velocity"][start:stop]
+        frame.particles.angmom = particles["angmom"][start:stop]
+        for field in ("types", "typeid", "mass", "charge", "diameter"):
+            setattr(frame.particles, field, getattr(template.particles, field))
+        frame.particles.moment_inertia = template.particles.moment_inertia
+        frame.particles.body = template.particles.body
+        for group in TOPOLOGY_GROUPS:
+            setattr(frame, group, getattr(template, group))
+    return frame
+
+
+def _split_writer(templates, offsets, filenames):
+    """Custom action writing each replica to its own GSD file.
+
+    The first frame of each file holds the full particle data and topology,
+    later frames only positions, orientations and images. Only these
+    arrays are read, through the local snapshot, instead of copying the
+    full system with ``get_snapshot`` at every frame.
+    """
+    import gsd.hoomd
+    import hoomd
+    import numpy as np
+
+    class SplitWriter(hoomd.custom.Action):
+        def __init__(self):
+            self.files = [gsd.hoomd.open(f, mode="w") for f in filenames]
+            self.written = [False] * len(filenames)
+
+        def act(self, timestep):
+            fields = ["position", "orientation", "image"]
+            if not all(self.written):
+                fields += ["velocity", "angmom"]
+            particles = dict()
+            with self._state.cpu_local_snapshot as snapshot:
+                tag = np.array(snapshot.particles.tag)
+                for field in fields:
+                    local = np.array(getattr(snapshot.particles, field))
+                    particles[field] = np.empty_like(local)
+                    particles[field][tag] = local
+            box = self._state.box
+            box = [box.Lx, box.Ly, box.Lz, box.xy, box.xz, box.yz]
+            for i, traj in enumerate(self.files):
+                traj.append(
+                    _split_frame(
+                        particles,
+                        timestep,
+                        box,
+                        templates[i],
+                        offsets[i],
+                        offsets[i + 1],
+                        full=not self.written[i],
+                    )
+                )
+                self.written[i] = True
+
+        def close(self):
+            for traj in self.files:
+                traj.close()
+
+    return SplitWriter()
+
+
+def run_replicas(
+    restart_files,
+    forces,
+    n_steps,
+    kT,
+    tau_kt,
+    dt,
+    seeds,
+    trajectory_files,
+    write_freq,
+    output_files,
+    device=None,
+    write_trigger=None,
+    monitor=None,
+):
+    """Run replicas started from ``restart_files`` together.
+
+    ``forces`` is the force field of a single replica (e.g. the pickled
+    ``forcefield.pickle`` of a job). Frames are written every ``write_freq``
+    steps to ``trajectory_files``, or at the trigger that ``write_trigger``
+    returns for the starting timestep (see
+    ``template_utils.writers.output_trigger``). ``monitor`` is called with
+    the simulation before the run, e.g. to attach a drift monitor. The
+    final state of each replica is written to ``output_files`` with a
+    checkpoint. Exact states and
+    thermostat variables are restored from the checkpoints of the restart
+    files where available. ``seeds`` holds the seed of every replica. The
+    combined simulation uses the first, and each checkpoint records the
+    replica's own seed, so continuing a replica on its own keeps it.
+    Returns the number of steps per second.
+    """
+    import time
+
+    import gsd.hoomd
+    import hoomd
+    import numpy as np
+
+    from template_utils.checkpoint import (
+        THERMOSTAT_FIELDS,
+        load_checkpoint,
+        write_checkpoint,
+    )
+
+    templates = []
+    for filename in restart_files:
+        with gsd.hoomd.open(filename, mode="r") as traj:
+            templates.append(traj[-1])
+    if any(t.particles.types != templates[0].particles.types for t in templates):
+        raise ValueError("Replicas must have the same particle types.")
+    n = len(templates)
+    offsets = np.cumsum([0] + [t.particles.N for t in templates])
+    checkpoints = [load_checkpoint(f) for f in restart_files]
+
+    sim = hoomd.Simulation(
+        device=device or hoomd.device.auto_select(), seed=int(seeds[0])
+    )
+    if sim.device.communicator.num_ranks > 1:
+        raise ValueError("Replicas run on a single MPI rank.")
+    stacked = stack_frames(templates)
+    sim.timestep = stacked.configuration.step
+    snapshot = hoomd.Snapshot.from_gsd_frame(stacked, sim.device.communicator)
+    for i, checkpoint in enumerate(checkpoints):
+        if checkpoint is None:
+            continue
+        for field in ("position", "velocity", "orientation", "angmom"):
+            getattr(snapshot.particles, field)[
+                offsets[i] : offsets[i + 1]
+            ] = checkpoint[field]
+    sim.create_state_from_snapshot(snapshot)
+
+    methods = []
+    for i, checkpoint in enumerate(checkpoints):
+        thermostat = hoomd.md.methods.thermostats.MTTK(kT=kT, tau=tau_kt)
+        for field in THERMOSTAT_FIELDS:
+            if checkpoint is not None and field in checkpoint:
+                setattr(thermostat, field, tuple(checkpoint[field].tolist()))
+        types = [replica_type(t, i) for t in templates[i].particles.types]
+        methods.append(
+            hoomd.md.methods.ConstantVolume(
+                filter=hoomd.filter.Type(types), thermostat=thermostat
+            )
+        )
+    sim.operations.integrator = hoomd.md.Integrator(
+        dt=dt, methods=methods, forces=replica_forces(forces, n)
+    )
+    if write_trigger is None:
+        trigger = hoomd.trigger.Periodic(int(write_freq))
+    else:
+        trigger = write_trigger(sim.timestep)
+    writer = _split_writer(templates, offsets, trajectory_files)
+    sim.operations.writers.append(
+        hoomd.write.CustomWriter(action=writer, trigger=trigger)
+    )
+    if monitor is not None:
+        monitor(sim)
+
+    start = time.perf_counter()
+    try:
+        sim.run(int(n_steps))
+    finally:
+        writer.close()
+    tps = int(n_steps) / (time.perf_counter() - start)
+
+    snapshot = sim.state.get_snapshot()
+    particles = {
+        field: getattr(snapshot.particles, field)
+        for field in ("position", "velocity", "orientation", "angmom", "image")
+    }
+    for i, filename in enumerate(output_files):
+        frame = _split_frame(
+            particles,
+            sim.timestep,
+            snapshot.configuration.box,
+            templates[i],
+            offsets[i],
+            offsets[i + 1],
+            full=True,
+        )
+        with gsd.hoomd.open(filename, mode="w") as traj:
+            traj.append(frame)
+        state = {
+            field: np.array(
+                getattr(snapshot.particles, field)[offsets[i] : offsets[i + 1]]
+            )
+            for field in ("position", "velocity", "orientation", "angmom")
+        }
+        state["image"] = np.array(frame.particles.image)
+        state["box"] = np.array(snapshot.configuration.box, dtype=np.float64)
+        state["timestep"] = np.array(sim.timestep, dtype=np.uint64)
+        state["seed"] = np.array(int(seeds[i]))
+        for field in THERMOSTAT_FIELDS:
+            state[field] = np.array(getattr(methods[i].thermostat, field))
+        write_checkpoint(filename, state)
+    return tps
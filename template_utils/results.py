@@ -0,0 +1,219 @@
+"""Project-wide results table in a single columnar NPZ bundle.
+
+``collect_results`` gathers the statepoints, the scalar job document values
+and the ``.npy`` result arrays of all jobs into ``results.npz`` in the project
+root. Only jobs whose arrays or job document changed since the last update
+are read again. Notebooks then open one file instead of walking the
+workspace::
+
+    from template_utils.results import ResultsTable
+
+    table = ResultsTable("results.npz")
+    rows = table.select(chains=[50, 400], density=1.32)
+    for row in rows:
+        time = table.array("msd_time_comb_mid", row)
+        msd = table.array("msd_data_real_nm_squared_comb_mid", row)
+
+The bundle holds one entry per column:
+
+``job_id``, ``fingerprint``, ``statepoint``, ``document``
+    Strings, the last two JSON encoded.
+``sp/<key>``, ``doc/<key>``
+    Statepoint and scalar document values. Numbers and booleans are floats
+    (NaN where missing), text is a string (empty where missing) and lists
+    such as ``chains`` are JSON strings.
+``array/<name>/data``, ``array/<name>/offsets``
+    The arrays of all jobs concatenated along their first axis, with the
+    rows of job ``i`` at ``data[offsets[i]:offsets[i + 1]]``.
+"""
+import hashlib
+import json
+import os
+
+RESULTS_FILE = "results.npz"
+DOCUMENT_FILES = ("signac_job_document.json",)
+
+
+def _fingerprint(job):
+    """Hash of the names, sizes and times of a job's arrays and document."""
+    entries = sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(job.path)
+        if entry.name.endswith(".npy") or entry.name in DOCUMENT_FILES
+    )
+    return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+
+def _is_scalar(value):
+    return isinstance(value, (bool, int, float, str)) or value is None
+
+
+def _read_job(job):
+    import numpy as np
+
+    arrays = dict()
+    for entry in os.scandir(job.path):
+        if entry.name.endswith(".npy"):
+            arrays[entry.name[: -len(".npy")]] = np.load(entry.path)
+    document = {k: v for k, v in job.doc().items() if _is_scalar(v)}
+    return dict(
+        statepoint=job.statepoint(), document=document, arrays=arrays
+    )
+
+
+def _column(values):
+    """Typed column from a list of values with ``None`` for missing ones."""
+    import numpy as np
+
+    present = [v for v in values if v is not None]
+    if present and all(isinstance(v, str) for v in present):
+        return np.array(["" if v is None else v for v in values], dtype=str)
+    if all(isinstance(v, (bool, int, float)) for v in present):
+        return np.array(
+            [np.nan if v is None else float(v) for v in values],
+            dtype=np.float64,
+        )
+    return np.array([json.dumps(v) for v in values], dtype=str)
+
+
+class ResultsTable:
+    """Read access to a results bundle written by ``collect_results``."""
+
+    def __init__(self, filename=RESULTS_FILE):
+        import numpy as np
+
+        with np.load(filename, allow_pickle=False) as bundle:
+            self.columns = {key: bundle[key] for key in bundle.files}
+        self.job_ids = list(self.columns["job_id"])
+
+    def __len__(self):
+        return len(self.job_ids)
+
+    @property
+    def arrays(self):
+        """Names of the stored result arrays."""
+        return sorted(
+            {
+                key.split("/")[1]
+                for key in self.columns
+                if key.startswith("array/")
+            }
+        )
+
+    def statepoint(self, row):
+        return json.loads(str(self.columns["statepoint"][row]))
+
+    def document(self, row):
+        return json.loads(str(self.columns["document"][row]))
+
+    def column(self, key):
+        """A ``sp/`` or ``doc/`` column, e.g. ``table.column("doc/runs")``."""
+        return self.columns[key]
+
+    def select(self, **filters):
+        """Rows whose statepoint matches all ``filters``.
+
+        A filter value is compared for equality (lists and tuples as JSON)
+        or, if callable, applied to the whole column and must return a
+        boolean array.
+        """
+        import numpy as np
+
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in filters.items():
+            column = self.columns.get(f"sp/{key}")
+            if column is None:
+                return np.zeros(0, dtype=int)
+            if callable(value):
+                mask &= value(column)
+            elif isinstance(value, (list, tuple, dict)):
+                mask &= column == json.dumps(value)
+            else:
+                mask &= column == value
+        return np.flatnonzero(mask)
+
+    def array(self, name, row):
+        """The array ``name`` of the job in ``row``."""
+        offsets = self.columns[f"array/{name}/offsets"]
+        data = self.columns[f"array/{name}/data"]
+        return data[offsets[row] : offsets[row + 1]]
+
+
+def _previous_rows(filename):
+    """Rows of an existing bundle keyed by job id, with their fingerprints."""
+    if not os.path.isfile(filename):
+        return dict()
+    table = ResultsTable(filename)
+    rows = dict()
+    for row, job_id in enumerate(table.job_ids):
+        rows[job_id] = dict(
+            fingerprint=str(table.columns["fingerprint"][row]),
+            statepoint=table.statepoint(row),
+            document=table.document(row),
+            arrays={
+                name: table.array(name, row)
+                for name in table.arrays
+                if table.columns[f"array/{name}/offsets"][row + 1]
+                > table.columns[f"array/{name}/offsets"][row]
+            },
+        )
+    return rows
+
+
+def collect_results(jobs, filename):
+    """Update the results bundle ``filename`` with ``jobs``.
+
+    Jobs no longer in ``jobs`` are dropped. Returns the number of jobs read
+    from the workspace.
+    """
+    import numpy as np
+
+    previous = _previous_rows(filename)
+    rows = dict()
+    n_read = 0
+    for job in jobs:
+        fingerprint = _fingerprint(job)
+        old = previous.get(job.id)
+        if old is not None and old["fingerprint"] == fingerprint:
+            rows[job.id] = old
+            continue
+        rows[job.id] = dict(fingerprint=fingerprint, **_read_job(job))
+        n_read += 1
+
+    job_ids = sorted(rows)
+    columns = dict(
+        job_id=np.array(job_ids, dtype=str),
+        fingerprint=np.array(
+            [rows[i]["fingerprint"] for i in job_ids], dtype=str
+        ),
+        statepoint=np.array(
+            [json.dumps(rows[i]["statepoint"]) for i in job_ids], dtype=str
+        ),
+        document=np.array(
+            [json.dumps(rows[i]["document"]) for i in job_ids], dtype=str
+        ),
+    )
+    for prefix, field in (("sp", "statepoint"), ("doc", "document")):
+        keys = sorted({k for i in job_ids for k in rows[i][field]})
+        for key in keys:
+            columns[f"{prefix}/{key}"] = _column(
+                [rows[i][field].get(key) for i in job_ids]
+            )
+    names = sorted({name for i in job_ids for name in rows[i]["arrays"]})
+    for name in names:
+        arrays = [rows[i]["arrays"].get(name) for i in job_ids]
+        shapes = {a.shape[1:] for a in arrays if a is not None}
+        if len(shapes) > 1:
+            print(f"Skipping {name}, its shape differs between jobs.")
+            continue
+        lengths = [0 if a is None else len(np.atleast_1d(a)) for a in arrays]
+        columns[f"array/{name}/offsets"] = np.concatenate(
+            [[0], np.cumsum(lengths)]
+        ).astype(np.int64)
+        columns[f"array/{name}/data"] = np.concatenate(
+            [np.atleast_1d(a) for a in arrays if a is not None]
+        )
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, **columns)
+    os.replace(filename + ".tmp", filename)
+    return n_read
@@ -0,0 +1,132 @@
+"""Short timestep stability benchmarks.
+
+``measure_stability`` runs a short NVT segment followed by an NVE segment on
+an existing ``flowermd.base.Simulation`` and returns the energy drift, the
+rigid body constraint violation (the largest displacement of a constituent
+from its place in the body) and the time steps per second. These are
+enough to decide whether a timestep is usable without running a full
+production job.
+"""
+import time
+
+
+def _total_energy(sim, thermo):
+    potential = sum(force.energy for force in sim.operations.integrator.forces)
+    return potential + thermo.kinetic_energy
+
+
+def _constraint_violation(sim, bodies):
+    """Largest distance of a rigid body constituent from its place."""
+    from template_utils.ellipsoid import rigid_violation
+
+    snapshot = sim.state.get_snapshot()
+    if snapshot.communicator.rank != 0:
+        return 0.0
+    return rigid_violation(snapshot, bodies)
+
+
+def measure_stability(sim, kT, tau_kt, n_steps, n_samples=20, bodies=None):
+    """Run ``n_steps`` of NVT then ``n_steps`` of NVE and measure stability.
+
+    Returns a dict with the NVE energy drift (energy per integrated degree
+    of freedom per unit time, ``None`` if the energy is not finite), the
+    standard deviation of the total energy, the rigid body constraint
+    violation for the body definitions ``bodies`` (see
+    ``template_utils.ellipsoid.body_definitions``, ``None`` without them),
+    the mean kinetic temperature of the NVT segment and the TPS of both
+    segments.
+    """
+    import hoomd
+    import numpy as np
+
+    thermo = hoomd.md.compute.ThermodynamicQuantities(filter=sim.integrate_group)
+    sim.operations.computes.append(thermo)
+    chunk = max(int(n_steps) // n_samples, 1)
+
+    sim.run_NVT(n_steps=chunk, kT=kT, tau_kt=tau_kt)
+    temperatures = []
+    start = time.perf_counter()
+    for i in range(n_samples - 1):
+        sim.run(chunk)
+        temperatures.append(thermo.kinetic_temperature)
+    nvt_tps = chunk * (n_samples - 1) / (time.perf_counter() - start)
+
+    sim.run_NVE(n_steps=chunk)
+    times = []
+    energies = []
+    start = time.perf_counter()
+    for i in range(n_samples):
+        sim.run(chunk)
+        times.append(sim.timestep * sim.dt)
+        energies.append(_total_energy(sim, thermo))
+    nve_tps = chunk * n_samples / (time.perf_counter() - start)
+    degrees_of_freedom = max(thermo.degrees_of_freedom, 1)
+    sim.operations.computes.remove(thermo)
+
+    energies = np.array(energies)
+    finite = bool(np.all(np.isfinite(energies)))
+    if finite:
+        slope = np.polyfit(np.array(times) - times[0], energies, 1)[0]
+        drift = abs(slope) / degrees_of_freedom
+        fluctuation = float(np.std(energies))
+    else:
+        drift = None
+        fluctuation = None
+    return dict(
+        dt=sim.dt,
+        finite=finite,
+        energy_drift=drift if drift is None else float(drift),
+        energy_fluctuation=fluctuation,
+        constraint_violation=None
+        if bodies is None
+        else _constraint_violation(sim, bodies),
+        mean_kT=float(np.mean(temperatures)) if temperatures else kT,
+        nvt_tps=nvt_tps,
+        nve_tps=nve_tps,
+    )
+
+
+def unstable_result(dt, error):
+    """Benchmark result of a timestep at which the simulation failed."""
+    return dict(
+        dt=dt,
+        finite=False,
+        energy_drift=None,
+        energy_fluctuation=None,
+        constraint_violation=None,
+        mean_kT=None,
+        nvt_tps=None,
+        nve_tps=None,
+        error=f"{type(error).__name__}: {error}"[-500:],
+    )
+
+
+def is_stable(result, kT, max_drift=1e-3, max_violation=1e-3, kT_tol=0.1):
+    """Whether a ``measure_stability`` result passes the stability criteria.
+
+    ``max_drift`` is in units of kT per degree of freedom per unit time,
+    ``max_violation`` in units of length and ``kT_tol`` is the allowed
+    relative deviation of the NVT temperature. Results without a constraint
+    violation (no rigid bodies) pass that criterion.
+    """
+    violation = result["constraint_violation"]
+    return (
+        result["finite"]
+        and result["energy_drift"] <= max_drift * kT
+        and (violation is None or violation <= max_violation)
+        and abs(result["mean_kT"] - kT) <= kT_tol * kT
+    )
+
+
+def largest_stable_dt(results, kT, **criteria):
+    """Pick the largest stable timestep from a list of benchmark results.
+
+    Returns the chosen result extended with the throughput in simulated
+    time units per wall-clock hour, or ``None`` if no timestep is stable.
+    """
+    stable = [r for r in results if is_stable(r, kT, **criteria)]
+    if not stable:
+        return None
+    best = dict(max(stable, key=lambda r: r["dt"]))
+    best["time_per_hour"] = best["dt"] * best["nvt_tps"] * 3600
+    return best
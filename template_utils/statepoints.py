@@ -0,0 +1,150 @@
+"""Cached statepoint index and incremental workspace expansion.
+
+Running ``init.py`` walks the full parameter product and opens every job,
+which gets slow once a sweep has thousands of statepoints. The project keeps
+an index of all statepoints in ``statepoint_index.json``, refreshed from a
+listing of the workspace directory, so the difference between the parameter
+product and the workspace can be computed without opening any job::
+
+    python init.py --diff       # show what would be created
+    python init.py --expand     # create only the new jobs
+
+Without options ``init.py`` still walks and initializes every job, e.g. to
+set new document defaults on existing jobs.
+"""
+import argparse
+import json
+import os
+import re
+
+INDEX_FILE = "statepoint_index.json"
+MAX_NEW_JOBS = 500
+_JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def _normalized(statepoint):
+    """The statepoint as stored by signac, with tuples as lists."""
+    return json.loads(json.dumps(statepoint))
+
+
+def load_index(project):
+    """Statepoints of all jobs in the workspace, keyed by job id.
+
+    Only jobs missing from the cached index are read from disk.
+    """
+    filename = project.fn(INDEX_FILE)
+    index = dict()
+    if os.path.isfile(filename):
+        with open(filename, "r") as f:
+            index = json.load(f)
+    workspace = project.workspace
+    ids = set()
+    if os.path.isdir(workspace):
+        ids = {n for n in os.listdir(workspace) if _JOB_ID.fullmatch(n)}
+    for job_id in ids - index.keys():
+        with open(
+            os.path.join(workspace, job_id, "signac_statepoint.json"), "r"
+        ) as f:
+            index[job_id] = json.load(f)
+    return {job_id: index[job_id] for job_id in ids}
+
+
+def save_index(project, index):
+    filename = project.fn(INDEX_FILE)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(filename + ".tmp", filename)
+
+
+def new_statepoints(project, names, combinations, index):
+    """Statepoints of the parameter product that are not in ``index``."""
+    new = dict()
+    for params in combinations:
+        statepoint = dict(zip(names, params))
+        job_id = project.open_job(statepoint).id
+        if job_id not in index and job_id not in new:
+            new[job_id] = statepoint
+    return new
+
+
+def print_diff(names, combinations, index, new):
+    """Summarize the parameter product and the jobs it would add."""
+    sizes = [
+        len({json.dumps(c[i]) for c in combinations})
+        for i in range(len(names))
+    ]
+    print(
+        " x ".join(f"{n} {name}" for n, name in zip(sizes, names) if n > 1)
+        or "1 combination",
+        f"= {len(combinations)} statepoints in the parameter product.",
+    )
+    print(f"{len(index)} jobs in the workspace, {len(new)} new.")
+    existing = [
+        {json.dumps(sp.get(name)) for sp in index.values()} for name in names
+    ]
+    for i, name in enumerate(names):
+        added = sorted(
+            {json.dumps(_normalized(sp[name])) for sp in new.values()}
+            - existing[i]
+        )
+        if added:
+            print(f"  new {name}: {', '.join(added)}")
+
+
+def expand(project, new, init_job, index):
+    """Initialize the jobs in ``new`` and add them to the index."""
+    for job_id, statepoint in new.items():
+        job = project.open_job(statepoint)
+        job.init()
+        init_job(job)
+        index[job_id] = _normalized(statepoint)
+    save_index(project, index)
+
+
+def main(get_parameters, init_job, walk, args=None):
+    """Command line of an ``init.py``; ``walk`` is its full initialization."""
+    import signac
+
+    parser = argparse.ArgumentParser(
+        description="Initialize the project's data space."
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--diff",
+        action="store_true",
+        help="Show the jobs the parameter product adds to the workspace.",
+    )
+    group.add_argument(
+        "--expand",
+        action="store_true",
+        help="Only initialize jobs that are not in the workspace yet.",
+    )
+    parser.add_argument(
+        "--max-new",
+        type=int,
+        default=MAX_NEW_JOBS,
+        help="Refuse to expand by more jobs than this without --force.",
+    )
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args(args)
+    if not (args.diff or args.expand):
+        walk()
+        return
+
+    project = signac.init_project()
+    names, combinations = get_parameters()
+    index = load_index(project)
+    new = new_statepoints(project, names, combinations, index)
+    print_diff(names, combinations, index, new)
+    if len(new) > args.max_new:
+        print(
+            f"Warning: {len(new)} new jobs is more than --max-new "
+            f"{args.max_new}, check the parameter lists."
+        )
+    if args.diff:
+        return
+    if len(new) > args.max_new and not args.force:
+        print("Nothing created, use --force to create them anyway.")
+        return
+    expand(project, new, init_job, index)
+    print(f"Initialized {len(new)} jobs.")
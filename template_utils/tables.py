@@ -0,0 +1,203 @@
+"""Compact tabulated MSIBI force fields.
+
+MSIBI writes its pair, bond and angle potentials as HOOMD ``Table`` forces
+on the fine grids used during the iteration, and the pair tables extend to
+the cutoff of the target RDF. HOOMD interpolates tables linearly, so a table
+can be resampled to fewer points as long as the interpolated energy and
+force stay within a tolerance, and a pair cutoff can be moved in to where
+the potential has decayed. A shorter cutoff shrinks the neighbor list, which
+is paid for on every step of every job using the force field::
+
+    forces, report = cached_forcefield(
+        msibi_job.fn("pps-msibi.pickle"), project.fn("forcefields")
+    )
+
+The compacted force field is cached next to the project under the name of
+the source file and a hash of its contents and the tolerances, so jobs
+sharing an MSIBI job only compact it once.
+"""
+import hashlib
+import json
+import os
+import pickle
+
+# Energy and force tolerances, in the reduced units of the force field.
+U_TOLERANCE = 1e-3
+F_TOLERANCE = 1e-2
+MIN_WIDTH = 16
+
+
+def _grid(start, stop, width, endpoint):
+    import numpy as np
+
+    return np.linspace(start, stop, int(width), endpoint=endpoint)
+
+
+def _errors(x, U, F, grid, U_new, F_new):
+    """Largest deviation of the resampled table from the original points."""
+    import numpy as np
+
+    inside = x <= grid[-1]
+    return (
+        float(np.max(np.abs(np.interp(x[inside], grid, U_new) - U[inside]))),
+        float(np.max(np.abs(np.interp(x[inside], grid, F_new) - F[inside]))),
+    )
+
+
+def min_width(x, U, F, start, stop, endpoint, u_tol, f_tol, width=MIN_WIDTH):
+    """Smallest table width on ``[start, stop]`` that meets the tolerances.
+
+    ``x``, ``U`` and ``F`` are the original table. The search is a bisection
+    between ``width`` and the original width, which always passes.
+    """
+    import numpy as np
+
+    def passes(n):
+        grid = _grid(start, stop, n, endpoint)
+        u_err, f_err = _errors(
+            x, U, F, grid, np.interp(grid, x, U), np.interp(grid, x, F)
+        )
+        return u_err <= u_tol and f_err <= f_tol
+
+    lo, hi = int(width), len(x)
+    if lo >= hi:
+        return hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if passes(mid):
+            hi = mid
+        else:
+            lo = mid + 1
+    return hi
+
+
+def trimmed_cutoff(r, U, F, u_tol, f_tol):
+    """The first grid point beyond which ``U`` and ``F`` stay within tolerance.
+
+    ``r`` is the pair table grid, which does not include the cutoff itself.
+    Returns ``None`` if the potential has not decayed before the cutoff.
+    """
+    import numpy as np
+
+    significant = np.flatnonzero((np.abs(U) > u_tol) | (np.abs(F) > f_tol))
+    if len(significant) == 0 or significant[-1] + 1 >= len(r):
+        return None
+    return float(r[significant[-1] + 1])
+
+
+def _compact_pair(force, u_tol, f_tol):
+    import hoomd
+    import numpy as np
+
+    compact = hoomd.md.pair.Table(nlist=force.nlist, default_r_cut=0.0)
+    report = dict()
+    for pair in force.params.keys():
+        params = force.params[pair]
+        r_min, r_cut = params["r_min"], force.r_cut[pair]
+        U, F = np.asarray(params["U"]), np.asarray(params["F"])
+        r = _grid(r_min, r_cut, len(U), endpoint=False)
+        new_cut = trimmed_cutoff(r, U, F, u_tol, f_tol) or r_cut
+        keep = r < new_cut
+        width = min_width(
+            r[keep], U[keep], F[keep], r_min, new_cut, False, u_tol, f_tol
+        )
+        grid = _grid(r_min, new_cut, width, endpoint=False)
+        compact.params[pair] = dict(
+            r_min=r_min, U=np.interp(grid, r, U), F=np.interp(grid, r, F)
+        )
+        compact.r_cut[pair] = new_cut
+        report["-".join(pair)] = dict(
+            width=[len(U), width], r_cut=[float(r_cut), float(new_cut)]
+        )
+    return compact, report
+
+
+def _compact_bonded(force, u_tol, f_tol):
+    """Resample a bond, angle or dihedral table to a common smaller width."""
+    import hoomd
+    import numpy as np
+
+    def limits(params):
+        if isinstance(force, hoomd.md.bond.Table):
+            return params["r_min"], params["r_max"]
+        if isinstance(force, hoomd.md.angle.Table):
+            return 0.0, np.pi
+        return -np.pi, np.pi
+
+    # Angle and dihedral tables store the torque as tau instead of F.
+    key = "F" if isinstance(force, hoomd.md.bond.Table) else "tau"
+    tables = dict()
+    for name in force.params.keys():
+        params = force.params[name]
+        start, stop = limits(params)
+        U, F = np.asarray(params["U"]), np.asarray(params[key])
+        tables[name] = (_grid(start, stop, len(U), True), U, F, params)
+    # The width is shared by all types of a bonded table force.
+    width = max(
+        min_width(x, U, F, x[0], x[-1], True, u_tol, f_tol)
+        for x, U, F, _ in tables.values()
+    )
+    compact = type(force)(width=width)
+    for name, (x, U, F, params) in tables.items():
+        grid = _grid(x[0], x[-1], width, True)
+        new = dict(params, U=np.interp(grid, x, U))
+        new[key] = np.interp(grid, x, F)
+        compact.params[name] = new
+    return compact, {"width": [int(force.width), width]}
+
+
+def compact_forcefield(forces, u_tol=U_TOLERANCE, f_tol=F_TOLERANCE):
+    """Resample the table forces in ``forces`` within the tolerances.
+
+    Returns the new list of forces and a report of the old and new table
+    widths and pair cutoffs. Other forces are passed through unchanged.
+    """
+    import hoomd
+
+    bonded = (hoomd.md.bond.Table, hoomd.md.angle.Table, hoomd.md.dihedral.Table)
+    compacted = []
+    report = dict()
+    for force in forces:
+        if isinstance(force, hoomd.md.pair.Table):
+            force, report["pair"] = _compact_pair(force, u_tol, f_tol)
+        elif isinstance(force, bonded):
+            kind = type(force).__module__.split(".")[-1]
+            force, report[kind] = _compact_bonded(force, u_tol, f_tol)
+        compacted.append(force)
+    return compacted, report
+
+
+def cached_forcefield(
+    source_file, cache_dir, u_tol=U_TOLERANCE, f_tol=F_TOLERANCE
+):
+    """Compacted force field of the pickle ``source_file``, cached.
+
+    Returns the forces and the compaction report. The cache entry is keyed
+    by the contents of ``source_file`` and the tolerances, so a refit MSIBI
+    force field is compacted again.
+    """
+    with open(source_file, "rb") as f:
+        source = f.read()
+    key = hashlib.sha1(
+        source + json.dumps([u_tol, f_tol]).encode()
+    ).hexdigest()[:12]
+    name = os.path.splitext(os.path.basename(source_file))[0]
+    cache_file = os.path.join(cache_dir, f"{name}-{key}.pickle")
+    report_file = os.path.join(cache_dir, f"{name}-{key}.json")
+    if os.path.isfile(cache_file) and os.path.isfile(report_file):
+        with open(cache_file, "rb") as f:
+            forces = pickle.load(f)
+        with open(report_file) as f:
+            return forces, json.load(f)
+
+    forces, report = compact_forcefield(pickle.loads(source), u_tol, f_tol)
+    report["source"] = os.path.abspath(source_file)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to temporary files first, other jobs may read the cache.
+    with open(cache_file + ".tmp", "wb") as f:
+        pickle.dump(forces, f)
+    with open(report_file + ".tmp", "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(cache_file + ".tmp", cache_file)
+    os.replace(report_file + ".tmp", report_file)
+    return forces, report
@@ -0,0 +1,209 @@
+"""Performance telemetry for workflow operations.
+
+Decorate an operation with ``instrumented`` and wrap its expensive parts in
+``phase`` blocks::
+
+    @Project.operation(name="run")
+    @instrumented
+    def run(job):
+        with job:
+            with phase("shrink", sim):
+                sim.run_update_volume(...)
+
+Each call appends a record with the wall time of every phase, the TPS of the
+simulation in that phase, the peak resident memory and the number of bytes
+written to GSD and log files to ``telemetry.jsonl`` in the project root.
+Only the last ``DOC_RECORDS`` records are also kept in ``job.doc.telemetry``. Run
+``python -m template_utils.telemetry <project root>`` for a summary.
+
+For aggregate operations, e.g. replicas run together, one record with the
+total particle count is written to the project file and appended to the
+document of every job of the aggregate.
+"""
+import contextlib
+import datetime
+import functools
+import json
+import os
+import resource
+import socket
+import time
+
+from template_utils.execution import execution_profile, mpi_rank
+
+TELEMETRY_FILE = "telemetry.jsonl"
+OUTPUT_EXTENSIONS = (".gsd", ".txt", ".pickle", ".npz")
+DOC_RECORDS = 10
+
+_active = []
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _output_sizes(directory):
+    """Sizes of the output files in ``directory`` by name."""
+    return {
+        entry.name: entry.stat().st_size
+        for entry in os.scandir(directory)
+        if entry.name.endswith(OUTPUT_EXTENSIONS)
+    }
+
+
+def _bytes_written(directory, sizes):
+    """Growth of the output files in ``directory`` since ``sizes``.
+
+    Appended files only count the appended bytes. Rewritten files that
+    shrank count as zero.
+    """
+    return sum(
+        max(size - sizes.get(name, 0), 0)
+        for name, size in _output_sizes(directory).items()
+    )
+
+
+@contextlib.contextmanager
+def phase(name, sim=None):
+    """Time a phase of the active operation.
+
+    If ``sim`` is given, the number of steps run in the phase and the mean
+    time steps per second are recorded as well. Without ``sim``, steps and
+    TPS measured elsewhere can be reported by setting ``steps`` and ``tps``
+    in the yielded dict. Does nothing outside of an ``instrumented``
+    operation.
+    """
+    start_step = sim.timestep if sim is not None else None
+    measured = dict()
+    start = time.perf_counter()
+    try:
+        yield measured
+    finally:
+        wall_time = time.perf_counter() - start
+        if _active:
+            record = dict(name=name, wall_time=wall_time)
+            if sim is not None:
+                steps = sim.timestep - start_step
+                record["steps"] = steps
+                record["tps"] = steps / wall_time if wall_time > 0 else None
+            record.update(measured)
+            _active[-1]["phases"].append(record)
+
+
+def _save(jobs, record, project_file, sizes):
+    from template_utils.walltime import n_particles
+
+    record["peak_rss_mb"] = _peak_rss_mb()
+    record["bytes_written"] = sum(
+        _bytes_written(job.fn(""), job_sizes)
+        for job, job_sizes in zip(jobs, sizes)
+    )
+    record["n_particles"] = sum(n_particles(job) for job in jobs)
+    for job in jobs:
+        records = list(job.doc.get("telemetry", []))[-(DOC_RECORDS - 1) :]
+        job.doc.telemetry = records + [record]
+    with open(project_file, "a") as f:
+        f.write(json.dumps(dict(statepoint=jobs[0].sp(), **record)) + "\n")
+
+
+def instrumented(func):
+    """Record telemetry for every call of the operation ``func``."""
+
+    @functools.wraps(func)
+    def wrapper(*jobs, **kwargs):
+        import signac
+
+        project_file = signac.get_project().fn(TELEMETRY_FILE)
+        record = dict(
+            operation=func.__name__,
+            job=jobs[0].id,
+            profile=execution_profile(jobs[0]),
+            hostname=socket.gethostname(),
+            start=datetime.datetime.now().isoformat(timespec="seconds"),
+            phases=[],
+        )
+        if len(jobs) > 1:
+            record["jobs"] = [job.id for job in jobs]
+        _active.append(record)
+        sizes = [_output_sizes(job.fn("")) for job in jobs]
+        start = time.perf_counter()
+        try:
+            result = func(*jobs, **kwargs)
+            record["status"] = "completed"
+            return result
+        except BaseException as e:
+            record["status"] = f"failed: {type(e).__name__}"
+            raise
+        finally:
+            _active.pop()
+            if mpi_rank() == 0:
+                record["wall_time"] = time.perf_counter() - start
+                _save(jobs, record, project_file, sizes)
+
+    return wrapper
+
+
+def load(project_root):
+    """Read all telemetry records of a project."""
+    filename = os.path.join(project_root, TELEMETRY_FILE)
+    if not os.path.isfile(filename):
+        return []
+    with open(filename, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, keys=("chains", "density")):
+    """Mean wall time, TPS and peak memory per operation and statepoint group.
+
+    Statepoints without one of ``keys`` (e.g. ``N`` and ``length`` instead
+    of ``chains`` in single-ellipsoid) are grouped under ``None``.
+    """
+    groups = dict()
+    for record in records:
+        group = tuple(
+            json.dumps(record["statepoint"].get(key)) for key in keys
+        )
+        groups.setdefault((record["operation"],) + group, []).append(record)
+    rows = []
+    for key, group in sorted(groups.items()):
+        tps = [
+            p["tps"] for r in group for p in r["phases"] if p.get("tps")
+        ]
+        rows.append(
+            dict(
+                operation=key[0],
+                **{k: json.loads(v) for k, v in zip(keys, key[1:])},
+                runs=len(group),
+                failed=sum(r["status"] != "completed" for r in group),
+                mean_wall_time_h=sum(r["wall_time"] for r in group)
+                / len(group)
+                / 3600,
+                mean_tps=sum(tps) / len(tps) if tps else None,
+                peak_rss_mb=max(r["peak_rss_mb"] for r in group),
+                gb_written=sum(r["bytes_written"] for r in group) / 1e9,
+            )
+        )
+    return rows
+
+
+def print_summary(project_root, keys=("chains", "density")):
+    rows = summarize(load(project_root), keys=keys)
+    if not rows:
+        print("No telemetry recorded.")
+        return
+    header = list(rows[0].keys())
+    print("  ".join(f"{h:>16}" for h in header))
+    for row in rows:
+        print(
+            "  ".join(
+                f"{v:>16.4g}" if isinstance(v, float) else f"{str(v):>16}"
+                for v in row.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    import sys
+
+    print_summary(sys.argv[1] if len(sys.argv) > 1 else ".")
@@ -0,0 +1,360 @@
+"""Read the trajectory segments of a job as one sequence of frames.
+
+Each operation writes a new GSD file (``trajectory0.gsd``, ``trajectory1.gsd``,
+... for equilibration and ``production.gsd``, ``production2.gsd``, ... for
+production). ``MultiTrajectory`` opens these segments lazily and indexes them
+as if they were a single file, so analyses can do ``traj[-500:]`` across
+segment boundaries without writing a combined GSD file first.
+
+For vectorized analyses, ``MultiTrajectory.chunks`` reads per-particle
+arrays of a particle type selection straight from the GSD chunks into
+reused ``(n_frames, n_selected, width)`` blocks, without building a
+``gsd.hoomd.Frame`` per frame::
+
+    with open_job_trajectory(job) as traj:
+        for frames, block in traj.chunks(types="B", chunk_size=256):
+            positions = block["position"]  # (n, n_B, 3) float32
+"""
+import bisect
+import itertools
+import json
+import os
+import re
+
+SEGMENT_PATTERNS = {
+    "equilibration": re.compile(r"^trajectory(\d+)\.gsd$"),
+    "production": re.compile(r"^production(\d*)\.gsd$"),
+}
+ARCHIVE_PREFIX = "archive-"
+# Per-frame chunks that gsd.hoomd silently fills in from frame 0 when a
+# frame does not contain them (see template_utils.writers).
+MOMENTUM_CHUNKS = ("particles/velocity", "particles/angmom")
+STATIC_PARTICLE_FIELDS = (
+    "types",
+    "typeid",
+    "mass",
+    "charge",
+    "diameter",
+    "body",
+    "moment_inertia",
+)
+TOPOLOGY_GROUPS = ("bonds", "angles", "dihedrals", "impropers", "constraints")
+# Per-particle fields that ``MultiTrajectory.chunks`` can read.
+CHUNK_FIELDS = {
+    "position": ("float32", 3),
+    "orientation": ("float32", 4),
+    "velocity": ("float32", 3),
+    "angmom": ("float32", 4),
+    "image": ("int32", 3),
+}
+
+
+def find_segments(directory, stage="production", archived=False):
+    """Return the segment files of ``stage`` in ``directory`` in run order.
+
+    ``production.gsd`` is the first production segment, followed by
+    ``production2.gsd``, ``production3.gsd``, ... as written by the
+    ``production_run_longer`` operations. With ``archived=True`` the slim
+    ``archive-*.gsd`` copies written by ``template_utils.archive`` are
+    returned instead.
+    """
+    try:
+        pattern = SEGMENT_PATTERNS[stage]
+    except KeyError:
+        raise ValueError(
+            f"Unknown stage {stage}, choose from {list(SEGMENT_PATTERNS)}."
+        )
+    segments = []
+    for name in os.listdir(directory):
+        if archived:
+            if not name.startswith(ARCHIVE_PREFIX):
+                continue
+            match = pattern.match(name[len(ARCHIVE_PREFIX):])
+        else:
+            match = pattern.match(name)
+        if match:
+            number = int(match.group(1)) if match.group(1) else 1
+            segments.append((number, os.path.join(directory, name)))
+    return [path for number, path in sorted(segments)]
+
+
+def _read_nframes(filename):
+    import gsd.fl
+
+    with gsd.fl.open(name=filename, mode="r") as f:
+        return f.nframes
+
+
+def _frame_counts(filenames, index_file=None):
+    """Number of frames per file, cached in ``index_file`` if given.
+
+    Cache entries are keyed by file name and invalidated when the size or
+    modification time of the file changes.
+    """
+    cached = {}
+    if index_file and os.path.isfile(index_file):
+        with open(index_file, "r") as f:
+            cached = json.load(f)
+    counts = []
+    changed = False
+    for filename in filenames:
+        stat = os.stat(filename)
+        key = os.path.basename(filename)
+        entry = cached.get(key)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime
+        ):
+            entry = dict(
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                nframes=_read_nframes(filename),
+            )
+            cached[key] = entry
+            changed = True
+        counts.append(entry["nframes"])
+    if index_file and changed:
+        tmp_file = f"{index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(cached, f, indent=1)
+        os.replace(tmp_file, index_file)
+    return counts
+
+
+def rebuild_frame(traj, index, template=None):
+    """Read frame ``index`` of ``traj`` as a complete frame.
+
+    Velocities and angular momenta that were not written in this frame are
+    set to ``None`` instead of the stale frame 0 values. If ``template`` (a
+    ``gsd.hoomd.Frame`` with the same number of particles) is given, static
+    particle data and topology missing from the file are taken from it.
+    """
+    frame = traj[index]
+    if index > 0:
+        for chunk in MOMENTUM_CHUNKS:
+            if not traj.file.chunk_exists(frame=index, name=chunk):
+                setattr(frame.particles, chunk.split("/")[1], None)
+    if template is not None and frame.particles.N == template.particles.N:
+        for field in STATIC_PARTICLE_FIELDS:
+            if not traj.file.chunk_exists(frame=0, name=f"particles/{field}"):
+                setattr(
+                    frame.particles, field, getattr(template.particles, field)
+                )
+        for group in TOPOLOGY_GROUPS:
+            if not traj.file.chunk_exists(frame=0, name=f"{group}/N"):
+                setattr(frame, group, getattr(template, group))
+    return frame
+
+
+def type_selection(frame, types=None):
+    """Indices of the particles of ``types`` (a name or a list) in ``frame``.
+
+    Returns a ``slice`` if the particles are contiguous, as for chains of
+    one bead type, so that reading them needs no fancy indexing.
+    """
+    import numpy as np
+
+    if types is None:
+        return slice(0, frame.particles.N)
+    if isinstance(types, str):
+        types = [types]
+    unknown = set(types) - set(frame.particles.types)
+    if unknown:
+        raise ValueError(
+            f"Unknown particle types {sorted(unknown)}, the trajectory has "
+            f"{frame.particles.types}."
+        )
+    typeids = [frame.particles.types.index(t) for t in types]
+    indices = np.flatnonzero(np.isin(frame.particles.typeid, typeids))
+    if len(indices) and indices[-1] - indices[0] + 1 == len(indices):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return indices
+
+
+class MultiTrajectory:
+    """Read-only sequence of frames spread over several GSD files.
+
+    Parameters
+    ----------
+    filenames : list of str
+        GSD files in the order their frames should appear.
+    index_file : str, optional
+        JSON file used to cache the number of frames in each file, so that
+        files are only opened when frames are actually read.
+    template : gsd.hoomd.Frame, optional
+        Complete frame used to rebuild frames written without static data,
+        see ``rebuild_frame``.
+
+    Integer indexing returns a ``gsd.hoomd.Frame``, slicing returns a
+    ``TrajectoryView`` that reads frames on demand.
+    """
+
+    def __init__(self, filenames, index_file=None, template=None):
+        self.filenames = [os.path.abspath(f) for f in filenames]
+        self.index_file = index_file
+        self.template = template
+        self._handles = [None] * len(self.filenames)
+        self._offsets = None
+
+    @property
+    def offsets(self):
+        """Global index of the first frame in each file, plus the total."""
+        if self._offsets is None:
+            counts = _frame_counts(self.filenames, self.index_file)
+            self._offsets = list(itertools.accumulate(counts, initial=0))
+        return self._offsets
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def locate(self, index):
+        """Return the (file number, local frame) pair of a global index."""
+        n_frames = len(self)
+        if index < 0:
+            index += n_frames
+        if not 0 <= index < n_frames:
+            raise IndexError(
+                f"Frame {index} out of range for {n_frames} frames."
+            )
+        segment = bisect.bisect_right(self.offsets, index) - 1
+        return segment, index - self.offsets[segment]
+
+    def segment(self, number):
+        """Return the opened ``gsd.hoomd`` trajectory of one file."""
+        if self._handles[number] is None:
+            import gsd.hoomd
+
+            self._handles[number] = gsd.hoomd.open(
+                self.filenames[number], mode="r"
+            )
+        return self._handles[number]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TrajectoryView(self, range(len(self))[key])
+        segment, local = self.locate(int(key))
+        return rebuild_frame(self.segment(segment), local, self.template)
+
+    def __iter__(self):
+        for number in range(len(self.filenames)):
+            n_local = self.offsets[number + 1] - self.offsets[number]
+            if n_local:
+                handle = self.segment(number)
+                for local in range(n_local):
+                    yield rebuild_frame(handle, local, self.template)
+
+    def chunks(
+        self, types=None, fields=("position",), chunk_size=64, frames=None
+    ):
+        """Yield blocks of per-particle arrays of the ``types`` particles.
+
+        Yields ``(indices, blocks)`` with the global frame indices of the
+        block and a dict of ``(len(indices), n_selected, width)`` arrays per
+        field in ``fields`` (see ``CHUNK_FIELDS``). ``frames`` is a slice or
+        range of global frame indices, all frames by default.
+
+        The blocks are reused buffers that are overwritten by the next
+        chunk, copy them to keep them. Fields missing from a frame are taken
+        from frame 0 of its file, as ``gsd.hoomd`` does.
+        """
+        import numpy as np
+
+        unknown = set(fields) - set(CHUNK_FIELDS)
+        if unknown:
+            raise ValueError(
+                f"Unknown fields {sorted(unknown)}, choose from "
+                f"{list(CHUNK_FIELDS)}."
+            )
+        if len(self) == 0:
+            return
+        if frames is None or isinstance(frames, slice):
+            frames = range(len(self))[frames or slice(None)]
+        first = self[0]
+        selection = type_selection(first, types)
+        n_selected = len(range(first.particles.N)[selection])
+        buffers = {
+            field: np.empty(
+                (chunk_size, n_selected, CHUNK_FIELDS[field][1]),
+                dtype=CHUNK_FIELDS[field][0],
+            )
+            for field in fields
+        }
+        defaults = dict()
+        indices = []
+        for index in frames:
+            segment, local = self.locate(index)
+            handle = self.segment(segment)
+            for field in fields:
+                name = f"particles/{field}"
+                if handle.file.chunk_exists(frame=local, name=name):
+                    data = handle.file.read_chunk(frame=local, name=name)
+                else:
+                    if (segment, field) not in defaults:
+                        defaults[(segment, field)] = getattr(
+                            handle[0].particles, field
+                        )
+                    data = defaults[(segment, field)]
+                buffers[field][len(indices)] = data[selection]
+            indices.append(index)
+            if len(indices) == chunk_size:
+                yield np.array(indices), buffers
+                indices = []
+        if indices:
+            yield np.array(indices), {
+                field: buffer[: len(indices)]
+                for field, buffer in buffers.items()
+            }
+
+    def close(self):
+        for handle in self._handles:
+            if handle is not None:
+                handle.close()
+        self._handles = [None] * len(self.filenames)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryView:
+    """Lazy selection of frames from a ``MultiTrajectory``."""
+
+    def __init__(self, trajectory, indices):
+        self.trajectory = trajectory
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return TrajectoryView(self.trajectory, self.indices[key])
+        return self.trajectory[self.indices[key]]
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.trajectory[index]
+
+
+def open_job_trajectory(job, stage="production", archived=False):
+    """Open all segments of ``stage`` in a job's workspace.
+
+    The frame counts are cached in ``{stage}-index.json`` in the job
+    directory. The last frame of ``restart.gsd`` is used as the template
+    for rebuilding full frames.
+    """
+    template = None
+    if job.isfile("restart.gsd"):
+        import gsd.hoomd
+
+        with gsd.hoomd.open(job.fn("restart.gsd"), mode="r") as traj:
+            template = traj[-1]
+    segments = find_segments(job.fn(""), stage=stage, archived=archived)
+    return MultiTrajectory(
+        segments,
+        index_file=job.fn(f"{stage}-index.json"),
+        template=template,
+    )
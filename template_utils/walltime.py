@@ -0,0 +1,129 @@
+"""Predict operation walltimes from recorded telemetry.
+
+The time steps per second of past simulation phases (see
+``template_utils.telemetry``) are fit as a power law of the particle count,
+``TPS = a * N**b``. An operation's walltime is then its number of steps
+divided by the predicted TPS, times a safety factor. Use
+``predicted_walltime`` as the ``walltime`` directive of an operation::
+
+    @Project.operation(
+        directives={"walltime": predicted_walltime(lambda job: job.sp.n_steps)}
+    )
+
+Without any telemetry the directive is ``None`` and the submission template
+falls back to its fixed walltime.
+"""
+import functools
+import math
+
+from template_utils.execution import execution_profile
+from template_utils.telemetry import load
+
+
+@functools.lru_cache(maxsize=None)
+def _project_records(project_root):
+    return load(project_root)
+
+
+def _record_particles(record):
+    """Particle count of a telemetry record.
+
+    Older records of templates that did not store the count in the job
+    document have ``n_particles=None``, it is estimated from the statepoint.
+    """
+    if record.get("n_particles"):
+        return record["n_particles"]
+    statepoint = record.get("statepoint", dict())
+    if "chains" in statepoint:
+        return statepoint["chains"][0] * statepoint["chains"][1]
+    if "N" in statepoint and "length" in statepoint:
+        return statepoint["N"] * statepoint["length"]
+    return None
+
+
+def fit_tps(records, phase="nvt", profile="gpu"):
+    """Fit ``TPS = a * N**b`` to the completed ``phase`` records.
+
+    Only records of the given execution ``profile`` are used. Returns
+    ``(a, b)`` or ``None`` if there are no usable records. With a
+    single system size ``b`` is 0 and ``a`` is the geometric mean TPS.
+    """
+    points = [
+        (math.log(_record_particles(r)), math.log(p["tps"]))
+        for r in records
+        if _record_particles(r)
+        and r["status"] == "completed"
+        and r.get("profile", "gpu") == profile
+        for p in r["phases"]
+        if p["name"] == phase and p.get("tps")
+    ]
+    if not points:
+        return None
+    n = len(points)
+    mean_x = sum(x for x, y in points) / n
+    mean_y = sum(y for x, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, y in points)
+    if var_x == 0:
+        return math.exp(mean_y), 0.0
+    b = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    a = math.exp(mean_y - b * mean_x)
+    return a, b
+
+
+def n_particles(job):
+    """Particle count of a job, estimated from the statepoint if not built."""
+    if "n_particles" in job.doc:
+        return job.doc.n_particles
+    if "num_mols" in job.doc:
+        return job.doc.num_mols * job.doc.lengths
+    return job.sp.N * job.sp.length
+
+
+def predict_walltime(
+    job,
+    n_steps,
+    records=None,
+    safety=1.25,
+    overhead=0.25,
+    maximum=None,
+    particles=None,
+):
+    """Predicted walltime in hours of running ``n_steps`` for ``job``.
+
+    ``overhead`` (hours) covers system setup and I/O. ``particles`` defaults
+    to the particle count of ``job``. Returns ``None`` if there is no
+    telemetry to base the prediction on.
+    """
+    if records is None:
+        import signac
+
+        records = _project_records(signac.get_project().fn(""))
+    model = fit_tps(records, profile=execution_profile(job))
+    if model is None:
+        return None
+    a, b = model
+    if particles is None:
+        particles = n_particles(job)
+    tps = a * particles**b
+    hours = safety * n_steps / tps / 3600 + overhead
+    if maximum is not None:
+        hours = min(hours, maximum)
+    return math.ceil(hours * 4) / 4
+
+
+def predicted_walltime(n_steps, **kwargs):
+    """Walltime directive for an operation running ``n_steps(job)`` steps.
+
+    For aggregate operations the steps of the first job and the total
+    particle count of the aggregate are used.
+    """
+
+    def walltime(*jobs):
+        return predict_walltime(
+            jobs[0],
+            n_steps(jobs[0]),
+            particles=sum(n_particles(job) for job in jobs),
+            **kwargs,
+        )
+
+    return walltime
@@ -0,0 +1,232 @@
+"""Long-lived worker that keeps an allocation busy across the whole project.
+
+Instead of submitting every stage separately, submit one worker per node
+and let it run the stages back to back::
+
+    python project.py worker --hours 47.5
+
+The worker repeatedly picks the eligible (job, operation) pair of the job
+with the longest remaining critical path (see ``template_utils.priority``),
+the longest predicted walltime first, runs it with ``FlowProject.run`` and
+starts over. Aggregate operations, e.g. ``collect-results``, are left to
+``run`` and ``submit``. An operation without a postcondition stays eligible
+after it ran, so the worker runs it at most once per job. It stops when
+nothing is eligible, when the next operation would not finish before the
+allocation ends, or after the running operation when it receives SIGTERM
+(sent by SLURM before the walltime is reached).
+
+A ``worker.lock`` file in the job directory, created atomically, keeps
+several workers from running operations of the same job; the holder is also
+shown in ``job.doc.worker``. Locks expire after the predicted walltime of
+the locked operation, so a crashed worker does not block a job forever.
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import signal
+import socket
+import time
+
+from template_utils.priority import remaining_hours
+from template_utils.telemetry import load
+
+LOCK_FILE = "worker.lock"
+
+_stop = []
+
+
+def _handle_sigterm(signum, frame):
+    print("Received SIGTERM, stopping after the current operation.")
+    _stop.append(signum)
+
+
+def predicted_hours(project, name, job):
+    """Walltime directive of operation ``name`` for ``job`` in hours."""
+    try:
+        directives = project.groups[name].operation_directives[name]
+    except (AttributeError, KeyError):
+        return None
+    walltime = directives.get("walltime")
+    if callable(walltime):
+        walltime = walltime(job)
+    if isinstance(walltime, datetime.timedelta):
+        walltime = walltime.total_seconds() / 3600
+    return walltime
+
+
+def acquire_lock(job, operation, expires):
+    """Lock ``job`` until the unix time ``expires``, False if it is taken."""
+    filename = job.fn(LOCK_FILE)
+    for attempt in range(2):
+        try:
+            fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                with open(filename, "r") as f:
+                    lock = json.load(f)
+            except (OSError, ValueError):
+                return False
+            if lock["expires"] > time.time() or attempt > 0:
+                return False
+            print(f"Removing expired lock of {job.id} held by {lock}.")
+            os.remove(filename)
+    lock = dict(
+        host=socket.gethostname(),
+        pid=os.getpid(),
+        operation=operation,
+        expires=expires,
+    )
+    with os.fdopen(fd, "w") as f:
+        json.dump(lock, f)
+    job.doc.worker = lock
+    return True
+
+
+def release_lock(job):
+    if os.path.isfile(job.fn(LOCK_FILE)):
+        os.remove(job.fn(LOCK_FILE))
+    if "worker" in job.doc:
+        del job.doc["worker"]
+
+
+def _operation_kind(project, name):
+    """Whether operation ``name`` is an aggregate and has postconditions.
+
+    signac-flow has no public accessor for either, so this reads the
+    aggregator flow stores on the operation function and the conditions of
+    the ``FlowOperation``.
+    """
+    from flow import aggregator
+
+    operation = project.operations.get(name)
+    if operation is None:
+        return False, True
+    function = getattr(operation, "_op_func", None)
+    aggregate = getattr(
+        function, "_flow_aggregate", aggregator.groupsof(1)
+    ) != aggregator.groupsof(1)
+    return aggregate, bool(getattr(operation, "_postconditions", True))
+
+
+def eligible_operations(project, stages, names=None):
+    """All eligible (priority, job, operation, hours), highest priority first.
+
+    The priority is the remaining critical path of the job through
+    ``stages`` in hours, then the predicted walltime of the operation.
+    Aggregate operations are left out. Locked jobs are included,
+    ``acquire_lock`` decides whether they can run.
+    """
+    records = load(project.fn(""))
+    candidates = []
+    for job in project:
+        status = project.get_job_status(job)
+        job_hours = None
+        for name, operation in status["operations"].items():
+            if not operation.get("eligible"):
+                continue
+            if names and not any(re.fullmatch(n, name) for n in names):
+                continue
+            if _operation_kind(project, name)[0]:
+                continue
+            if job_hours is None:
+                job_hours = remaining_hours(job, stages, records)
+            hours = predicted_hours(project, name, job)
+            priority = (job_hours, hours or 0)
+            candidates.append((priority, job, name, hours))
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    return candidates
+
+
+def work(
+    project, stages, hours, margin=0.25, names=None, default_hours=None
+):
+    """Run eligible operations until nothing fits in the remaining hours.
+
+    ``stages`` is the critical path of the template, see
+    ``template_utils.priority``. A failing operation is reported and not
+    tried again by this worker, nor is an operation without postconditions
+    that completed. ``margin`` hours are kept free at the end of the
+    allocation. Operations without a walltime prediction are assumed to
+    take ``default_hours``, or all of the remaining time if that is not
+    given.
+    """
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+    end = time.time() + hours * 3600
+    completed = 0
+    failed = set()
+    done = set()
+    while not _stop:
+        left = (end - time.time()) / 3600 - margin
+        chosen = None
+        for priority, job, name, predicted in eligible_operations(
+            project, stages, names
+        ):
+            if (job.id, name) in failed or (job.id, name) in done:
+                continue
+            needed = predicted or default_hours or left
+            if needed <= left and acquire_lock(
+                job, name, time.time() + needed * 3600
+            ):
+                chosen = (job, name)
+                break
+        if chosen is None:
+            break
+        job, name = chosen
+        print(f"Running {name} on {job.id} ({left:.2f} hours left).")
+        try:
+            project.run(jobs=[job], names=[f"^{re.escape(name)}$"])
+            completed += 1
+            if not _operation_kind(project, name)[1]:
+                done.add((job.id, name))
+        except Exception as e:
+            print(f"{name} failed on {job.id}: {e!r}, not retrying it.")
+            failed.add((job.id, name))
+        finally:
+            release_lock(job)
+    print(
+        f"Worker finished after {completed} operations, {len(failed)} failed."
+    )
+    return completed
+
+
+def main(project, stages, args=None):
+    parser = argparse.ArgumentParser(
+        prog="project.py worker", description=__doc__.splitlines()[0]
+    )
+    parser.add_argument(
+        "--hours",
+        type=float,
+        required=True,
+        help="Length of the allocation in hours.",
+    )
+    parser.add_argument(
+        "--margin",
+        type=float,
+        default=0.25,
+        help="Hours to keep free at the end of the allocation.",
+    )
+    parser.add_argument(
+        "--default-hours",
+        type=float,
+        default=None,
+        help="Assumed walltime of operations without a prediction.",
+    )
+    parser.add_argument(
+        "-o",
+        "--operation",
+        dest="names",
+        nargs="+",
+        help="Only run operations matching these regular expressions.",
+    )
+    args = parser.parse_args(args)
+    work(
+        project,
+        stages,
+        hours=args.hours,
+        margin=args.margin,
+        names=args.names,
+        default_hours=args.default_hours,
+    )
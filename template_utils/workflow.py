@@ -0,0 +1,324 @@
+"""Workflow pieces shared by the four templates.
+
+The cluster environments, the labels every template uses and the body of
+the continuation operations (run-longer, production, production_run_longer)
+live here, so a change to how jobs are restarted, written or instrumented
+applies to all templates at once. A template registers the labels on its
+project class and configures each continuation with the files, step count
+and ``Simulation`` arguments that differ between templates::
+
+    initial_run_done = KGCG.label(workflow.initial_run_done)
+
+    @KGCG.pre(initial_run_done)
+    @KGCG.post(equilibrated)
+    @KGCG.operation(...)
+    @instrumented
+    @failure_policy
+    def run_longer(job):
+        workflow.continue_nvt(
+            job,
+            restart="restart.gsd",
+            output="restart.gsd",
+            gsd_file=f"trajectory{job.doc.runs}.gsd",
+            log_file=f"log{job.doc.runs}.txt",
+            n_steps=job.sp.n_equil_steps,
+            stage="equilibration",
+            counter="runs",
+            seed=job.doc.seed,
+        )
+"""
+from flow.environment import DefaultSlurmEnvironment
+
+
+class Borah(DefaultSlurmEnvironment):
+    hostname_pattern = "borah"
+    template = "borah.sh"
+    default_partition = "shortgpu-v100"
+
+    @classmethod
+    def add_args(cls, parser):
+        parser.add_argument(
+            "--partition",
+            default=cls.default_partition,
+            help="Specify the partition to submit to."
+        )
+
+
+class Fry(DefaultSlurmEnvironment):
+    hostname_pattern = "fry"
+    template = "fry.sh"
+    default_partition = "v100,batch"
+
+    @classmethod
+    def add_args(cls, parser):
+        parser.add_argument(
+            "--partition",
+            default=cls.default_partition,
+            help="Specify the partition to submit to."
+        )
+
+
+def initial_run_done(job):
+    return job.doc.runs > 0
+
+
+def equilibrated(job):
+    return job.doc.equilibrated
+
+
+def sampled(job):
+    return job.doc.sampled
+
+
+def production_done(job):
+    return job.isfile("production-restart.gsd")
+
+
+def archived(job):
+    from template_utils.archive import unarchived
+
+    return job.doc.get("archived", False) and not unarchived(job)
+
+
+def nlist_tuned(job):
+    return "nlist" in job.doc
+
+
+def print_job_id(job):
+    print("------------------------------------")
+    print("JOB ID NUMBER:")
+    print(job.id)
+    print("------------------------------------")
+
+
+def continue_nvt(
+    job,
+    restart,
+    output,
+    gsd_file,
+    log_file,
+    n_steps,
+    stage,
+    counter,
+    seed,
+    gsd_write_freq=None,
+    rigid=False,
+    **simulation_kwargs,
+):
+    """Continue the simulation of ``job`` from ``restart`` under NVT.
+
+    Loads the job's pickled force field with the tuned neighbor list
+    settings, restores the full precision state and thermostat saved with
+    ``restart`` and runs ``n_steps`` writing ``gsd_file`` and ``log_file``
+    with the output schedule of ``stage``. The final state is saved to
+    ``output`` and ``job.doc[counter]`` is incremented. ``gsd_write_freq``
+    defaults to ``job.sp.gsd_write_freq``. With ``rigid`` the rigid body
+    constraint is rebuilt from the job document. The timestep is
+    ``job.sp.dt`` times ``job.doc.dt_factor``, which ``failure_policy``
+    reduces after unstable runs. Other keyword arguments, e.g.
+    ``reference_values``, are passed to ``flowermd.base.Simulation``.
+
+    The run is watched by ``template_utils.monitor``. If it stops the run,
+    the state is saved to ``aborted-<output>`` for inspection, ``restart``
+    is left as it is and the exception is re-raised for ``failure_policy``.
+    """
+    import pickle
+
+    from flowermd.base import Simulation
+
+    from template_utils.checkpoint import (
+        restore_checkpoint,
+        run_nvt,
+        save_checkpoint,
+    )
+    from template_utils.execution import execution_device, rank_doc
+    from template_utils.monitor import UnstableSimulation, add_drift_monitor
+    from template_utils.nlist import apply_nlist_settings
+    from template_utils.telemetry import phase
+    from template_utils.writers import set_gsd_dynamic, set_output_schedule
+
+    with job:
+        doc = rank_doc(job)
+        print_job_id(job)
+        print(f"Continuing the simulation from {restart}...")
+        with open(job.fn("forcefield.pickle"), "rb") as f:
+            hoomd_ff = pickle.load(f)
+        apply_nlist_settings(hoomd_ff, job)
+        if rigid:
+            from template_utils.ellipsoid import rigid_constraint
+
+            simulation_kwargs["constraint"] = rigid_constraint(
+                job, job.fn(restart)
+            )
+        if gsd_write_freq is None:
+            gsd_write_freq = job.sp.gsd_write_freq
+        sim = Simulation(
+            initial_state=job.fn(restart),
+            device=execution_device(job),
+            forcefield=hoomd_ff,
+            dt=job.sp.dt * job.doc.get("dt_factor", 1.0),
+            gsd_write_freq=int(gsd_write_freq),
+            gsd_file_name=job.fn(gsd_file),
+            log_write_freq=job.sp.log_write_freq,
+            log_file_name=job.fn(log_file),
+            seed=seed,
+            **simulation_kwargs,
+        )
+        set_gsd_dynamic(sim, job)
+        checkpoint = restore_checkpoint(sim, job.fn(restart))
+        set_output_schedule(sim, job, stage, n_steps=n_steps)
+        add_drift_monitor(sim, job)
+        print("Running simulation.")
+        try:
+            with phase("nvt", sim):
+                run_nvt(
+                    sim,
+                    checkpoint,
+                    n_steps=n_steps,
+                    kT=job.sp.kT,
+                    tau_kt=job.doc.tau_kT,
+                )
+        except UnstableSimulation as e:
+            aborted = f"aborted-{output}"
+            print(f"Stopped early: {e}")
+            print(f"Saving the unstable state to {aborted}.")
+            save_checkpoint(sim, job.fn(aborted))
+            raise
+        with phase("io"):
+            save_checkpoint(sim, job.fn(output))
+        doc[counter] = job.doc.get(counter, 0) + 1
+        print("Simulation finished.")
+
+
+def continue_replicas(
+    jobs,
+    restart,
+    output,
+    gsd_files,
+    n_steps,
+    stage,
+    counter,
+    seeds,
+    gsd_write_freq=None,
+):
+    """Continue the seed replicas ``jobs`` together from ``restart``.
+
+    The aggregate counterpart of ``continue_nvt``, run with
+    ``template_utils.replicas.run_replicas``. ``gsd_files`` and ``seeds``
+    hold the trajectory file and the seed of every job. The force field,
+    timestep, output schedule and drift monitor settings of the first job
+    are used for all replicas. The final state of each replica is saved to
+    its ``output`` and ``job.doc[counter]`` of every job is incremented.
+    """
+    import pickle
+
+    import hoomd
+
+    from template_utils.execution import execution_device, rank_doc
+    from template_utils.monitor import add_drift_monitor
+    from template_utils.nlist import apply_nlist_settings
+    from template_utils.replicas import run_replicas
+    from template_utils.telemetry import phase
+    from template_utils.writers import output_trigger, record_schedule
+
+    first = jobs[0]
+    for job in jobs:
+        print_job_id(job)
+    with open(first.fn("forcefield.pickle"), "rb") as f:
+        hoomd_ff = pickle.load(f)
+    apply_nlist_settings(hoomd_ff, first)
+    if gsd_write_freq is None:
+        gsd_write_freq = first.sp.gsd_write_freq
+
+    def write_trigger(start):
+        trigger, schedule = output_trigger(
+            first, stage, start, n_steps, gsd_write_freq
+        )
+        for job, gsd_file in zip(jobs, gsd_files):
+            record_schedule(job, gsd_file, schedule, start, n_steps)
+        return trigger
+
+    def monitor(sim):
+        add_drift_monitor(sim, first, filter=hoomd.filter.All())
+
+    print(f"Running {len(jobs)} replicas together from {restart}.")
+    with phase("nvt") as measured:
+        tps = run_replicas(
+            restart_files=[job.fn(restart) for job in jobs],
+            forces=hoomd_ff,
+            n_steps=n_steps,
+            kT=first.sp.kT,
+            tau_kt=first.doc.tau_kT,
+            dt=first.sp.dt * first.doc.get("dt_factor", 1.0),
+            seeds=seeds,
+            trajectory_files=[
+                job.fn(gsd_file) for job, gsd_file in zip(jobs, gsd_files)
+            ],
+            write_freq=gsd_write_freq,
+            output_files=[job.fn(output) for job in jobs],
+            device=execution_device(first),
+            write_trigger=write_trigger,
+            monitor=monitor,
+        )
+        measured.update(steps=int(n_steps), tps=tps)
+    for job in jobs:
+        doc = rank_doc(job)
+        doc[counter] = job.doc.get(counter, 0) + 1
+    print(f"Simulation finished at {tps:.1f} steps/s for all replicas.")
+
+
+def tune_neighbor_list(job, seed, rigid=False, **simulation_kwargs):
+    """Store the fastest neighbor list settings of ``restart.gsd``.
+
+    The result of ``template_utils.nlist.tune_nlist`` is written to
+    ``job.doc.nlist``, from where ``continue_nvt`` applies it. Tuning runs
+    at the timestep of the continuations, including ``job.doc.dt_factor``.
+    Its trajectory and log go to a temporary directory.
+    """
+    import os
+    import pickle
+    import tempfile
+
+    from flowermd.base import Simulation
+
+    from template_utils.checkpoint import restore_checkpoint
+    from template_utils.execution import execution_device, rank_doc
+    from template_utils.nlist import TUNE_STEPS, tune_nlist
+    from template_utils.telemetry import phase
+
+    with job:
+        doc = rank_doc(job)
+        print_job_id(job)
+        with open(job.fn("forcefield.pickle"), "rb") as f:
+            hoomd_ff = pickle.load(f)
+        if rigid:
+            from template_utils.ellipsoid import rigid_constraint
+
+            simulation_kwargs["constraint"] = rigid_constraint(
+                job, job.fn("restart.gsd")
+            )
+        n_steps = int(job.doc.get("nlist_tune_steps", TUNE_STEPS))
+        with tempfile.TemporaryDirectory() as scratch:
+            sim = Simulation(
+                initial_state=job.fn("restart.gsd"),
+                device=execution_device(job),
+                forcefield=hoomd_ff,
+                dt=job.sp.dt * job.doc.get("dt_factor", 1.0),
+                gsd_write_freq=int(1e9),
+                gsd_file_name=os.path.join(scratch, "tune-nlist.gsd"),
+                log_write_freq=int(1e9),
+                log_file_name=os.path.join(scratch, "tune-nlist.txt"),
+                seed=seed,
+                **simulation_kwargs,
+            )
+            restore_checkpoint(sim, job.fn("restart.gsd"))
+            print("Scanning neighbor list settings...")
+            with phase("nvt", sim):
+                result = tune_nlist(
+                    sim, kT=job.sp.kT, tau_kt=job.doc.tau_kT, n_steps=n_steps
+                )
+            # Close the output files before the directory is removed.
+            sim.operations.writers.clear()
+        doc.nlist = result
+        print(result)
+        print("Finished.")
@@ -0,0 +1,194 @@
+"""Configure the HOOMD writers created by ``flowermd.base.Simulation``.
+
+HOOMD's GSD writer stores every quantity in the first frame of a file and
+only the quantities listed in ``dynamic`` in the frames after it. Topology,
+types, masses and rigid body definitions therefore never need to be
+repeated. By default only positions, orientations and image flags are
+written per frame; velocities and angular momenta are dropped.
+
+The timesteps at which frames are written can be changed from the fixed
+``gsd_write_freq`` to log-spaced, multi-tier or burst schedules with
+``set_output_schedule``.
+"""
+import os
+
+DEFAULT_GSD_DYNAMIC = ["property", "particles/image"]
+
+
+def set_gsd_dynamic(sim, job):
+    """Set the per-frame quantities of the simulation's GSD writers.
+
+    The list is read from ``job.doc.gsd_dynamic`` (initialised to
+    ``DEFAULT_GSD_DYNAMIC``) so that readers know what each frame holds.
+    Must be called before the first ``run``, when the writers are attached.
+    """
+    import hoomd
+
+    from template_utils.execution import rank_doc
+
+    doc = rank_doc(job)
+    dynamic = list(doc.setdefault("gsd_dynamic", DEFAULT_GSD_DYNAMIC))
+    for writer in sim.operations.writers:
+        if isinstance(writer, hoomd.write.GSD):
+            writer.dynamic = dynamic
+
+
+OUTPUT_MODES = ("linear", "log", "tiers", "burst")
+
+
+def frame_steps(schedule, start, n_steps):
+    """Timesteps at which a GSD writer with ``schedule`` writes a frame.
+
+    ``start`` is the timestep the operation started at and ``n_steps`` the
+    number of steps it ran, as recorded in ``job.doc.output_schedules``.
+    """
+    import numpy as np
+
+    n_steps = int(n_steps)
+    mode = schedule.get("mode", "linear")
+    offsets = [np.zeros(0)]
+    if mode == "log":
+        decades = np.log10(max(n_steps, 1))
+        n_frames = int(np.ceil(decades * schedule.get("frames_per_decade", 10)))
+        offsets.append(np.round(np.logspace(0, decades, n_frames + 1)))
+    elif mode == "tiers":
+        begin = 0
+        for until, period in schedule["tiers"]:
+            until = min(int(until), n_steps)
+            period = int(period)
+            offsets.append(np.arange(begin + period, until + 1, period))
+            begin = until
+    elif mode == "burst":
+        offsets.append(
+            np.arange(
+                int(schedule["burst_period"]),
+                int(schedule["burst_steps"]) + 1,
+                int(schedule["burst_period"]),
+            )
+        )
+    if "period" in schedule:
+        period = int(schedule["period"])
+        first = (start // period + 1) * period
+        offsets.append(np.arange(first, start + n_steps + 1, period) - start)
+    offsets = np.unique(np.concatenate(offsets).astype(np.int64))
+    return (start + offsets[(offsets > 0) & (offsets <= n_steps)]).tolist()
+
+
+def _schedule_trigger(schedule, start, n_steps):
+    import hoomd
+
+    mode = schedule.get("mode", "linear")
+    triggers = []
+    if mode == "log":
+        # A handful of frames per decade, so a list of On triggers is cheap
+        log_schedule = {k: v for k, v in schedule.items() if k != "period"}
+        triggers += [
+            hoomd.trigger.On(step)
+            for step in frame_steps(log_schedule, start, n_steps)
+        ]
+    elif mode == "tiers":
+        begin = 0
+        for until, period in schedule["tiers"]:
+            until = min(int(until), int(n_steps))
+            triggers.append(
+                hoomd.trigger.And(
+                    [
+                        hoomd.trigger.After(start + begin),
+                        hoomd.trigger.Before(start + until + 1),
+                        hoomd.trigger.Periodic(
+                            int(period), phase=(start + begin) % int(period)
+                        ),
+                    ]
+                )
+            )
+            begin = until
+    elif mode == "burst":
+        burst_period = int(schedule["burst_period"])
+        triggers.append(
+            hoomd.trigger.And(
+                [
+                    hoomd.trigger.After(start),
+                    hoomd.trigger.Before(
+                        start + int(schedule["burst_steps"]) + 1
+                    ),
+                    hoomd.trigger.Periodic(
+                        burst_period, phase=start % burst_period
+                    ),
+                ]
+            )
+        )
+    if "period" in schedule:
+        triggers.append(hoomd.trigger.Periodic(int(schedule["period"])))
+    if len(triggers) == 1:
+        return triggers[0]
+    return hoomd.trigger.Or(triggers)
+
+
+def _stage_schedule(job, stage):
+    schedule = dict(job.doc.get("output_schedule", dict()).get(stage, dict()))
+    mode = schedule.setdefault("mode", "linear")
+    if mode not in OUTPUT_MODES:
+        raise ValueError(
+            f"Unknown output mode {mode}, choose from {OUTPUT_MODES}."
+        )
+    return schedule
+
+
+def record_schedule(job, filename, schedule, start, n_steps):
+    """Record the schedule of ``filename`` in ``job.doc.output_schedules``."""
+    from template_utils.execution import rank_doc
+
+    schedules = dict(job.doc.get("output_schedules", dict()))
+    schedules[os.path.basename(filename)] = dict(
+        schedule, start=start, n_steps=int(n_steps)
+    )
+    rank_doc(job).output_schedules = schedules
+
+
+def output_trigger(job, stage, start, n_steps, period):
+    """Trigger and schedule of a writer following the job's ``stage`` schedule.
+
+    For writers not created by ``flowermd.base.Simulation``, e.g. the
+    replica writer of ``template_utils.replicas``. ``period`` is used
+    without a schedule. Pass the schedule to ``record_schedule``.
+    """
+    schedule = _stage_schedule(job, stage)
+    if schedule["mode"] == "linear" and "period" not in schedule:
+        schedule["period"] = int(period)
+    return _schedule_trigger(schedule, start, n_steps), schedule
+
+
+def set_output_schedule(sim, job, stage, n_steps):
+    """Replace the GSD trigger with the job's schedule for ``stage``.
+
+    ``job.doc.output_schedule`` maps a stage (``"equilibration"`` or
+    ``"production"``) to a schedule, relative to the timestep the operation
+    starts at::
+
+        {"mode": "linear", "period": 1e6}
+        {"mode": "log", "frames_per_decade": 10, "period": 1e7}
+        {"mode": "tiers", "tiers": [[1e4, 1e2], [1e6, 1e4], [1e8, 1e6]]}
+        {"mode": "burst", "burst_steps": 1e5, "burst_period": 1e3,
+         "period": 1e6}
+
+    Log spacing starts at the first step after ``start``. Tiers give
+    ``[until, period]`` pairs, where ``until`` is the number of steps after
+    the start up to which ``period`` applies. A burst writes densely for
+    ``burst_steps`` after the start. ``period`` adds frames at fixed
+    multiples of the timestep. Without a schedule the writer keeps its
+    fixed period. Either way the schedule, the starting step and
+    ``n_steps`` are recorded in ``job.doc.output_schedules`` under the
+    file name, so ``frame_steps`` can rebuild the frame timesteps.
+    """
+    import hoomd
+
+    schedule = _stage_schedule(job, stage)
+    start = sim.timestep
+    for writer in sim.operations.writers:
+        if not isinstance(writer, hoomd.write.GSD):
+            continue
+        if schedule["mode"] == "linear" and "period" not in schedule:
+            schedule["period"] = writer.trigger.period
+        else:
+            writer.trigger = _schedule_trigger(schedule, start, n_steps)
+        record_schedule(job, writer.filename, schedule, start, n_steps)